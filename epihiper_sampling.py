@@ -1,28 +1,234 @@
+"""
+Sample intermediate contact network files in streaming passes with memory bounded by the sample size.
+    - 'reservoir': Uniform sampling without replacement of exactly 'sample_size' edges (or all edges if fewer).
+    - 'bernoulli': Each edge is kept independently with probability 'sample_rate'.
+    - 'stratified': Edges are stratified by activity and/or duration bins. A first pass counts the edges per stratum,
+                    and 'sample_size' edges are allocated over strata proportionally to their sizes by the largest
+                    remainder method. A second pass keeps a reservoir of its quota per stratum.
+Input files are EpiHiper network files, i.e. the first line is the schema, the second line is the header, and the rest
+is the data:
+    targetPID,targetActivity,sourcePID,sourceActivity,duration,LID
+Output files only have the header and the data, which is the format the loaders expect.
+"""
+
 import logging
 import csv
+import math
 import random
+import multiprocessing
 
 g_contact_network_int_file_fmt = '/project/bii_nssac/COVID-19_USA_EpiHiper/rivanna/20211020-network_query/wy' \
                                  '/replicate_0/network[{0}]'
 g_sample_contact_network_int_file_fmt = '/scratch/mf3jh/data/epihiper/network_{0}'
 
+g_concurrency = math.ceil(multiprocessing.cpu_count() * 0.8)
+
+# Duration bins for 'stratified'. A duration falls into bin k if g_duration_bin[k - 1] <= duration < g_duration_bin[k].
+g_duration_bin = [300, 900, 1800, 3600, 7200, 14400, 28800]
+
+
+def read_network_file(in_path):
+    """
+    Yield the header and then the data rows of a network file one by one.
+    """
+    with open(in_path, 'r') as in_fd:
+        csv_reader = csv.reader(in_fd, delimiter=',')
+        for row_idx, row in enumerate(csv_reader):
+            if row_idx == 0:
+                continue
+            yield row
+
+
+def duration_bin(duration):
+    for bin_idx, bin_upper in enumerate(g_duration_bin):
+        if duration < bin_upper:
+            return bin_idx
+    return len(g_duration_bin)
+
+
+g_l_stratify_by = ['trg_act', 'src_act', 'duration']
+
+
+def stratum_key(row, l_stratify_by):
+    """
+    :param
+        l_stratify_by: list of str
+            Any of 'trg_act', 'src_act' and 'duration'.
+    """
+    l_key = []
+    for stratify_by in l_stratify_by:
+        if stratify_by == 'trg_act':
+            l_key.append(row[1])
+        elif stratify_by == 'src_act':
+            l_key.append(row[3])
+        elif stratify_by == 'duration':
+            l_key.append(duration_bin(int(row[4])))
+        else:
+            raise Exception('[stratum_key] Unknown stratify_by: %s' % stratify_by)
+    return tuple(l_key)
+
+
+def reservoir_sample(row_iter, sample_size, rng):
+    """
+    Algorithm R. Return (sample, number of rows seen).
+    """
+    l_sample = []
+    num_seen = 0
+    for row in row_iter:
+        if num_seen < sample_size:
+            l_sample.append(row)
+        else:
+            idx = rng.randint(0, num_seen)
+            if idx < sample_size:
+                l_sample[idx] = row
+        num_seen += 1
+    return l_sample, num_seen
+
+
+def bernoulli_sample(row_iter, sample_rate, rng):
+    l_sample = []
+    num_seen = 0
+    for row in row_iter:
+        if rng.random() < sample_rate:
+            l_sample.append(row)
+        num_seen += 1
+    return l_sample, num_seen
+
+
+def count_strata(row_iter, l_stratify_by):
+    """
+    Return dict of stratum -> number of rows.
+    """
+    d_num_seen = dict()
+    for row in row_iter:
+        key = stratum_key(row, l_stratify_by)
+        d_num_seen[key] = d_num_seen.get(key, 0) + 1
+    return d_num_seen
+
+
+def stratum_quotas(d_num_seen, sample_size):
+    """
+    Allocate 'sample_size' over strata proportionally to their sizes by the largest remainder method, so that the
+    quotas sum up to min(sample_size, number of rows) and no quota exceeds its stratum.
+    """
+    d_quota = {key: 0 for key in d_num_seen}
+    left = min(sample_size, sum(d_num_seen.values()))
+    while left > 0:
+        l_open = [key for key in d_num_seen if d_quota[key] < d_num_seen[key]]
+        num_open_total = float(sum(d_num_seen[key] for key in l_open))
+        d_share = {key: left * d_num_seen[key] / num_open_total for key in l_open}
+        d_part = {key: min(int(d_share[key]), d_num_seen[key] - d_quota[key]) for key in l_open}
+        num_rest = left - sum(d_part.values())
+        for key in sorted(l_open, key=lambda key: d_share[key] - int(d_share[key]), reverse=True):
+            if num_rest <= 0:
+                break
+            if d_quota[key] + d_part[key] < d_num_seen[key]:
+                d_part[key] += 1
+                num_rest -= 1
+        for key in l_open:
+            d_quota[key] += d_part[key]
+        left -= sum(d_part.values())
+    return d_quota
+
+
+def stratified_sample(row_iter, d_quota, l_stratify_by, rng):
+    """
+    Keep a reservoir of its quota in 'd_quota' (stratum -> int, see 'stratum_quotas') per stratum.
+    Return (sample, number of rows seen).
+    """
+    d_reservoir = {key: [] for key in d_quota}
+    d_num_seen = {key: 0 for key in d_quota}
+    num_total = 0
+    for row in row_iter:
+        num_total += 1
+        key = stratum_key(row, l_stratify_by)
+        quota = d_quota.get(key, 0)
+        if quota <= 0:
+            continue
+        num_seen = d_num_seen[key]
+        if num_seen < quota:
+            d_reservoir[key].append(row)
+        else:
+            idx = rng.randint(0, num_seen)
+            if idx < quota:
+                d_reservoir[key][idx] = row
+        d_num_seen[key] = num_seen + 1
+
+    l_sample = []
+    for key in d_reservoir:
+        l_sample += d_reservoir[key]
+    return l_sample, num_total
+
+
+def sample_network_file(in_path, out_path, method='reservoir', sample_size=1000000, sample_rate=None,
+                        l_stratify_by=None, seed=None):
+    """
+    Sample one network file and write the sample with the header.
+    :return: (int, int)
+        (Number of rows seen, number of rows sampled)
+    """
+    logging.debug('[sample_network_file] Start with %s' % in_path)
+    if method not in ['reservoir', 'bernoulli', 'stratified']:
+        raise Exception('[sample_network_file] method can only be "reservoir", "bernoulli" or "stratified"!')
+    if method in ['reservoir', 'stratified'] and (not isinstance(sample_size, int) or sample_size < 0):
+        raise Exception('[sample_network_file] sample_size must be a non-negative int for "%s"!' % method)
+    if method == 'bernoulli' and (sample_rate is None or not 0 <= sample_rate <= 1):
+        raise Exception('[sample_network_file] sample_rate must be in [0, 1] for "bernoulli"!')
+    if method == 'stratified' and (not l_stratify_by
+                                   or any(stratify_by not in g_l_stratify_by for stratify_by in l_stratify_by)):
+        raise Exception('[sample_network_file] l_stratify_by must be a non-empty list of %s for "stratified"!'
+                        % g_l_stratify_by)
+    rng = random.Random(seed)
+
+    row_iter = read_network_file(in_path)
+    header = next(row_iter)
+    if method == 'reservoir':
+        l_sample, num_seen = reservoir_sample(row_iter, sample_size, rng)
+    elif method == 'bernoulli':
+        l_sample, num_seen = bernoulli_sample(row_iter, sample_rate, rng)
+    else:
+        d_quota = stratum_quotas(count_strata(row_iter, l_stratify_by), sample_size)
+        row_iter = read_network_file(in_path)
+        next(row_iter)
+        l_sample, num_seen = stratified_sample(row_iter, d_quota, l_stratify_by, rng)
+
+    with open(out_path, 'w+') as out_fd:
+        csv_writer = csv.writer(out_fd, delimiter=',')
+        csv_writer.writerow(header)
+        csv_writer.writerows(l_sample)
+    logging.debug('[sample_network_file] Done with %s: %s of %s rows sampled.' % (in_path, len(l_sample), num_seen))
+    return num_seen, len(l_sample)
+
+
+def sample_network_file_single_task(task):
+    return sample_network_file(*task)
+
+
+def sample_network_files(l_int_idx, method='reservoir', sample_size=1000000, sample_rate=None, l_stratify_by=None,
+                         seed=None, num_proc=None):
+    """
+    Sample the network files of 'l_int_idx' in parallel, one file per process.
+    """
+    if num_proc is None:
+        num_proc = g_concurrency
+    l_task = []
+    for int_idx in l_int_idx:
+        file_seed = None if seed is None else seed + int_idx
+        l_task.append((g_contact_network_int_file_fmt.format(str(int_idx)),
+                       g_sample_contact_network_int_file_fmt.format(str(int_idx)),
+                       method, sample_size, sample_rate, l_stratify_by, file_seed))
+    with multiprocessing.Pool(processes=min(num_proc, max(len(l_task), 1))) as pool:
+        l_ret = pool.map(sample_network_file_single_task, l_task)
+    return l_ret
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
 
     sample_size = 1000000
     num_int = 10
-    header = None
-    for int_idx in range(num_int):
-        logging.debug('Start with %s' % int_idx)
-        ln_cnt = 0
-        # READ IN CSV
-        with open(g_contact_network_int_file_fmt.format(str(int_idx)), 'r') as in_fd:
-            csv_reader = list(csv.reader(in_fd, delimiter=','))
-            header = csv_reader[1]
-            l_sample = random.choices(csv_reader[2:], k=sample_size)
-        # WRITE OUT
-        with open(g_sample_contact_network_int_file_fmt.format(str(int_idx)), 'w+') as out_fd:
-            csv_writer = csv.writer(out_fd, delimiter=',')
-            csv_writer.writerow(header)
-            csv_writer.writerows(l_sample)
+    sample_network_files(range(num_int), method='reservoir', sample_size=sample_size)
+    # sample_network_files(range(num_int), method='bernoulli', sample_rate=0.01)
+    # sample_network_files(range(num_int), method='stratified', sample_size=sample_size,
+    #                      l_stratify_by=['trg_act', 'duration'])
     logging.debug('All done.')
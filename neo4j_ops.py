@@ -55,24 +55,57 @@ NOTE
         - Check out all 'TODO', and make modifications when necessary.
 """
 
-# import json
+import time
+g_module_load_start = time.time()
+
+import json
 import logging
 import csv
 import os
 import sys
-import time
 import math
 import sqlite3
 from os import path, walk
 import re
+import hashlib
+import pickle
+import zlib
 import multiprocessing
 import threading
+import queue
+import socket
+import resource
+import importlib
+
+
+class LazyModule(object):
+    """
+    A module imported on its first attribute access. Heavy modules are bound to these, so that a command only pays
+    for importing the modules it actually touches, e.g. 'load_epihiper_output_data' needs none of them.
+    """
+    def __init__(self, module_name, needed_by=None):
+        self.module_name = module_name
+        self.needed_by = needed_by
+        self.module = None
+
+    def __getattr__(self, attr):
+        if self.module is None:
+            try:
+                self.module = importlib.import_module(self.module_name)
+            except ImportError as e:
+                raise ImportError('[LazyModule] %s is required%s but cannot be imported: %s'
+                                  % (self.module_name, '' if self.needed_by is None else ' by ' + self.needed_by, e))
+        return getattr(self.module, attr)
+
 
-import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from neo4j import GraphDatabase
-import snap
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+neo4j = LazyModule('neo4j', 'Neo4j commands')
+# OPTIONAL
+# Only needed by plotting and SNAP commands respectively.
+plt = LazyModule('matplotlib.pyplot', 'plotting')
+sns = LazyModule('seaborn', 'plotting')
+snap = LazyModule('snap', 'SNAP graph export')
 
 
 ################################################################################
@@ -142,6 +175,33 @@ g_init_cn_path = path.join(g_init_cn_folder, g_init_cn_file_name)
 g_person_trait_path = path.join(g_init_cn_folder, g_person_trait_file_name)
 g_epihiper_output_path = path.join(g_epihiper_output_folder, g_int_cn_folder, 'output.csv')
 g_epihiper_output_db_path = path.join(g_epihiper_output_folder, g_int_cn_folder, 'output.db')
+g_epihiper_output_col_folder = path.join(g_epihiper_output_folder, g_int_cn_folder, 'output_col')
+g_cn_csr_folder = path.join(g_epihiper_output_folder, g_int_cn_folder, 'cn_csr')
+g_person_col_folder = path.join(g_epihiper_output_folder, g_int_cn_folder, 'person_col')
+g_household_folder = path.join(g_epihiper_output_folder, g_int_cn_folder, 'household')
+g_tick_degree_folder = path.join(g_epihiper_output_folder, g_int_cn_folder, 'tick_degree')
+g_sketch_folder = path.join(g_epihiper_output_folder, g_int_cn_folder, 'sketch')
+g_stats_catalog_db_path = path.join(g_epihiper_output_folder, g_int_cn_folder, 'stats_catalog.db')
+g_transmission_tree_path = path.join(g_epihiper_output_folder, g_int_cn_folder, 'transmission_tree.npz')
+g_output_cube_folder = path.join(g_epihiper_output_folder, g_int_cn_folder, 'output_cube')
+g_pidset_store_path = path.join(g_epihiper_output_folder, g_int_cn_folder, 'pidset_store.npz')
+g_query_cache_folder = path.join(g_epihiper_output_folder, g_int_cn_folder, 'query_cache')
+g_instrument_report_folder = path.join(g_epihiper_output_folder, g_int_cn_folder, 'instrument')
+g_pipeline_trace_path = path.join(g_epihiper_output_folder, g_int_cn_folder, 'pipeline_trace.json')
+g_query_daemon_socket_path = path.join(g_epihiper_output_folder, g_int_cn_folder, 'query_daemon.sock')
+
+# TODO
+# Each of these adds work to every load, so they are off by default. Whatever is enabled of the three per-tick
+# ones shares one pass over the contact network file of the tick. See 'process_loaded_tick'.
+# If True, per-tick degree tables are materialized right after the edges of each tick are loaded.
+g_materialize_tick_degrees = False
+# If True, sketches of each tick are built right after the edges of the tick are loaded, and sketches of people are
+# built right after nodes are loaded.
+g_build_sketches = False
+# If True, the statistics catalog is updated right after nodes or the edges of a tick are loaded.
+g_maintain_stats_catalog = False
+# If True, the prefix-sum cube of the EpiHiper output is materialized right after the output is loaded into SQLite.
+g_materialize_output_cube = False
 
 g_neo4j_server_uri = None
 g_neo4j_server_uri_fmt = 'neo4j://{0}:7687'
@@ -161,10 +221,472 @@ elif g_neo4j_edition == 'enterprise':
 
 g_epihiper_output_tb_name = 'epihiper_output'
 
+# TODO
+# Physical layout of the EpiHiper output table.
+# - 'rowid': Rows are stored in the load order keyed by 'out_id'.
+# - 'tick_clustered': A WITHOUT ROWID table keyed by (tick, exit_state, pid, out_id), so rows of the same tick, and of
+#   the same exit state within a tick, sit on contiguous pages. Tick-window and exit-state scans then become range
+#   scans over the primary key.
+# !!!CAUTION!!!
+# The layout is decided at 'create_epihiper_output_db' and cannot be changed afterwards. Make sure the same value is
+# used for all the following commands on the same DB.
+g_epihiper_output_db_layout = 'rowid'
+# g_epihiper_output_db_layout = 'tick_clustered'
+
 
 # Only for examle queries
 g_example_query_folder = '/project/biocomplexity/mf3jh/example_queries/'
 g_example_query_each_folder_fmt = path.join(g_example_query_folder, 'query_{0}')
+# TODO
+# If True, the example queries checkpoint the intermediate and final results into their folders.
+g_example_query_checkpoint = True
+
+
+################################################################################
+#   QUERY RESULT CACHE
+################################################################################
+# Results of read queries to Neo4j and SQLite are cached on disk across runs, since the DBs only change at load time:
+#   <g_query_cache_folder>/index.db:       SQLite. 'query_cache' (key, size, last_access, hit) indexes entries, and
+#                                          'load_epoch' holds the load epoch.
+#   <g_query_cache_folder>/<key>.pickle:   The pickled result of an entry.
+# A key is the SHA-1 of the namespace, the query text, the parameters and the load epoch. Every command that changes
+# a DB (see 'g_l_load_epoch_cmd') bumps the load epoch and clears the cache, so stale results are never returned. The
+# loaders ('create_nodes_for_init_cn', 'create_edges' and 'load_epihiper_output_to_db') also bump it when they finish,
+# so that results cached while they were writing are dropped too.
+# When the cache grows beyond 'g_query_cache_max_bytes', the least recently used entries are evicted.
+# Neo4j queries that may write, or that anchor on cohort labels (see 'COHORT LABELS'), are never cached.
+# Bumping is a no-op until the cache has been used, so loaders do not touch the cache folder when it is off. The load
+# epoch is read through a read-only connection, so concurrent lookups do not contend for the write lock of the index.
+g_query_cache_enabled = False
+g_query_cache_max_bytes = 10 * 1024 ** 3
+g_query_cache_stats = {'hit': 0, 'miss': 0, 'put': 0, 'evict': 0, 'skip': 0}
+g_query_cache_lock = threading.Lock()
+g_query_cache_index_ready = False
+g_l_load_epoch_cmd = ['create_db', 'create_constraints', 'create_indexes', 'purge_db', 'create_nodes',
+                      'create_init_cn_edges', 'create_int_cn_edges', 'create_epihiper_output_db',
+                      'load_epihiper_output_data', 'create_epihiper_output_db_indexes', 'parallel_apoc',
+                      'serial_apoc', 'bogus_data']
+g_neo4j_write_clause_re = re.compile(r'\b(create|merge|set|delete|remove|call|foreach|load\s+csv)\b', re.IGNORECASE)
+
+
+def query_cache_count(stat):
+    with g_query_cache_lock:
+        g_query_cache_stats[stat] += 1
+
+
+def query_cache_stats():
+    with g_query_cache_lock:
+        return dict(g_query_cache_stats)
+
+
+def connect_to_query_cache():
+    """
+    Open the index for writing. The tables are created once per process.
+    """
+    global g_query_cache_index_ready
+    index_path = path.join(g_query_cache_folder, 'index.db')
+    if g_query_cache_index_ready and path.exists(index_path):
+        return sqlite3.connect(index_path, timeout=600)
+    if not path.exists(g_query_cache_folder):
+        os.makedirs(g_query_cache_folder, exist_ok=True)
+    db_con = sqlite3.connect(index_path, timeout=600)
+    db_con.execute('''create table if not exists query_cache
+                      (
+                         key text primary key,
+                         size integer not null,
+                         last_access real not null,
+                         hit integer not null
+                      ) without rowid''')
+    db_con.execute('''create table if not exists load_epoch (id integer primary key check (id=0), epoch integer)''')
+    db_con.execute('''insert or ignore into load_epoch (id, epoch) values (0, 0)''')
+    db_con.commit()
+    g_query_cache_index_ready = True
+    return db_con
+
+
+def get_load_epoch():
+    """
+    Read the load epoch through a read-only connection. 0 if the cache has never been used.
+    """
+    index_path = path.join(g_query_cache_folder, 'index.db')
+    if not path.exists(index_path):
+        return 0
+    db_con = sqlite3.connect('file:%s?mode=ro' % index_path, uri=True, timeout=600)
+    try:
+        row = db_con.execute('''select epoch from load_epoch where id=0''').fetchone()
+        return 0 if row is None else int(row[0])
+    except sqlite3.OperationalError:
+        # The index is being created by another process.
+        return 0
+    finally:
+        db_con.close()
+
+
+def bump_load_epoch():
+    """
+    Bump the load epoch and clear all cache entries, which can never be hit again. Nothing is done if the cache has
+    never been used, since there is nothing to invalidate.
+    """
+    if not path.exists(path.join(g_query_cache_folder, 'index.db')):
+        return 0
+    db_con = connect_to_query_cache()
+    try:
+        with db_con:
+            db_con.execute('''update load_epoch set epoch=epoch+1 where id=0''')
+            l_key = [row[0] for row in db_con.execute('''select key from query_cache''').fetchall()]
+            db_con.execute('''delete from query_cache''')
+        epoch = int(db_con.execute('''select epoch from load_epoch where id=0''').fetchone()[0])
+    finally:
+        db_con.close()
+    for key in l_key:
+        entry_path = path.join(g_query_cache_folder, '%s.pickle' % key)
+        if path.exists(entry_path):
+            os.remove(entry_path)
+    logging.critical('[bump_load_epoch] Load epoch is %s. %s cache entries cleared.' % (epoch, len(l_key)))
+    return epoch
+
+
+def query_cache_key(namespace, query_str, query_param=None):
+    key_str = json.dumps([namespace, query_str, query_param, get_load_epoch()], sort_keys=True, default=str)
+    return hashlib.sha1(key_str.encode('utf-8')).hexdigest()
+
+
+def query_cache_get(key):
+    """
+    :return: (bool, object)
+        (True, result) on a hit, (False, None) on a miss.
+    """
+    db_con = connect_to_query_cache()
+    entry_path = path.join(g_query_cache_folder, '%s.pickle' % key)
+    try:
+        row = db_con.execute('''select size from query_cache where key=?''', (key,)).fetchone()
+        if row is None or not path.exists(entry_path):
+            query_cache_count('miss')
+            return False, None
+        ret = pd.read_pickle(entry_path)
+        with db_con:
+            db_con.execute('''update query_cache set last_access=?, hit=hit+1 where key=?''', (time.time(), key))
+    except Exception as e:
+        logging.error('[query_cache_get] %s' % e)
+        query_cache_count('miss')
+        return False, None
+    finally:
+        db_con.close()
+    query_cache_count('hit')
+    return True, ret
+
+
+def query_cache_put(key, ret):
+    if not path.exists(g_query_cache_folder):
+        os.makedirs(g_query_cache_folder, exist_ok=True)
+    entry_path = path.join(g_query_cache_folder, '%s.pickle' % key)
+    tmp_path = '%s.%s.tmp' % (entry_path, os.getpid())
+    try:
+        pd.to_pickle(ret, tmp_path)
+        os.replace(tmp_path, entry_path)
+    except Exception as e:
+        # E.g. results holding unpicklable driver objects.
+        logging.error('[query_cache_put] Not cached: %s' % e)
+        if path.exists(tmp_path):
+            os.remove(tmp_path)
+        query_cache_count('skip')
+        return False
+
+    db_con = connect_to_query_cache()
+    try:
+        with db_con:
+            db_con.execute('''insert or replace into query_cache (key, size, last_access, hit) values (?,?,?,0)''',
+                           (key, path.getsize(entry_path), time.time()))
+        query_cache_count('put')
+        query_cache_evict(db_con)
+    finally:
+        db_con.close()
+    return True
+
+
+def query_cache_evict(db_con, max_bytes=None):
+    """
+    Evict the least recently used entries until the cache fits in 'max_bytes'.
+    """
+    if max_bytes is None:
+        max_bytes = g_query_cache_max_bytes
+    total_bytes = db_con.execute('''select coalesce(sum(size), 0) from query_cache''').fetchone()[0]
+    while total_bytes > max_bytes:
+        rows = db_con.execute('''select key, size from query_cache order by last_access limit 100''').fetchall()
+        if len(rows) <= 0:
+            break
+        for key, size in rows:
+            if total_bytes <= max_bytes:
+                break
+            with db_con:
+                db_con.execute('''delete from query_cache where key=?''', (key,))
+            entry_path = path.join(g_query_cache_folder, '%s.pickle' % key)
+            if path.exists(entry_path):
+                os.remove(entry_path)
+            total_bytes -= size
+            query_cache_count('evict')
+
+
+def is_cacheable_neo4j_query(query_str):
+    return g_neo4j_write_clause_re.search(query_str) is None and ('`%s' % g_cohort_label_prefix) not in query_str
+
+
+def sqlite_fetchall_cached(db_cur, sql_str, l_param=None, cache_param=None):
+    """
+    'db_cur.execute(sql_str, l_param).fetchall()' through the query result cache.
+    :param
+        cache_param:
+            Extra inputs of the query that are not in 'sql_str' or 'l_param', e.g. the PIDs in a temp table.
+    """
+    if l_param is None:
+        l_param = []
+    if not g_query_cache_enabled:
+        return db_cur.execute(sql_str, l_param).fetchall()
+    key = query_cache_key('sqlite', sql_str, [l_param, cache_param])
+    hit, rows = query_cache_get(key)
+    if hit:
+        return rows
+    rows = db_cur.execute(sql_str, l_param).fetchall()
+    query_cache_put(key, rows)
+    return rows
+
+
+def query_cache_report():
+    """
+    :return: dict
+        Hit/miss counters of this process, plus the number of entries, their total bytes and hits across runs.
+    """
+    db_con = connect_to_query_cache()
+    try:
+        num_entry, num_byte, num_hit = db_con.execute('''select count(*), coalesce(sum(size), 0), 
+                                                         coalesce(sum(hit), 0) from query_cache''').fetchone()
+    finally:
+        db_con.close()
+    d_report = query_cache_stats()
+    num_lookup = d_report['hit'] + d_report['miss']
+    d_report.update({'hit_rate': d_report['hit'] / num_lookup if num_lookup > 0 else None,
+                     'num_entry': num_entry, 'num_byte': num_byte, 'num_hit_all_runs': num_hit,
+                     'load_epoch': get_load_epoch()})
+    logging.critical('[query_cache_report] %s' % d_report)
+    return d_report
+
+
+################################################################################
+#   QUERY INSTRUMENTATION
+################################################################################
+# When enabled, every query through 'execute_neo4j_queries', 'stream_neo4j_query' and SQLite connections opened by
+# 'connect_to_sqlite' is recorded with:
+#   store:          'neo4j' or 'sqlite'.
+#   cmd:            The command of the pipeline running the query.
+#   template:       The query text with literals replaced by '?', so that the same query over different ticks, states
+#                   or PID lists falls into one template.
+#   secs:           Latency. For SQLite, fetching the rows is included.
+#   rows:           Rows returned. For 'executemany', rows written.
+#   row_bytes, param_bytes: Pickled sizes of the rows returned and the parameters sent, if 'g_instrument_bytes'.
+#   cache_hit:      True if served by the query result cache.
+#   db_hits, d_op_db_hits: Total DB hits and DB hits per operator from the PROFILE plan, if 'g_instrument_profile'.
+# 'write_instrument_report' aggregates records by (store, cmd, template) into latency histograms and totals, and writes
+# them as JSON and CSV.
+g_instrument_enabled = False
+g_instrument_profile = False
+g_instrument_bytes = True
+g_instrument_latency_bucket = [0.001, 0.01, 0.1, 1.0, 10.0, 100.0]
+g_instrument_records = []
+g_instrument_lock = threading.Lock()
+# Each command run by 'run_pipeline' registers itself by thread ident, and so does each of its helper threads (see
+# 'run_with_instrument_cmd'). 'cmd' is only the default for threads that do neither.
+g_instrument_context = {'cmd': None}
+g_neo4j_unprofilable_re = re.compile(r'^\s*(profile|explain|show|create\s+(btree\s+)?(index|constraint)|'
+                                     r'drop\s+(index|constraint))\b', re.IGNORECASE)
+
+
+def query_template(query_str):
+    template = re.sub(r'\s+', ' ', str(query_str)).strip()
+    template = re.sub(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"", '?', template)
+    template = re.sub(r'(?<![\w`])-?\d+(\.\d+)?\b', '?', template)
+    template = re.sub(r'\(\s*\?(\s*,\s*\?)*\s*\)', '(?)', template)
+    template = re.sub(r'\[\s*\?(\s*,\s*\?)*\s*\]', '[?]', template)
+    return template
+
+
+def payload_bytes(payload):
+    if not g_instrument_bytes or payload is None:
+        return 0
+    try:
+        return len(pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 0
+
+
+def instrument_cmd():
+    """
+    :return: The command that the calling thread runs for.
+    """
+    return g_instrument_context.get(threading.get_ident(), g_instrument_context['cmd'])
+
+
+def run_with_instrument_cmd(cmd, target, *args):
+    """
+    Run 'target(*args)' with the metrics it records attributed to 'cmd'. A thread does not inherit the command of the
+    thread that starts it, so helper threads of a command are started with this and 'instrument_cmd()'.
+    """
+    g_instrument_context[threading.get_ident()] = cmd
+    try:
+        return target(*args)
+    finally:
+        g_instrument_context.pop(threading.get_ident(), None)
+
+
+def record_query_metric(store, query_str, secs, rows=0, row_bytes=0, param_bytes=0, cache_hit=False, d_profile=None):
+    """
+    Append a record to 'g_instrument_records'. The record is returned so that the caller may update it in place,
+    e.g. as rows are fetched.
+    """
+    cmd = instrument_cmd()
+    d_rec = {'store': store, 'cmd': cmd, 'template': query_template(query_str),
+             'ts': time.time(), 'secs': secs, 'rows': rows, 'row_bytes': row_bytes, 'param_bytes': param_bytes,
+             'cache_hit': cache_hit, 'db_hits': None, 'd_op_db_hits': None}
+    if d_profile is not None:
+        d_op_db_hits = flatten_neo4j_profile(d_profile)
+        d_rec['d_op_db_hits'] = d_op_db_hits
+        d_rec['db_hits'] = sum(d_op_db_hits.values())
+    with g_instrument_lock:
+        g_instrument_records.append(d_rec)
+    return d_rec
+
+
+def flatten_neo4j_profile(d_profile, d_op_db_hits=None):
+    """
+    Sum DB hits per operator type over a PROFILE plan tree.
+    """
+    if d_op_db_hits is None:
+        d_op_db_hits = dict()
+    op = d_profile.get('operatorType', 'unknown')
+    d_op_db_hits[op] = d_op_db_hits.get(op, 0) + int(d_profile.get('dbHits', 0))
+    for d_child in d_profile.get('children', []):
+        flatten_neo4j_profile(d_child, d_op_db_hits)
+    return d_op_db_hits
+
+
+class InstrumentedSqliteCursor(sqlite3.Cursor):
+    """
+    Records each statement when it is executed and adds fetch time, rows and bytes to its record as rows are fetched.
+    """
+    def execute(self, sql, parameters=()):
+        timer_start = time.time()
+        ret = super().execute(sql, parameters)
+        self.d_rec = record_query_metric('sqlite', sql, time.time() - timer_start,
+                                         param_bytes=payload_bytes(list(parameters)))
+        return ret
+
+    def executemany(self, sql, seq_of_parameters):
+        l_param = list(seq_of_parameters)
+        timer_start = time.time()
+        ret = super().executemany(sql, l_param)
+        self.d_rec = record_query_metric('sqlite', sql, time.time() - timer_start, rows=len(l_param),
+                                         param_bytes=payload_bytes(l_param))
+        return ret
+
+    def fetch_with_metric(self, fetch_fn, *args):
+        timer_start = time.time()
+        ret = fetch_fn(*args)
+        d_rec = getattr(self, 'd_rec', None)
+        if d_rec is not None:
+            d_rec['secs'] += time.time() - timer_start
+            l_row = ret if isinstance(ret, list) else ([] if ret is None else [ret])
+            d_rec['rows'] += len(l_row)
+            d_rec['row_bytes'] += payload_bytes(l_row)
+        return ret
+
+    def fetchone(self):
+        return self.fetch_with_metric(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self.fetch_with_metric(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self.fetch_with_metric(super().fetchall)
+
+
+class InstrumentedSqliteConnection(sqlite3.Connection):
+    def cursor(self, factory=InstrumentedSqliteCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+def connect_to_sqlite(db_path, **kwargs):
+    """
+    'sqlite3.connect' that is instrumented if 'g_instrument_enabled'.
+    """
+    if g_instrument_enabled:
+        return sqlite3.connect(db_path, factory=InstrumentedSqliteConnection, **kwargs)
+    return sqlite3.connect(db_path, **kwargs)
+
+
+def instrument_report():
+    """
+    Aggregate 'g_instrument_records' by (store, cmd, template).
+    :return: pandas DataFrame
+        Columns: store, cmd, template, count, cache_hits, total_secs, mean_secs, p50_secs, p95_secs, max_secs, rows,
+                 row_bytes, param_bytes, db_hits, d_op_db_hits, and 'hist_le_<bucket>' (plus 'hist_gt_<last bucket>')
+                 counting latencies per bucket.
+    """
+    with g_instrument_lock:
+        l_rec = list(g_instrument_records)
+    l_bin = [0.0] + g_instrument_latency_bucket + [np.inf]
+    l_hist_col = ['hist_le_%s' % bucket for bucket in g_instrument_latency_bucket] \
+        + ['hist_gt_%s' % g_instrument_latency_bucket[-1]]
+    l_agg = []
+    df_rec = pd.DataFrame(l_rec, columns=['store', 'cmd', 'template', 'ts', 'secs', 'rows', 'row_bytes',
+                                          'param_bytes', 'cache_hit', 'db_hits', 'd_op_db_hits'])
+    for (store, cmd, template), df_grp in df_rec.groupby(['store', 'cmd', 'template'], dropna=False, sort=False):
+        np_secs = df_grp['secs'].to_numpy(dtype=np.float64)
+        d_op_db_hits = dict()
+        for d_op in df_grp['d_op_db_hits']:
+            if d_op is not None:
+                for op, db_hits in d_op.items():
+                    d_op_db_hits[op] = d_op_db_hits.get(op, 0) + db_hits
+        d_agg = {'store': store, 'cmd': cmd, 'template': template, 'count': len(df_grp),
+                 'cache_hits': int(df_grp['cache_hit'].sum()), 'total_secs': float(np_secs.sum()),
+                 'mean_secs': float(np_secs.mean()), 'p50_secs': float(np.percentile(np_secs, 50)),
+                 'p95_secs': float(np.percentile(np_secs, 95)), 'max_secs': float(np_secs.max()),
+                 'rows': int(df_grp['rows'].sum()), 'row_bytes': int(df_grp['row_bytes'].sum()),
+                 'param_bytes': int(df_grp['param_bytes'].sum()),
+                 'db_hits': int(df_grp['db_hits'].dropna().sum()) if df_grp['db_hits'].notna().any() else None,
+                 'd_op_db_hits': d_op_db_hits if len(d_op_db_hits) > 0 else None}
+        d_agg.update(zip(l_hist_col, np.histogram(np_secs, bins=l_bin)[0].tolist()))
+        l_agg.append(d_agg)
+    df_agg = pd.DataFrame(l_agg)
+    if len(df_agg) > 0:
+        df_agg = df_agg.sort_values('total_secs', ascending=False).reset_index(drop=True)
+    return df_agg
+
+
+def write_instrument_report(out_folder=None, run_name=None):
+    """
+    Write the aggregated report to 'instrument_<run_name>.json' and 'instrument_<run_name>.csv' in 'out_folder'.
+    """
+    if out_folder is None:
+        out_folder = g_instrument_report_folder
+    if run_name is None:
+        run_name = time.strftime('%Y%m%d%H%M%S') + '_%s' % os.getpid()
+    if not path.exists(out_folder):
+        os.makedirs(out_folder)
+    df_agg = instrument_report()
+    with open(path.join(out_folder, 'instrument_%s.json' % run_name), 'w+') as out_fd:
+        json.dump({'run_name': run_name, 'num_query': len(g_instrument_records),
+                   'latency_bucket': g_instrument_latency_bucket,
+                   'templates': df_agg.to_dict(orient='records')}, out_fd, indent=4, default=str)
+    df_agg.drop(columns=['d_op_db_hits'], errors='ignore').to_csv(path.join(out_folder, 'instrument_%s.csv'
+                                                                            % run_name), index=False)
+    logging.critical('[write_instrument_report] %s queries over %s templates written to %s.'
+                     % (len(g_instrument_records), len(df_agg), out_folder))
+    return df_agg
 
 
 ################################################################################
@@ -199,7 +721,7 @@ def connect_to_neo4j_driver(uri, auth, kwargs):
         return None
 
     try:
-        driver = GraphDatabase.driver(uri=uri, auth=auth, **kwargs)
+        driver = neo4j.GraphDatabase.driver(uri=uri, auth=auth, **kwargs)
     except Exception as e:
         logging.error('[connect_to_neo4j_driver] Failed to connect to Neo4j driver: %s' % e)
         return None
@@ -270,6 +792,19 @@ def execute_neo4j_queries(neo4j_driver, neo4j_session_config, l_query_str, l_que
     if l_query_param is not None and len(l_query_str) != len(l_query_param):
         raise Exception('[execute_neo4j_query] l_query_param does not match l_query_str.')
 
+    cache_key = None
+    if g_query_cache_enabled and need_ret:
+        if all(is_cacheable_neo4j_query(query_str) for query_str in l_query_str):
+            cache_key = query_cache_key('neo4j', l_query_str, [l_query_param, neo4j_session_config])
+            hit, l_ret = query_cache_get(cache_key)
+            if hit:
+                if g_instrument_enabled:
+                    for query_id, query_str in enumerate(l_query_str):
+                        record_query_metric('neo4j', query_str, 0.0, rows=len(l_ret[query_id]), cache_hit=True)
+                return l_ret
+        else:
+            query_cache_count('skip')
+
     neo4j_session = get_neo4j_session(neo4j_driver, session_config=neo4j_session_config)
 
     # timer_start = time.time()
@@ -281,12 +816,24 @@ def execute_neo4j_queries(neo4j_driver, neo4j_session_config, l_query_str, l_que
                 query_param = None
                 if l_query_param is not None:
                     query_param = l_query_param[query_id]
-                results = neo4j_tx.run(query_str, query_param)
+                profile = g_instrument_enabled and g_instrument_profile \
+                    and g_neo4j_unprofilable_re.match(query_str) is None
+                timer_query = time.time()
+                results = neo4j_tx.run('PROFILE ' + query_str if profile else query_str, query_param)
+                l_values = None
                 if need_ret:
                     # !!!CAUTION!!!
                     # Here we need to use 'values()' function to retain the results instead of 'data()'
                     # because 'data()' may miss some data in the results!
-                    l_ret.append(results.values())
+                    l_values = results.values()
+                    l_ret.append(l_values)
+                if g_instrument_enabled:
+                    # Consuming makes sure the query has completed on the server.
+                    summary = results.consume()
+                    record_query_metric('neo4j', query_str, time.time() - timer_query,
+                                        rows=0 if l_values is None else len(l_values),
+                                        row_bytes=payload_bytes(l_values), param_bytes=payload_bytes(query_param),
+                                        d_profile=summary.profile if profile else None)
             neo4j_tx.commit()
         neo4j_session.close()
     except Exception as e:
@@ -295,6 +842,8 @@ def execute_neo4j_queries(neo4j_driver, neo4j_session_config, l_query_str, l_que
 
     # logging.critical('[execute_neo4j_query] All done in %s secs.' % str(time.time() - timer_start))
     if need_ret:
+        if cache_key is not None:
+            query_cache_put(cache_key, l_ret)
         return l_ret
     else:
         return None
@@ -423,8 +972,9 @@ def create_nodes_for_init_cn(neo4j_driver, batch_size, method='apoc', task_carri
             else:
                 task_data = l_person_trait[i:]
             task_id = 'Task ' + str(task_num_id)
-            task_instance = task_carrier(target=create_nodes_for_init_cn_by_create_method_single_task,
-                                         args=(task_id, neo4j_driver, neo4j_session_config, task_data, batch_size),
+            task_instance = task_carrier(target=run_with_instrument_cmd,
+                                         args=(instrument_cmd(), create_nodes_for_init_cn_by_create_method_single_task,
+                                               task_id, neo4j_driver, neo4j_session_config, task_data, batch_size),
                                          name=task_id)
             task_instance.start()
             l_task_instance.append(task_instance)
@@ -437,6 +987,7 @@ def create_nodes_for_init_cn(neo4j_driver, batch_size, method='apoc', task_carri
                 else:
                     l_task_instance.remove(task_instance)
         logging.critical('[create_nodes_for_init_cn] All done in %s secs.' % str(time.time() - timer_start))
+    bump_load_epoch()
 
 
 def create_edges(edge_file, occur, neo4j_driver, batch_size, method='apoc', task_carrier_type='thread'):
@@ -475,6 +1026,7 @@ def create_edges(edge_file, occur, neo4j_driver, batch_size, method='apoc', task
     elif method == 'create':
         pass
 
+    bump_load_epoch()
     logging.critical('[create_edges] All done in %s secs.' % str(time.time() - timer_start))
 
 
@@ -585,32 +1137,121 @@ def create_init_cn(neo4j_driver, init_cn_batch_size=100000):
     logging.critical('[create_init_cn] All done. Running time: %s ' % str(time.time() - timer_start_init))
 
 
-def create_int_cn_edges_auto_search(neo4j_driver, search_folder, l_time_points, batch_size=1000000, method='apoc'):
+def search_int_cn_files(search_folder, l_time_points=None):
     """
-    Automatically search for intermediate contact network files and load into DB.
+    Search for intermediate contact network files matching 'g_int_cn_file_fmt'.
     :param
         l_time_points: list of int
-            The list of time points in consideration. Considered intermediate contact networks will be loaded in.
+            If given, only files of these time points are returned.
+    :return: list of (int, str, str)
+        (time point, folder, file name), sorted by time point.
     """
-    logging.critical('[create_int_cn_edges_auto_search] Starts.')
-    timer_start = time.time()
-
-    # SEARCH FOR INT CN AND LOAD IN
+    l_int_cn_file = []
     for (dirpath, dirname, filenames) in walk(search_folder):
         for filename in filenames:
             if re.match(g_int_cn_file_fmt, filename) is None:
                 continue
             l_num_str = re.findall(r'[0-9]+', filename)
             if len(l_num_str) != 1:
-                logging.error('[create_int_cn_edges_auto_search] Confusing file occurs: %s' % filename)
+                logging.error('[search_int_cn_files] Confusing file occurs: %s' % filename)
                 continue
             time_point = int(l_num_str[0])
-            if int(l_num_str[0]) not in l_time_points:
+            if l_time_points is not None and time_point not in l_time_points:
                 continue
-            logging.critical('[create_int_cn_edges_auto_search] Loading edges for time point %s starts.' % (time_point))
-            create_edges(path.join(g_int_cn_folder, filename), time_point, neo4j_driver, batch_size, method)
-            logging.critical('[create_int_cn_edges_auto_search] Loading edges for time point %s done in %s secs.'
-                             % (time_point, time.time() - timer_start))
+            l_int_cn_file.append((time_point, dirpath, filename))
+    return sorted(l_int_cn_file)
+
+
+g_cn_chunk_size = 1000000
+
+
+def read_cn_file_chunks(cn_file_path, chunk_size=None):
+    """
+    Stream a contact network file as chunks of columns, skipping its header line. Contact network files are only read
+    through here, so that no reader holds a whole file as Python objects.
+    :return: generator of dict
+        'trg_pid', 'src_pid', 'duration': (int64) arrays.
+        'trg_act', 'src_act': (object) arrays of str.
+        Each chunk holds at most 'chunk_size' edges.
+    """
+    if chunk_size is None:
+        chunk_size = g_cn_chunk_size
+    try:
+        chunk_reader = pd.read_csv(cn_file_path, header=None, skiprows=1, usecols=[0, 1, 2, 3, 4],
+                                   dtype={0: np.int64, 1: str, 2: np.int64, 3: str, 4: np.int64},
+                                   chunksize=chunk_size)
+    except pd.errors.EmptyDataError:
+        return
+    with chunk_reader:
+        for df_chunk in chunk_reader:
+            yield {'trg_pid': df_chunk[0].values, 'trg_act': df_chunk[1].values, 'src_pid': df_chunk[2].values,
+                   'src_act': df_chunk[3].values, 'duration': df_chunk[4].values}
+
+
+def encode_cn_acts(d_act_code, np_act):
+    """
+    Codes of activities by 'd_act_code', which is extended by new activities in place.
+    """
+    l_val, np_inv = np.unique(np_act, return_inverse=True)
+    np_code = np.asarray([d_act_code.setdefault(val, len(d_act_code)) for val in l_val], dtype=np.int64)
+    return np_code[np_inv]
+
+
+def run_cn_file_consumers(cn_file_path, l_consumer):
+    """
+    Feed each chunk of a contact network file to every consumer, in one pass over the file.
+    :param
+        l_consumer: list of (function, function)
+            (add_chunk, finish) of each consumer. 'add_chunk' takes a chunk of 'read_cn_file_chunks', and 'finish'
+            returns the result of the consumer after the last chunk.
+    :return: list
+        Results of 'finish' in the order of 'l_consumer'.
+    """
+    for d_chunk in read_cn_file_chunks(cn_file_path):
+        for add_chunk, _ in l_consumer:
+            add_chunk(d_chunk)
+    return [finish() for _, finish in l_consumer]
+
+
+def process_loaded_tick(tick, cn_file_path):
+    """
+    Right after the edges of 'tick' are loaded, materialize whatever is enabled by 'g_materialize_tick_degrees',
+    'g_build_sketches' and 'g_maintain_stats_catalog' in one pass over its contact network file.
+    Return True if successes, False otherwise.
+    """
+    l_consumer = []
+    if g_materialize_tick_degrees:
+        l_consumer.append(tick_degrees_consumer(tick))
+    if g_build_sketches:
+        l_consumer.append(tick_sketches_consumer(tick))
+    if g_maintain_stats_catalog:
+        l_consumer.append(stats_catalog_tick_consumer(tick))
+    if len(l_consumer) <= 0:
+        return True
+    timer_start = time.time()
+    ret = all(run_cn_file_consumers(cn_file_path, l_consumer))
+    logging.critical('[process_loaded_tick] Tick %s: %s consumers done in %s secs.'
+                     % (tick, len(l_consumer), time.time() - timer_start))
+    return ret
+
+
+def create_int_cn_edges_auto_search(neo4j_driver, search_folder, l_time_points, batch_size=1000000, method='apoc'):
+    """
+    Automatically search for intermediate contact network files and load into DB.
+    :param
+        l_time_points: list of int
+            The list of time points in consideration. Considered intermediate contact networks will be loaded in.
+    """
+    logging.critical('[create_int_cn_edges_auto_search] Starts.')
+    timer_start = time.time()
+
+    # SEARCH FOR INT CN AND LOAD IN
+    for time_point, dirpath, filename in search_int_cn_files(search_folder, l_time_points):
+        logging.critical('[create_int_cn_edges_auto_search] Loading edges for time point %s starts.' % (time_point))
+        create_edges(path.join(g_int_cn_folder, filename), time_point, neo4j_driver, batch_size, method)
+        process_loaded_tick(time_point, path.join(dirpath, filename))
+        logging.critical('[create_int_cn_edges_auto_search] Loading edges for time point %s done in %s secs.'
+                         % (time_point, time.time() - timer_start))
 
     logging.critical('[create_int_cn_edges_auto_search] All done in %s secs.' % str(time.time() - timer_start))
 
@@ -702,30 +1343,54 @@ def create_int_cn_edges_auto_search(neo4j_driver, search_folder, l_time_points,
 ################################################################################
 #   EPIHIPER OUTPUT PROCESSING
 ################################################################################
-def create_epihiper_output_db():
+def create_epihiper_output_db(layout=None):
     """
     Return True if successes, False otherwise.
+    :param
+        layout: str
+            See 'g_epihiper_output_db_layout'. If None, 'g_epihiper_output_db_layout' is used.
     """
     logging.critical('[create_epihiper_output_db] Starts.')
 
+    if layout is None:
+        layout = g_epihiper_output_db_layout
+
     try:
-        db_con = sqlite3.connect(g_epihiper_output_db_path)
+        db_con = connect_to_sqlite(g_epihiper_output_db_path)
     except Exception as e:
         logging.error('[create_epihiper_output_db] %s' % e)
         return False
     logging.critical('[create_epihiper_output_db] Database created.')
 
     if db_con is not None:
-        sql_str = '''create table if not exists %s
-                     (
-                        out_id integer primary key,
-                        tick integer not null,
-                        pid integer not null,
-                        exit_state text,
-                        contact_pid integer, 
-                        lid text
-                     )
-                  ''' % g_epihiper_output_tb_name
+        if layout == 'rowid':
+            sql_str = '''create table if not exists %s
+                         (
+                            out_id integer primary key,
+                            tick integer not null,
+                            pid integer not null,
+                            exit_state text,
+                            contact_pid integer, 
+                            lid text
+                         )
+                      ''' % g_epihiper_output_tb_name
+        elif layout == 'tick_clustered':
+            # 'out_id' is kept in the key only to make it unique in case a person enters the same state more than
+            # once in the same tick.
+            sql_str = '''create table if not exists %s
+                         (
+                            out_id integer not null,
+                            tick integer not null,
+                            pid integer not null,
+                            exit_state text not null,
+                            contact_pid integer, 
+                            lid text,
+                            primary key (tick, exit_state, pid, out_id)
+                         ) without rowid
+                      ''' % g_epihiper_output_tb_name
+        else:
+            db_con.close()
+            raise Exception('[create_epihiper_output_db] layout can only be "rowid" or "tick_clustered"!')
         try:
             db_cur = db_con.cursor()
             db_cur.execute(sql_str)
@@ -734,26 +1399,35 @@ def create_epihiper_output_db():
             return False
         finally:
             db_con.close()
-        logging.critical('[create_epihiper_output_db] Table created.')
+        logging.critical('[create_epihiper_output_db] Table created with layout %s.' % layout)
 
     logging.critical('[create_epihiper_output_db] All done.')
     return True
 
 
-def load_epihiper_output_to_db(batch_size=10000):
+def load_epihiper_output_to_db(batch_size=10000, layout=None):
     """
     Return True if successes, False otherwise.
+    :param
+        layout: str
+            See 'g_epihiper_output_db_layout'. If None, 'g_epihiper_output_db_layout' is used.
+            With 'tick_clustered', records are buffered per tick and written sorted by (exit_state, pid), so the
+            B-tree of the table is filled in its key order. EpiHiper writes its output tick by tick, so only one tick
+            is buffered at a time.
     TODO
         It may look neater refactoring the DB connection and closure to 'with' statement.
     """
     logging.critical('[load_epihiper_output_to_db] Starts.')
     timer_start = time.time()
 
+    if layout is None:
+        layout = g_epihiper_output_db_layout
+
     if not path.exists(g_epihiper_output_path):
         raise Exception('[load_epihiper_output_to_db] %s does not exist.' % g_epihiper_output_path)
 
     try:
-        db_con = sqlite3.connect(g_epihiper_output_db_path)
+        db_con = connect_to_sqlite(g_epihiper_output_db_path)
         db_cur = db_con.cursor()
     except Exception as e:
         logging.error('[load_epihiper_output_to_db] %s' % e)
@@ -762,6 +1436,20 @@ def load_epihiper_output_to_db(batch_size=10000):
     sql_str = '''insert into %s (out_id, tick, pid, exit_state, contact_pid, lid) values (?,?,?,?,?,?)''' \
               % g_epihiper_output_tb_name
 
+    if layout == 'tick_clustered':
+        err = not load_epihiper_output_to_db_tick_clustered(db_con, db_cur, sql_str, batch_size, timer_start)
+        db_con.close()
+        bump_load_epoch()
+        if err:
+            logging.critical('[load_epihiper_output_to_db] Return with errors in %s secs.'
+                             % str(time.time() - timer_start))
+        else:
+            logging.critical('[load_epihiper_output_to_db] All done in %s secs.' % str(time.time() - timer_start))
+        return not err
+    elif layout != 'rowid':
+        db_con.close()
+        raise Exception('[load_epihiper_output_to_db] layout can only be "rowid" or "tick_clustered"!')
+
     err = False
     out_id = 0
     with open(g_epihiper_output_path, 'r') as in_fd:
@@ -798,6 +1486,7 @@ def load_epihiper_output_to_db(batch_size=10000):
             err = True
 
     db_con.close()
+    bump_load_epoch()
 
     if err:
         logging.critical('[load_epihiper_output_to_db] Return with errors in %s secs.' % str(time.time() - timer_start))
@@ -806,6 +1495,61 @@ def load_epihiper_output_to_db(batch_size=10000):
     return not err
 
 
+def load_epihiper_output_to_db_tick_clustered(db_con, db_cur, sql_str, batch_size, timer_start):
+    """
+    Load EpiHiper output into a 'tick_clustered' table. Records of each tick are sorted by (exit_state, pid) before
+    being inserted, and each tick is committed in chunks of 'batch_size'.
+    NOTE:
+        If the output file is not ordered by tick, a tick may be flushed more than once. The result is still correct,
+        only the pages of that tick are less contiguous.
+    Return True if successes, False otherwise.
+    """
+    err = False
+    out_id = 0
+    cur_tick = None
+    l_tick_rec = []
+
+    def flush_tick():
+        nonlocal err
+        l_tick_rec.sort(key=lambda rec: (rec[3], rec[2], rec[0]))
+        for i in range(0, len(l_tick_rec), batch_size):
+            try:
+                db_cur.executemany(sql_str, l_tick_rec[i: i + batch_size])
+                db_con.commit()
+            except Exception as e:
+                logging.error('[load_epihiper_output_to_db_tick_clustered] tick: %s, error: %s' % (cur_tick, e))
+                err = True
+        logging.critical('[load_epihiper_output_to_db_tick_clustered] Committed %s recs for tick %s in %s secs.'
+                         % (len(l_tick_rec), cur_tick, time.time() - timer_start))
+        l_tick_rec.clear()
+
+    with open(g_epihiper_output_path, 'r') as in_fd:
+        csv_reader = csv.reader(in_fd, delimiter=',')
+        for row_idx, row in enumerate(csv_reader):
+            if row_idx == 0:
+                continue
+            tick = int(row[0])
+            pid = int(row[1])
+            exit_state = row[2]
+            contact_pid = int(row[3])
+            if contact_pid == -1:
+                contact_pid = None
+            lid = int(row[4])
+            if lid == -1:
+                lid = None
+            if cur_tick is not None and tick != cur_tick:
+                flush_tick()
+            cur_tick = tick
+            l_tick_rec.append((out_id, tick, pid, exit_state, contact_pid, lid))
+            out_id += 1
+        if len(l_tick_rec) > 0:
+            flush_tick()
+
+    logging.critical('[load_epihiper_output_to_db_tick_clustered] Loaded %s recs in %s secs.'
+                     % (out_id, time.time() - timer_start))
+    return not err
+
+
 def create_indexes_on_epihipter_output_db():
     """
     Return True if successes, False otherwise.
@@ -814,7 +1558,7 @@ def create_indexes_on_epihipter_output_db():
     timer_start = time.time()
 
     try:
-        db_con = sqlite3.connect(g_epihiper_output_db_path)
+        db_con = connect_to_sqlite(g_epihiper_output_db_path)
         db_cur = db_con.cursor()
     except Exception as e:
         logging.error(e)
@@ -834,7 +1578,9 @@ def create_indexes_on_epihipter_output_db():
     sql_str_2 = '''create index if not exists idx_pid on %s (pid)''' % g_epihiper_output_tb_name
 
     try:
-        db_cur.execute(sql_str_1)
+        # With 'tick_clustered', the primary key already leads with 'tick', and 'idx_tick' would be redundant.
+        if g_epihiper_output_db_layout != 'tick_clustered':
+            db_cur.execute(sql_str_1)
         db_cur.execute(sql_str_2)
     except Exception as e:
         logging.error('[create_indexes_on_epihipter_output_db] Create indexes: %s' % e)
@@ -870,9 +1616,49 @@ def load_epihiper_output(ds_path):
     return df_output
 
 
-def fetch_pids_by_exit_state(exit_state, out_path):
+def load_pids_into_sqlite_temp_table(db_cur, l_pid, tmp_tb_name='tmp_pid'):
+    """
+    Bulk-insert a set of PIDs into an indexed temporary table on the given SQLite connection, so that a query stage
+    can semi-join against 'g_epihiper_output_tb_name' with
+        'where pid in (select pid from temp.<tmp_tb_name>)'
+    instead of building 'pid in (?,?,...)' with one placeholder per PID. The latter hits SQLite's variable limit on
+    real data and makes the statement parse as large as the PID set.
+    NOTE:
+        The temporary table only lives in the connection of 'db_cur', and is replaced if it already exists.
+        Duplicate PIDs are dropped.
+    :param
+        db_cur: sqlite3.Cursor
+    :param
+        l_pid: iterable of int
+    :param
+        tmp_tb_name: str
+    :return: str
+        The qualified name of the temporary table if succeeds. None, otherwise.
+    """
+    sql_str_drop = '''drop table if exists temp.%s''' % tmp_tb_name
+    sql_str_create = '''create temp table %s (pid integer primary key)''' % tmp_tb_name
+    sql_str_insert = '''insert or ignore into temp.%s (pid) values (?)''' % tmp_tb_name
+    try:
+        db_cur.execute(sql_str_drop)
+        db_cur.execute(sql_str_create)
+        db_cur.executemany(sql_str_insert, ((int(pid),) for pid in l_pid))
+    except Exception as e:
+        logging.error('[load_pids_into_sqlite_temp_table] %s' % e)
+        return None
+    return 'temp.%s' % tmp_tb_name
+
+
+def fetch_pids_by_exit_state(exit_state, out_path, d_col_store=None, d_pidset_store=None):
     """
     Return the list of PIDs over time for a given exit state.
+    :param
+        d_col_store: dict
+            If given, PIDs are sliced from the columnar store instead of queried from SQLite.
+            See 'load_epihiper_output_col_store'.
+    :param
+        d_pidset_store: dict
+            If given, PIDs are decoded from the PID set store. It takes precedence over 'd_col_store'.
+            See 'load_pidset_store'.
     :return: pandas DataFrame
         Index: tick (int)
         Column: pid (list of int)
@@ -880,8 +1666,28 @@ def fetch_pids_by_exit_state(exit_state, out_path):
     logging.critical('[fetch_pids_by_exit_state] Starts.')
     timer_start = time.time()
 
+    if d_pidset_store is not None:
+        df_pid_by_tick = pidset_store_pid_over_time(d_pidset_store, exit_state)
+        pd.to_pickle(df_pid_by_tick, out_path)
+        logging.critical('[fetch_pids_by_exit_state] All done from PID set store in %s secs.'
+                         % str(time.time() - timer_start))
+        return df_pid_by_tick
+
+    if d_col_store is not None:
+        np_tick, np_pid = col_store_select(d_col_store, exit_state=exit_state)
+        # Records are sorted by tick, so each tick is a contiguous slice.
+        np_tick_val, np_tick_start = np.unique(np_tick, return_index=True)
+        l_pid_split = np.split(np_pid, np_tick_start[1:])
+        l_rec = [(int(tick), pids.tolist()) for tick, pids in zip(np_tick_val, l_pid_split)]
+        df_pid_by_tick = pd.DataFrame(l_rec, columns=['tick', 'pid'])
+        df_pid_by_tick = df_pid_by_tick.set_index('tick')
+        pd.to_pickle(df_pid_by_tick, out_path)
+        logging.critical('[fetch_pids_by_exit_state] All done from columnar store in %s secs.'
+                         % str(time.time() - timer_start))
+        return df_pid_by_tick
+
     try:
-        db_con = sqlite3.connect(g_epihiper_output_db_path)
+        db_con = connect_to_sqlite(g_epihiper_output_db_path)
         db_cur = db_con.cursor()
     except Exception as e:
         logging.error(e)
@@ -890,8 +1696,7 @@ def fetch_pids_by_exit_state(exit_state, out_path):
     sql_str = '''select tick, pid from %s where exit_state="%s"''' \
               % (g_epihiper_output_tb_name, exit_state)
     try:
-        db_cur.execute(sql_str)
-        rows = db_cur.fetchall()
+        rows = sqlite_fetchall_cached(db_cur, sql_str)
     except Exception as e:
         logging.error('[fetch_pids_by_exit_state] %s' % e)
         return None
@@ -918,163 +1723,3087 @@ def fetch_pids_by_exit_state(exit_state, out_path):
 
 
 ################################################################################
-#   EXAMPLE QUERIES
+#   EPIHIPER OUTPUT COLUMNAR STORE
 ################################################################################
-def duration_distribution(neo4j_driver, df_output_pid_over_time, out_name_suffix, data_out_path, img_out_path,
-                          save_img=True, l_t=None, mode='in_1nn'):
+# The columnar store holds the EpiHiper output as one NumPy file per column, all sorted by tick:
+#   tick.npy:           (int32) Tick of each record.
+#   pid.npy:            (int64) PID of each record.
+#   exit_state.npy:     (int16) Code of the exit state of each record. Decoded by 'exit_state_dict.json'.
+#   contact_pid.npy:    (int64) Contact PID of each record. -1 means None.
+#   lid.npy:            (int64) LID of each record. -1 means None.
+#   tick_val.npy:       (int32) Sorted distinct ticks.
+#   tick_offset.npy:    (int64) Records of 'tick_val[i]' are in [tick_offset[i], tick_offset[i + 1]).
+#   exit_state_dict.json: The list of exit states. The code of an exit state is its position in this list.
+# Within each tick, records are sorted by (exit_state, pid).
+g_l_epihiper_output_col = ['tick', 'pid', 'exit_state', 'contact_pid', 'lid']
+
+
+def build_epihiper_output_col_store(out_folder=None):
     """
-    Get the duration distribution over a subgraph of contact network at time points specified by 'l_t'.
-    The subgraph is defined by 'mode'.
-    :param
-        df_output_pid_over_time: pandas DataFrame
-            Filtered PIDs over time. The subgraph is constructed starting from these PIDs.
-    :param
-        l_t: list of int
-            The given time points. '-1' means the initial contact graph.
-    :param
-        mode: str
-            'in_1nn': The subgraph is the 1-nearest-neighbor graph induced by incoming edges based on 'l_core_pids'.
-    :return: 2D ndarray
-        Dim 0: Durations sorted in the ascending order.
-        Dim 1: Counts of durations.
+    Build the columnar store from the EpiHiper output CSV file. See 'EPIHIPER OUTPUT COLUMNAR STORE'.
+    Return True if successes, False otherwise.
     """
-    logging.critical('[duration_distribution] Starts.')
+    logging.critical('[build_epihiper_output_col_store] Starts.')
     timer_start = time.time()
 
-    neo4j_session_config = {'database': g_neo4j_db_name}
-
-    if mode == 'in_1nn':
-        query_str = '''with $l_core_pid as l_core_pid, $tick as tick
-                       match (n:PERSON) where n.pid in l_core_pid
-                       match ()-[r:CONTACT]->(n) where r.occur = tick
-                       return r.duration as d
-                    '''
+    if out_folder is None:
+        out_folder = g_epihiper_output_col_folder
+    if not path.exists(g_epihiper_output_path):
+        raise Exception('[build_epihiper_output_col_store] %s does not exist.' % g_epihiper_output_path)
+    if not path.exists(out_folder):
+        os.makedirs(out_folder)
+
+    l_tick = []
+    l_pid = []
+    l_exit_state = []
+    l_contact_pid = []
+    l_lid = []
+    d_exit_state_code = dict()
+    with open(g_epihiper_output_path, 'r') as in_fd:
+        csv_reader = csv.reader(in_fd, delimiter=',')
+        for row_idx, row in enumerate(csv_reader):
+            if row_idx == 0:
+                continue
+            exit_state = row[2]
+            if exit_state not in d_exit_state_code:
+                d_exit_state_code[exit_state] = len(d_exit_state_code)
+            l_tick.append(int(row[0]))
+            l_pid.append(int(row[1]))
+            l_exit_state.append(d_exit_state_code[exit_state])
+            l_contact_pid.append(int(row[3]))
+            l_lid.append(int(row[4]))
+    logging.critical('[build_epihiper_output_col_store] Read %s recs in %s secs.'
+                     % (len(l_tick), time.time() - timer_start))
+
+    np_tick = np.asarray(l_tick, dtype=np.int32)
+    np_pid = np.asarray(l_pid, dtype=np.int64)
+    np_exit_state = np.asarray(l_exit_state, dtype=np.int16)
+    del l_tick, l_pid, l_exit_state
+    # 'np.lexsort' sorts by the last key first.
+    np_order = np.lexsort((np_pid, np_exit_state, np_tick))
+    d_col = {'tick': np_tick[np_order],
+             'pid': np_pid[np_order],
+             'exit_state': np_exit_state[np_order],
+             'contact_pid': np.asarray(l_contact_pid, dtype=np.int64)[np_order],
+             'lid': np.asarray(l_lid, dtype=np.int64)[np_order]}
+    del l_contact_pid, l_lid
+
+    np_tick_val, np_tick_start = np.unique(d_col['tick'], return_index=True)
+    np_tick_offset = np.append(np_tick_start, len(d_col['tick'])).astype(np.int64)
+
+    for col_name in g_l_epihiper_output_col:
+        np.save(path.join(out_folder, '%s.npy' % col_name), d_col[col_name])
+    np.save(path.join(out_folder, 'tick_val.npy'), np_tick_val.astype(np.int32))
+    np.save(path.join(out_folder, 'tick_offset.npy'), np_tick_offset)
+    l_exit_state_dict = sorted(d_exit_state_code, key=lambda state: d_exit_state_code[state])
+    with open(path.join(out_folder, 'exit_state_dict.json'), 'w+') as out_fd:
+        json.dump(l_exit_state_dict, out_fd)
+
+    logging.critical('[build_epihiper_output_col_store] All done with %s recs and %s ticks in %s secs.'
+                     % (len(d_col['tick']), len(np_tick_val), time.time() - timer_start))
+    return True
 
-    if l_t is None:
-        l_t = df_output_pid_over_time.index.to_list()
 
-    l_dist_rec = []
-    for tick, pid_rec in df_output_pid_over_time.loc[l_t].iterrows():
-        d_duration = dict()
-        l_core_pids = pid_rec['pid']
-        query_param = {'l_core_pid': l_core_pids, 'tick': tick}
-        l_ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [query_str], l_query_param=[query_param],
-                                      need_ret=True)
-        for rec in l_ret[0]:
-            duration = int(rec[0])
-            if duration not in d_duration:
-                d_duration[duration] = 1
-            else:
-                d_duration[duration] += 1
-        if len(d_duration) <= 0:
-            continue
-        l_dist_rec.append((tick, d_duration))
+def load_epihiper_output_col_store(col_folder=None):
+    """
+    Open the columnar store. Column files are memory-mapped, so only touched pages are read from disk.
+    :return: dict
+        Keys: the columns in 'g_l_epihiper_output_col', 'tick_val', 'tick_offset' (np.memmap),
+              'l_exit_state' (list of str), 'd_exit_state_code' (dict: str -> int).
+        None if the store does not exist.
+    """
+    if col_folder is None:
+        col_folder = g_epihiper_output_col_folder
+    if not path.exists(path.join(col_folder, 'exit_state_dict.json')):
+        logging.error('[load_epihiper_output_col_store] No columnar store in %s.' % col_folder)
+        return None
 
-    df_dist = pd.DataFrame(l_dist_rec, columns=['tick', 'duration_dist'])
-    df_dist = df_dist.set_index('tick')
-    pd.to_pickle(df_dist, data_out_path)
-    logging.critical('[duration_distribution] Output results.')
+    d_col_store = dict()
+    for col_name in g_l_epihiper_output_col + ['tick_val', 'tick_offset']:
+        d_col_store[col_name] = np.load(path.join(col_folder, '%s.npy' % col_name), mmap_mode='r')
+    with open(path.join(col_folder, 'exit_state_dict.json'), 'r') as in_fd:
+        l_exit_state = json.load(in_fd)
+    d_col_store['l_exit_state'] = l_exit_state
+    d_col_store['d_exit_state_code'] = {exit_state: code for code, exit_state in enumerate(l_exit_state)}
+    logging.critical('[load_epihiper_output_col_store] Opened %s recs over %s ticks.'
+                     % (len(d_col_store['tick']), len(d_col_store['tick_val'])))
+    return d_col_store
 
-    # PLOT
-    if save_img:
-        fig, axes = plt.subplots(ncols=1, nrows=1)
-        d_draw = dict()
-        for tick, dist_rec in df_dist.iterrows():
-            d_dist = dist_rec['duration_dist']
-            l_duration = []
-            for duration in d_dist:
-                l_duration += [duration] * d_dist[duration]
-            d_draw['t' + str(tick)] = l_duration
-        sns.histplot(d_draw, multiple='stack', legend=True, ax=axes)
-        axes.set_title('Duration Distribution Over Time With Exit State %s' % out_name_suffix, fontsize=12,
-                       fontweight='semibold')
-        axes.set_xlabel('Duration', fontweight='semibold')
-        axes.set_ylabel('Frequency', fontweight='semibold')
-        plt.tight_layout(pad=1.0)
-        plt.savefig(img_out_path, format='PNG')
-        plt.show()
-        plt.clf()
-        plt.close()
 
-    logging.critical('[duration_distribution] All done in %s secs.' % str(time.time() - timer_start))
+def col_store_tick_range(d_col_store, tick_start, tick_end):
+    """
+    Return the record range [start, end) covering ticks between 'tick_start' and 'tick_end' inclusively.
+    """
+    np_tick_val = d_col_store['tick_val']
+    np_tick_offset = d_col_store['tick_offset']
+    start = int(np_tick_offset[np.searchsorted(np_tick_val, tick_start, side='left')])
+    end = int(np_tick_offset[np.searchsorted(np_tick_val, tick_end, side='right')])
+    return start, end
 
 
-# Query 1
-# How many males between 18 and 24 years of age are newly infected
-# (i.e., are just transitioned to state I or its variants [this could be a set of states])
-# between times 5 and 15 inclusive? What are the PIDs of these males?
-#
-# Solution:
-#   (1) Query EpiHiper SQLite DB for all PIDs with 'exit_state="I..."' between times 5 and 15 inclusively.
-#   (2) Query Neo4j for 'n.pid' where 'n.age>=18 and n.age<=24' given the PIDs.
-#
-# Running Time:
-#   0.4s
-def query_1_sqlite_1(out_path):
+def col_store_exit_state_codes(d_col_store, exit_state=None, exit_state_prefix=None):
     """
-    Query for PIDs where 'exit_state' starts with 'I' and 'tick' between 5 and 15 inclusively.
+    Return the array of exit state codes that equal 'exit_state' or start with 'exit_state_prefix'.
     """
-    logging.critical('[query_1_sqlite_1] Starts.')
-    timer_start = time.time()
+    l_code = []
+    for code, each_exit_state in enumerate(d_col_store['l_exit_state']):
+        if exit_state is not None and each_exit_state == exit_state:
+            l_code.append(code)
+        elif exit_state_prefix is not None and each_exit_state.startswith(exit_state_prefix):
+            l_code.append(code)
+    return np.asarray(l_code, dtype=np.int16)
 
-    try:
-        db_con = sqlite3.connect(g_epihiper_output_db_path)
-        db_cur = db_con.cursor()
-    except Exception as e:
-        logging.error(e)
-        return None
 
-    sql_str = '''PRAGMA case_sensitive_like=true'''
-    try:
-        db_cur.execute(sql_str)
-    except Exception as e:
-        logging.error('[query_1_sqlite_1] %s' % e)
-        return None
+def col_store_select(d_col_store, tick_start=None, tick_end=None, exit_state=None, exit_state_prefix=None):
+    """
+    Select records by a tick window and/or an exit state. The tick window is resolved by 'tick_offset' without
+    scanning, and the exit state predicate is a vectorized comparison over the window only.
+    :return: (ndarray, ndarray)
+        The ticks and PIDs of the selected records.
+    """
+    if tick_start is None:
+        tick_start = int(d_col_store['tick_val'][0]) if len(d_col_store['tick_val']) > 0 else 0
+    if tick_end is None:
+        tick_end = int(d_col_store['tick_val'][-1]) if len(d_col_store['tick_val']) > 0 else -1
+    start, end = col_store_tick_range(d_col_store, tick_start, tick_end)
+    np_tick = d_col_store['tick'][start:end]
+    np_pid = d_col_store['pid'][start:end]
+    if exit_state is None and exit_state_prefix is None:
+        return np.asarray(np_tick), np.asarray(np_pid)
+    np_code = col_store_exit_state_codes(d_col_store, exit_state, exit_state_prefix)
+    np_mask = np.isin(d_col_store['exit_state'][start:end], np_code)
+    return np.asarray(np_tick[np_mask]), np.asarray(np_pid[np_mask])
+
+
+def col_store_pids_at_tick(d_col_store, tick):
+    """
+    Return the distinct PIDs of all records at 'tick'.
+    """
+    _, np_pid = col_store_select(d_col_store, tick, tick)
+    return np.unique(np_pid)
 
-    sql_str = '''select tick, pid from {0} where tick>=5 and tick<=15 and exit_state like "I%"'''\
-        .format(g_epihiper_output_tb_name)
-    try:
+
+################################################################################
+#   PID SET BITMAPS
+################################################################################
+# A PID set is stored as a compressed bitmap in the layout of Roaring bitmaps: PIDs are partitioned by their high bits
+# (PID >> 16), and the low 16 bits of each partition go into a container:
+#   - Array container:  (uint16) Sorted low bits. Used when the partition has at most 'g_pidset_array_max' PIDs.
+#   - Bitmap container: (uint8) 8192 bytes packed with bitorder='little', i.e. low bits k is bit (k & 7) of byte
+#                       (k >> 3). Used otherwise.
+# In memory, a PID set is a dict: high bits (int) -> container. Empty containers are never kept.
+# Serialized, a PID set is zlib-compressed bytes of:
+#   [num_container (int64)][high (int64) x n][kind (int8) x n, 0: array, 1: bitmap][size (int32) x n][containers]
+# The PID set store holds one serialized PID set per (tick, exit_state) of the EpiHiper output:
+#   <g_pidset_store_path>: npz. 'index' is the JSON list of [tick, exit_state], and 'k<i>' is the PID set of index i.
+g_pidset_array_max = 4096
+g_pidset_bitmap_bytes = 8192
+
+
+def pidset_from_pids(l_pid):
+    np_pid = np.unique(np.asarray(l_pid, dtype=np.int64))
+    np_high = np_pid >> 16
+    np_high_val, np_high_start = np.unique(np_high, return_index=True)
+    d_pidset = dict()
+    for high, np_pid_part in zip(np_high_val, np.split(np_pid, np_high_start[1:])):
+        np_low = (np_pid_part & 0xFFFF).astype(np.uint16)
+        if len(np_low) > g_pidset_array_max:
+            d_pidset[int(high)] = pidset_container_to_bitmap(np_low)
+        else:
+            d_pidset[int(high)] = np_low
+    return d_pidset
+
+
+def pidset_to_pids(d_pidset):
+    """
+    Return the sorted PIDs as an int64 array.
+    """
+    l_pid_part = [(np.int64(high) << 16) + pidset_container_to_array(d_pidset[high]).astype(np.int64)
+                  for high in sorted(d_pidset)]
+    if len(l_pid_part) <= 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(l_pid_part)
+
+
+def pidset_container_to_array(container):
+    if container.dtype == np.uint16:
+        return container
+    return np.nonzero(np.unpackbits(container, bitorder='little'))[0].astype(np.uint16)
+
+
+def pidset_container_to_bitmap(container):
+    if container.dtype == np.uint8:
+        return container
+    np_bit = np.zeros(g_pidset_bitmap_bytes * 8, dtype=bool)
+    np_bit[container] = True
+    return np.packbits(np_bit, bitorder='little')
+
+
+def pidset_container_cardinality(container):
+    if container.dtype == np.uint16:
+        return len(container)
+    return int(np.unpackbits(container).sum())
+
+
+def pidset_container_normalize(container):
+    """
+    Turn a bitmap container into an array container if it is small enough. Return None if it is empty.
+    """
+    card = pidset_container_cardinality(container)
+    if card <= 0:
+        return None
+    if container.dtype == np.uint8 and card <= g_pidset_array_max:
+        return pidset_container_to_array(container)
+    return container
+
+
+def pidset_container_contains(container, np_low):
+    """
+    Return the mask of 'np_low' (uint16) in 'container'.
+    """
+    if container.dtype == np.uint16:
+        return np.isin(np_low, container, assume_unique=True)
+    return ((container[np_low >> 3] >> (np_low & 7).astype(np.uint8)) & 1).astype(bool)
+
+
+def pidset_cardinality(d_pidset):
+    return sum(pidset_container_cardinality(container) for container in d_pidset.values())
+
+
+def pidset_union(*l_pidset):
+    d_union = dict()
+    for d_pidset in l_pidset:
+        for high, container in d_pidset.items():
+            if high not in d_union:
+                d_union[high] = container
+            elif d_union[high].dtype == np.uint16 and container.dtype == np.uint16 \
+                    and len(d_union[high]) + len(container) <= g_pidset_array_max:
+                d_union[high] = np.union1d(d_union[high], container).astype(np.uint16)
+            else:
+                d_union[high] = pidset_container_normalize(
+                    pidset_container_to_bitmap(d_union[high]) | pidset_container_to_bitmap(container))
+    return d_union
+
+
+def pidset_intersection(d_pidset_1, d_pidset_2):
+    d_inter = dict()
+    for high in d_pidset_1.keys() & d_pidset_2.keys():
+        container_1 = d_pidset_1[high]
+        container_2 = d_pidset_2[high]
+        if container_1.dtype == np.uint8 and container_2.dtype == np.uint8:
+            container = pidset_container_normalize(container_1 & container_2)
+        else:
+            if container_1.dtype == np.uint8:
+                container_1, container_2 = container_2, container_1
+            container = container_1[pidset_container_contains(container_2, container_1)]
+            container = container if len(container) > 0 else None
+        if container is not None:
+            d_inter[high] = container
+    return d_inter
+
+
+def pidset_difference(d_pidset_1, d_pidset_2):
+    """
+    PIDs in 'd_pidset_1' but not in 'd_pidset_2'.
+    """
+    d_diff = dict()
+    for high, container_1 in d_pidset_1.items():
+        if high not in d_pidset_2:
+            d_diff[high] = container_1
+            continue
+        container_2 = d_pidset_2[high]
+        if container_1.dtype == np.uint16:
+            container = container_1[~pidset_container_contains(container_2, container_1)]
+            container = container if len(container) > 0 else None
+        else:
+            container = pidset_container_normalize(container_1 & ~pidset_container_to_bitmap(container_2))
+        if container is not None:
+            d_diff[high] = container
+    return d_diff
+
+
+def pidset_serialize(d_pidset):
+    l_high = sorted(d_pidset)
+    l_container = [d_pidset[high] for high in l_high]
+    np_high = np.asarray(l_high, dtype=np.int64)
+    np_kind = np.asarray([0 if container.dtype == np.uint16 else 1 for container in l_container], dtype=np.int8)
+    np_size = np.asarray([len(container) for container in l_container], dtype=np.int32)
+    l_bytes = [np.int64(len(l_high)).tobytes(), np_high.tobytes(), np_kind.tobytes(), np_size.tobytes()] \
+        + [container.tobytes() for container in l_container]
+    return zlib.compress(b''.join(l_bytes))
+
+
+def pidset_deserialize(pidset_bytes):
+    raw = zlib.decompress(bytes(pidset_bytes))
+    num_container = int(np.frombuffer(raw, dtype=np.int64, count=1)[0])
+    offset = 8
+    np_high = np.frombuffer(raw, dtype=np.int64, count=num_container, offset=offset)
+    offset += 8 * num_container
+    np_kind = np.frombuffer(raw, dtype=np.int8, count=num_container, offset=offset)
+    offset += num_container
+    np_size = np.frombuffer(raw, dtype=np.int32, count=num_container, offset=offset)
+    offset += 4 * num_container
+    d_pidset = dict()
+    for high, kind, size in zip(np_high, np_kind, np_size):
+        dtype = np.uint16 if kind == 0 else np.uint8
+        d_pidset[int(high)] = np.frombuffer(raw, dtype=dtype, count=int(size), offset=offset)
+        offset += int(size) * np.dtype(dtype).itemsize
+    return d_pidset
+
+
+def build_pidset_store(out_path=None, d_col_store=None):
+    """
+    Build the PID set store from the EpiHiper output. See 'PID SET BITMAPS'.
+    :param
+        d_col_store: dict
+            If given, PIDs are read from the columnar store instead of SQLite.
+    Return True if successes, False otherwise.
+    """
+    logging.critical('[build_pidset_store] Starts.')
+    timer_start = time.time()
+
+    if out_path is None:
+        out_path = g_pidset_store_path
+
+    d_pid_by_key = dict()
+    if d_col_store is not None:
+        np_tick_val = d_col_store['tick_val']
+        np_tick_offset = d_col_store['tick_offset']
+        for tick_idx, tick in enumerate(np_tick_val):
+            start = int(np_tick_offset[tick_idx])
+            end = int(np_tick_offset[tick_idx + 1])
+            # Within each tick, records are sorted by exit state.
+            np_code_val, np_code_start = np.unique(d_col_store['exit_state'][start:end], return_index=True)
+            l_pid_split = np.split(np.asarray(d_col_store['pid'][start:end]), np_code_start[1:])
+            for code, np_pid in zip(np_code_val, l_pid_split):
+                d_pid_by_key[(int(tick), d_col_store['l_exit_state'][code])] = np_pid
+    else:
+        try:
+            db_con = connect_to_sqlite(g_epihiper_output_db_path)
+            db_cur = db_con.cursor()
+        except Exception as e:
+            logging.error('[build_pidset_store] %s' % e)
+            return False
+        sql_str = '''select tick, exit_state, pid from %s''' % g_epihiper_output_tb_name
+        try:
+            db_cur.execute(sql_str)
+            while True:
+                rows = db_cur.fetchmany(100000)
+                if len(rows) <= 0:
+                    break
+                for row in rows:
+                    key = (int(row[0]), row[1])
+                    if key not in d_pid_by_key:
+                        d_pid_by_key[key] = [int(row[2])]
+                    else:
+                        d_pid_by_key[key].append(int(row[2]))
+        except Exception as e:
+            logging.error('[build_pidset_store] %s' % e)
+            return False
+        finally:
+            db_con.close()
+
+    l_key = sorted(d_pid_by_key)
+    d_npz = {'index': np.frombuffer(json.dumps([list(key) for key in l_key]).encode('utf-8'), dtype=np.uint8)}
+    num_pid = 0
+    num_byte = 0
+    for key_idx, key in enumerate(l_key):
+        pidset_bytes = pidset_serialize(pidset_from_pids(d_pid_by_key[key]))
+        d_npz['k%s' % key_idx] = np.frombuffer(pidset_bytes, dtype=np.uint8)
+        num_pid += len(d_pid_by_key[key])
+        num_byte += len(pidset_bytes)
+    np.savez(out_path, **d_npz)
+    logging.critical('[build_pidset_store] All done with %s PID sets, %s PIDs in %s bytes in %s secs.'
+                     % (len(l_key), num_pid, num_byte, time.time() - timer_start))
+    return True
+
+
+def load_pidset_store(store_path=None):
+    """
+    Open the PID set store. PID sets are read and deserialized on demand.
+    :return: dict
+        Keys: 'npz' (NpzFile), 'd_key_idx' (dict: (tick, exit_state) -> index), 'l_tick' (sorted list of int),
+              'l_exit_state' (sorted list of str). None if the store does not exist.
+    """
+    if store_path is None:
+        store_path = g_pidset_store_path
+    if not path.exists(store_path):
+        logging.error('[load_pidset_store] No PID set store at %s.' % store_path)
+        return None
+    npz_store = np.load(store_path)
+    l_key = [tuple(key) for key in json.loads(npz_store['index'].tobytes().decode('utf-8'))]
+    d_pidset_store = {'npz': npz_store,
+                      'd_key_idx': {key: key_idx for key_idx, key in enumerate(l_key)},
+                      'l_tick': sorted(set(key[0] for key in l_key)),
+                      'l_exit_state': sorted(set(key[1] for key in l_key))}
+    logging.critical('[load_pidset_store] Opened %s PID sets.' % len(l_key))
+    return d_pidset_store
+
+
+def pidset_store_get(d_pidset_store, tick, exit_state=None, exit_state_prefix=None):
+    """
+    Return the PID set at 'tick' of the exit state(s). If both 'exit_state' and 'exit_state_prefix' are None, all
+    exit states are included.
+    """
+    l_pidset = []
+    for each_exit_state in d_pidset_store['l_exit_state']:
+        if (exit_state is None and exit_state_prefix is None) or each_exit_state == exit_state \
+                or (exit_state_prefix is not None and each_exit_state.startswith(exit_state_prefix)):
+            key_idx = d_pidset_store['d_key_idx'].get((tick, each_exit_state))
+            if key_idx is not None:
+                l_pidset.append(pidset_deserialize(d_pidset_store['npz']['k%s' % key_idx]))
+    if len(l_pidset) == 1:
+        return l_pidset[0]
+    return pidset_union(*l_pidset)
+
+
+def pidset_store_newly_entered(d_pidset_store, tick, exit_state=None, exit_state_prefix=None):
+    """
+    PIDs of the exit state(s) at 'tick' but not at the previous tick in the store.
+    """
+    d_pidset = pidset_store_get(d_pidset_store, tick, exit_state, exit_state_prefix)
+    tick_idx = d_pidset_store['l_tick'].index(tick) if tick in d_pidset_store['l_tick'] else -1
+    if tick_idx <= 0:
+        return d_pidset
+    d_prev_pidset = pidset_store_get(d_pidset_store, d_pidset_store['l_tick'][tick_idx - 1], exit_state,
+                                     exit_state_prefix)
+    return pidset_difference(d_pidset, d_prev_pidset)
+
+
+def pidset_store_pid_over_time(d_pidset_store, exit_state, l_tick=None, newly_entered=False):
+    """
+    Same output as 'fetch_pids_by_exit_state', so it can be passed to 'duration_distribution', 'output_in_1nn_batch'
+    and so on. With 'newly_entered', each tick only keeps PIDs not in the exit state at the previous tick, which
+    shrinks the PID lists sent as query parameters.
+    :return: pandas DataFrame
+        Index: tick (int)
+        Column: pid (list of int)
+    """
+    if l_tick is None:
+        l_tick = d_pidset_store['l_tick']
+    l_rec = []
+    for tick in l_tick:
+        if newly_entered:
+            d_pidset = pidset_store_newly_entered(d_pidset_store, tick, exit_state)
+        else:
+            d_pidset = pidset_store_get(d_pidset_store, tick, exit_state)
+        if len(d_pidset) > 0:
+            l_rec.append((int(tick), pidset_to_pids(d_pidset).tolist()))
+    df_pid_by_tick = pd.DataFrame(l_rec, columns=['tick', 'pid'])
+    df_pid_by_tick = df_pid_by_tick.set_index('tick')
+    return df_pid_by_tick
+
+
+################################################################################
+#   CSR TEMPORAL CONTACT NETWORK ENGINE
+################################################################################
+# A Neo4j-free store of the temporal contact network built straight from the person trait file and the contact
+# network files. Each person is mapped to a row by the position of its PID in the sorted PID array, and each tick
+# holds the incoming edges of all people in the compressed sparse row (CSR) format:
+#   <g_cn_csr_folder>/pid.npy:                 (int64) Sorted PIDs. Row i is for 'pid[i]'.
+#   <g_cn_csr_folder>/act_dict.json:           The list of activities. The code of an activity is its position.
+#   <g_cn_csr_folder>/build_stats.json:        Build time and size per tick.
+#   <g_cn_csr_folder>/tick_<t>/indptr.npy:     (int64) Incoming edges of row i are in [indptr[i], indptr[i + 1]).
+#   <g_cn_csr_folder>/tick_<t>/indices.npy:    (int32) Source row of each edge.
+#   <g_cn_csr_folder>/tick_<t>/duration.npy:   (int32) Duration of each edge.
+#   <g_cn_csr_folder>/tick_<t>/src_act.npy:    (int16) Source activity code of each edge.
+#   <g_cn_csr_folder>/tick_<t>/trg_act.npy:    (int16) Target activity code of each edge.
+# The initial contact network is stored as tick -1, the same as 'occur' in Neo4j.
+g_l_cn_csr_col = ['indptr', 'indices', 'duration', 'src_act', 'trg_act']
+
+
+def read_person_pids(person_trait_path):
+    """
+    Return the sorted distinct PIDs in the person trait file.
+    """
+    l_pid = []
+    with open(person_trait_path, 'r') as in_fd:
+        csv_reader = csv.reader(in_fd, delimiter=',')
+        for row_idx, row in enumerate(csv_reader):
+            if row_idx == 0:
+                continue
+            l_pid.append(int(row[0]))
+    return np.unique(np.asarray(l_pid, dtype=np.int64))
+
+
+def build_cn_csr_tick(np_person_pid, d_act_code, cn_file_path, out_folder):
+    """
+    Build the CSR in-adjacency of one tick from a contact network file.
+    NOTE:
+        Edges whose end points are not in the person trait file are dropped.
+    :return: int
+        The number of edges stored.
+    """
+    # Chunks are kept as compact arrays with PIDs already mapped to rows, as the CSR needs all edges of the tick.
+    d_l_col = {'trg_row': [], 'src_row': [], 'duration': [], 'src_act': [], 'trg_act': []}
+    for d_chunk in read_cn_file_chunks(cn_file_path):
+        d_l_col['trg_row'].append(pid_to_row(np_person_pid, d_chunk['trg_pid']).astype(np.int32))
+        d_l_col['src_row'].append(pid_to_row(np_person_pid, d_chunk['src_pid']).astype(np.int32))
+        d_l_col['duration'].append(d_chunk['duration'].astype(np.int32))
+        d_l_col['src_act'].append(encode_cn_acts(d_act_code, d_chunk['src_act']).astype(np.int16))
+        d_l_col['trg_act'].append(encode_cn_acts(d_act_code, d_chunk['trg_act']).astype(np.int16))
+    d_np_col = {col_name: np.concatenate(l_col) if len(l_col) > 0 else np.zeros(0, dtype=np.int32)
+                for col_name, l_col in d_l_col.items()}
+    del d_l_col
+
+    num_person = len(np_person_pid)
+    np_trg_row = d_np_col['trg_row'].astype(np.int64)
+    np_src_row = d_np_col['src_row']
+    np_valid = (np_trg_row >= 0) & (np_src_row >= 0)
+    if not np.all(np_valid):
+        logging.error('[build_cn_csr_tick] %s edges with unknown PIDs are dropped in %s.'
+                      % (int(np.sum(~np_valid)), cn_file_path))
+    np_trg_row = np_trg_row[np_valid]
+    np_order = np.argsort(np_trg_row, kind='stable')
+    d_col = {'indptr': np.concatenate(([0], np.cumsum(np.bincount(np_trg_row, minlength=num_person)))).astype(np.int64),
+             'indices': np_src_row[np_valid][np_order].astype(np.int32),
+             'duration': d_np_col['duration'][np_valid][np_order],
+             'src_act': d_np_col['src_act'][np_valid][np_order].astype(np.int16),
+             'trg_act': d_np_col['trg_act'][np_valid][np_order].astype(np.int16)}
+
+    if not path.exists(out_folder):
+        os.makedirs(out_folder)
+    for col_name in g_l_cn_csr_col:
+        np.save(path.join(out_folder, '%s.npy' % col_name), d_col[col_name])
+    return len(d_col['indices'])
+
+
+def build_cn_csr(l_time_points=None, out_folder=None):
+    """
+    Build the CSR temporal contact network from the person trait file, the initial contact network file and the
+    intermediate contact network files. See 'CSR TEMPORAL CONTACT NETWORK ENGINE'.
+    :param
+        l_time_points: list of int
+            The time points of intermediate contact networks to be built. All found if None.
+    Return True if successes, False otherwise.
+    """
+    logging.critical('[build_cn_csr] Starts.')
+    timer_start = time.time()
+
+    if out_folder is None:
+        out_folder = g_cn_csr_folder
+    if not path.exists(out_folder):
+        os.makedirs(out_folder)
+
+    np_person_pid = read_person_pids(g_person_trait_path)
+    np.save(path.join(out_folder, 'pid.npy'), np_person_pid)
+    logging.critical('[build_cn_csr] %s people mapped in %s secs.' % (len(np_person_pid), time.time() - timer_start))
+
+    l_cn_file = [(-1, g_init_cn_path)]
+    search_folder = path.join(g_init_cn_folder, g_int_cn_folder)
+    for time_point, dirpath, filename in search_int_cn_files(search_folder, l_time_points):
+        l_cn_file.append((time_point, path.join(dirpath, filename)))
+
+    d_act_code = dict()
+    d_build_stats = dict()
+    for tick, cn_file_path in l_cn_file:
+        timer_start_tick = time.time()
+        tick_folder = path.join(out_folder, 'tick_%s' % tick)
+        num_edge = build_cn_csr_tick(np_person_pid, d_act_code, cn_file_path, tick_folder)
+        d_build_stats[str(tick)] = {'num_edge': num_edge,
+                                    'build_secs': time.time() - timer_start_tick,
+                                    'bytes': sum([path.getsize(path.join(tick_folder, '%s.npy' % col_name))
+                                                  for col_name in g_l_cn_csr_col])}
+        logging.critical('[build_cn_csr] Tick %s: %s edges in %s secs.'
+                         % (tick, num_edge, time.time() - timer_start_tick))
+
+    l_act = sorted(d_act_code, key=lambda act: d_act_code[act])
+    with open(path.join(out_folder, 'act_dict.json'), 'w+') as out_fd:
+        json.dump(l_act, out_fd)
+    d_build_stats['total_build_secs'] = time.time() - timer_start
+    with open(path.join(out_folder, 'build_stats.json'), 'w+') as out_fd:
+        json.dump(d_build_stats, out_fd, indent=4)
+
+    logging.critical('[build_cn_csr] All done in %s secs.' % str(time.time() - timer_start))
+    return True
+
+
+def load_cn_csr(csr_folder=None):
+    """
+    Open the CSR temporal contact network. Column files of each tick are memory-mapped on their first use.
+    :return: dict
+        'pid': (ndarray) Sorted PIDs.
+        'l_act': (list of str) Activities.
+        'd_act_code': (dict) Activity -> code.
+        'l_tick': (list of int) Available ticks.
+        'd_tick': (dict) Tick -> dict of column name -> np.memmap. Filled by 'get_cn_csr_tick'.
+        'folder': (str)
+        None if the store does not exist.
+    """
+    if csr_folder is None:
+        csr_folder = g_cn_csr_folder
+    if not path.exists(path.join(csr_folder, 'act_dict.json')):
+        logging.error('[load_cn_csr] No CSR contact network in %s.' % csr_folder)
+        return None
+
+    d_csr = {'pid': np.load(path.join(csr_folder, 'pid.npy')), 'folder': csr_folder, 'd_tick': dict()}
+    with open(path.join(csr_folder, 'act_dict.json'), 'r') as in_fd:
+        d_csr['l_act'] = json.load(in_fd)
+    d_csr['d_act_code'] = {act: code for code, act in enumerate(d_csr['l_act'])}
+    l_tick = []
+    for name in os.listdir(csr_folder):
+        if re.match(r'tick_-?\d+$', name) is not None:
+            l_tick.append(int(name[len('tick_'):]))
+    d_csr['l_tick'] = sorted(l_tick)
+    logging.critical('[load_cn_csr] Opened %s people over ticks %s.' % (len(d_csr['pid']), d_csr['l_tick']))
+    return d_csr
+
+
+def get_cn_csr_tick(d_csr, tick):
+    """
+    Return the dict of memory-mapped CSR columns of 'tick'. None if the tick is not available.
+    """
+    if tick in d_csr['d_tick']:
+        return d_csr['d_tick'][tick]
+    tick_folder = path.join(d_csr['folder'], 'tick_%s' % tick)
+    if not path.exists(tick_folder):
+        return None
+    d_tick = dict()
+    for col_name in g_l_cn_csr_col:
+        d_tick[col_name] = np.load(path.join(tick_folder, '%s.npy' % col_name), mmap_mode='r')
+    d_csr['d_tick'][tick] = d_tick
+    return d_tick
+
+
+def pid_to_row(np_person_pid, np_pid):
+    """
+    Map PIDs to rows. Unknown PIDs are mapped to -1.
+    """
+    np_pid = np.asarray(np_pid, dtype=np.int64)
+    if len(np_person_pid) <= 0:
+        return np.full(len(np_pid), -1, dtype=np.int64)
+    np_row = np.searchsorted(np_person_pid, np_pid).astype(np.int64)
+    np_row[np_row >= len(np_person_pid)] = 0
+    np_row[np_person_pid[np_row] != np_pid] = -1
+    return np_row
+
+
+def csr_in_edge_slots(d_tick, np_row):
+    """
+    Return the positions of all incoming edges of the given rows in the edge columns, and the target row of each.
+    """
+    np_indptr = d_tick['indptr']
+    np_start = np.asarray(np_indptr[np_row], dtype=np.int64)
+    np_cnt = np.asarray(np_indptr[np_row + 1], dtype=np.int64) - np_start
+    np_trg_row = np.repeat(np_row, np_cnt)
+    # Positions are 'start + k' for k in [0, cnt) of each row.
+    np_offset = np.arange(np.sum(np_cnt), dtype=np.int64) - np.repeat(np.cumsum(np_cnt) - np_cnt, np_cnt)
+    return np.repeat(np_start, np_cnt) + np_offset, np_trg_row
+
+
+def csr_in_degree(d_csr, tick, l_pid):
+    """
+    The counterpart of 'infect_in_deg_dist_at_t'. Unlike 'apoc.node.degree', only edges at 'tick' are counted.
+    :return: pandas DataFrame
+        Columns: pid (int), in_deg (int)
+    """
+    d_tick = get_cn_csr_tick(d_csr, tick)
+    np_pid = np.unique(np.asarray(l_pid, dtype=np.int64))
+    np_row = pid_to_row(d_csr['pid'], np_pid)
+    np_pid = np_pid[np_row >= 0]
+    np_row = np_row[np_row >= 0]
+    if d_tick is None:
+        return pd.DataFrame({'pid': np_pid, 'in_deg': np.zeros(len(np_pid), dtype=np.int64)})
+    np_indptr = d_tick['indptr']
+    np_in_deg = np.asarray(np_indptr[np_row + 1], dtype=np.int64) - np.asarray(np_indptr[np_row], dtype=np.int64)
+    return pd.DataFrame({'pid': np_pid, 'in_deg': np_in_deg})
+
+
+def csr_in_1nn(d_csr, tick, l_core_pid):
+    """
+    The counterpart of the query used by 'output_in_1nn_batch': all incoming edges of the core PIDs at 'tick'.
+    :return: pandas DataFrame
+        Columns: src_pid (int), trg_pid (int), duration (int), src_act (str), trg_act (str)
+    """
+    d_tick = get_cn_csr_tick(d_csr, tick)
+    l_col = ['src_pid', 'trg_pid', 'duration', 'src_act', 'trg_act']
+    if d_tick is None:
+        return pd.DataFrame([], columns=l_col)
+    np_row = pid_to_row(d_csr['pid'], np.unique(np.asarray(l_core_pid, dtype=np.int64)))
+    np_row = np_row[np_row >= 0]
+    np_slot, np_trg_row = csr_in_edge_slots(d_tick, np_row)
+    np_act = np.asarray(d_csr['l_act'], dtype=object)
+    return pd.DataFrame({'src_pid': d_csr['pid'][np.asarray(d_tick['indices'][np_slot], dtype=np.int64)],
+                         'trg_pid': d_csr['pid'][np_trg_row],
+                         'duration': np.asarray(d_tick['duration'][np_slot]),
+                         'src_act': np_act[np.asarray(d_tick['src_act'][np_slot], dtype=np.int64)],
+                         'trg_act': np_act[np.asarray(d_tick['trg_act'][np_slot], dtype=np.int64)]},
+                        columns=l_col)
+
+
+def csr_duration_distribution(d_csr, df_output_pid_over_time, l_t=None):
+    """
+    The counterpart of 'duration_distribution' with the 'in_1nn' mode.
+    :return: pandas DataFrame
+        Index: tick (int)
+        Column: duration_dist (dict of int -> int)
+    """
+    if l_t is None:
+        l_t = df_output_pid_over_time.index.to_list()
+
+    l_dist_rec = []
+    for tick, pid_rec in df_output_pid_over_time.loc[l_t].iterrows():
+        d_tick = get_cn_csr_tick(d_csr, tick)
+        if d_tick is None:
+            continue
+        np_row = pid_to_row(d_csr['pid'], np.unique(np.asarray(pid_rec['pid'], dtype=np.int64)))
+        np_slot, _ = csr_in_edge_slots(d_tick, np_row[np_row >= 0])
+        if len(np_slot) <= 0:
+            continue
+        np_duration, np_cnt = np.unique(np.asarray(d_tick['duration'][np_slot]), return_counts=True)
+        l_dist_rec.append((tick, {int(duration): int(cnt) for duration, cnt in zip(np_duration, np_cnt)}))
+
+    df_dist = pd.DataFrame(l_dist_rec, columns=['tick', 'duration_dist'])
+    df_dist = df_dist.set_index('tick')
+    return df_dist
+
+
+def benchmark_cn_csr_vs_neo4j(neo4j_driver, d_csr, df_output_pid_over_time, l_t, out_path):
+    """
+    Compare the CSR engine against Neo4j on the duration distribution, the in-1NN subgraph and the in-degrees of the
+    core PIDs at each tick in 'l_t'. Build time and on-disk size come from 'build_stats.json', and the memory is the
+    max resident set size of this process after the CSR queries.
+    :return: pandas DataFrame
+        Columns: tick, query, backend, secs, num_ret
+    """
+    logging.critical('[benchmark_cn_csr_vs_neo4j] Starts.')
+
+    neo4j_session_config = {'database': g_neo4j_db_name}
+    in_1nn_query_str = '''with $l_core_pid as l_core_pid, $tick as tick
+                           match (t:PERSON) where t.pid in l_core_pid
+                           match (s:PERSON)-[r:CONTACT]->(t) where r.occur = tick
+                           return s.pid, t.pid, r.duration, r.src_act, r.trg_act'''
+    in_deg_query_str = '''unwind $infect_pid as infect_pid
+                           match (n:PERSON {pid: infect_pid})
+                           return infect_pid, apoc.node.degree(n, "<CONTACT")'''
+
+    l_bench_rec = []
+    for tick in l_t:
+        l_core_pid = df_output_pid_over_time.loc[tick]['pid']
+
+        timer_start = time.time()
+        df_dist = csr_duration_distribution(d_csr, df_output_pid_over_time, [tick])
+        l_bench_rec.append((tick, 'duration_distribution', 'csr', time.time() - timer_start, len(df_dist)))
+        timer_start = time.time()
+        df_in_1nn = csr_in_1nn(d_csr, tick, l_core_pid)
+        l_bench_rec.append((tick, 'in_1nn', 'csr', time.time() - timer_start, len(df_in_1nn)))
+        timer_start = time.time()
+        df_in_deg = csr_in_degree(d_csr, tick, l_core_pid)
+        l_bench_rec.append((tick, 'in_deg', 'csr', time.time() - timer_start, len(df_in_deg)))
+
+        if neo4j_driver is None:
+            continue
+        timer_start = time.time()
+        ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [in_1nn_query_str],
+                                    l_query_param=[{'l_core_pid': l_core_pid, 'tick': tick}], need_ret=True)
+        if ret is None:
+            raise Exception('[benchmark_cn_csr_vs_neo4j] Neo4j in_1nn query failed at tick %s.' % tick)
+        # The duration distribution is a count over the same edges, so both are timed by this query.
+        secs = time.time() - timer_start
+        l_bench_rec.append((tick, 'duration_distribution', 'neo4j', secs, 1 if len(ret[0]) > 0 else 0))
+        l_bench_rec.append((tick, 'in_1nn', 'neo4j', secs, len(ret[0])))
+        timer_start = time.time()
+        ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [in_deg_query_str],
+                                    l_query_param=[{'infect_pid': list(set(l_core_pid))}], need_ret=True)
+        if ret is None:
+            raise Exception('[benchmark_cn_csr_vs_neo4j] Neo4j in_deg query failed at tick %s.' % tick)
+        l_bench_rec.append((tick, 'in_deg', 'neo4j', time.time() - timer_start, len(ret[0])))
+
+    df_bench = pd.DataFrame(l_bench_rec, columns=['tick', 'query', 'backend', 'secs', 'num_ret'])
+    pd.to_pickle(df_bench, out_path)
+
+    max_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    build_stats_path = path.join(d_csr['folder'], 'build_stats.json')
+    if path.exists(build_stats_path):
+        with open(build_stats_path, 'r') as in_fd:
+            d_build_stats = json.load(in_fd)
+        logging.critical('[benchmark_cn_csr_vs_neo4j] CSR build: %s secs, %s bytes on disk.'
+                         % (d_build_stats['total_build_secs'],
+                            sum([d_build_stats[key]['bytes'] for key in d_build_stats if key != 'total_build_secs'])))
+    logging.critical('[benchmark_cn_csr_vs_neo4j] Max RSS: %s MB.' % max_rss_mb)
+    logging.critical('[benchmark_cn_csr_vs_neo4j] Mean secs by query and backend:\n%s'
+                     % df_bench.groupby(['query', 'backend'])['secs'].mean())
+    return df_bench
+
+
+################################################################################
+#   PERSON COLUMN STORE WITH BITMAP INDEXES
+################################################################################
+# The person trait file is stored as one NumPy file per property, rows sorted by PID (the same row mapping as the CSR
+# contact network). String properties are dictionary-encoded. Dense bitmaps are bit-packed by 'np.packbits', one bit
+# per row, and only kept for low-cardinality properties:
+#   - Equality-encoded for 'gender' and 'age_group': bitmap[k] marks rows whose value is the k-th value.
+#   - Range-encoded for 'age': bitmap[k] marks rows with 'age <= age_val[k]', so any age range takes at most two
+#     bitmaps.
+# A dense bitmap per value of 'fips' and 'admin1' to 'admin4' would take N/8 bytes for each of up to hundreds of
+# thousands of values. Instead, their rows are sorted by value, i.e. a CSR from value codes to rows, which takes 4 bytes
+# per row whatever the cardinality.
+# Files:
+#   <g_person_col_folder>/<prop>.npy:               Column of each property.
+#   <g_person_col_folder>/bm_<prop>.npy:            (uint8) 2D bitmaps of a bitmap-indexed property.
+#   <g_person_col_folder>/bm_<prop>_val.json:       Values of the bitmaps of a bitmap-indexed property.
+#   <g_person_col_folder>/rows_<prop>.npy:          (int32) Rows sorted by the value code of a row-indexed property.
+#   <g_person_col_folder>/rows_<prop>_offset.npy:   (int64) Rows of code k are rows[offset[k]:offset[k + 1]].
+#   <g_person_col_folder>/dict_<prop>.json:         Values of a dictionary-encoded property.
+# All files are memory-mapped when opened.
+g_l_person_num_prop = ['pid', 'hid', 'age', 'gender', 'home_lat', 'home_lon']
+g_l_person_str_prop = ['age_group', 'fips', 'admin1', 'admin2', 'admin3', 'admin4']
+g_l_person_eq_bm_prop = ['gender', 'age_group']
+g_l_person_eq_rows_prop = ['fips', 'admin1', 'admin2', 'admin3', 'admin4']
+
+
+def build_person_col_store(out_folder=None):
+    """
+    Build the person column store and its bitmap indexes from the person trait file.
+    Return True if successes, False otherwise.
+    """
+    logging.critical('[build_person_col_store] Starts.')
+    timer_start = time.time()
+
+    if out_folder is None:
+        out_folder = g_person_col_folder
+    if not path.exists(out_folder):
+        os.makedirs(out_folder)
+
+    d_raw = {prop: [] for prop in g_l_person_num_prop + g_l_person_str_prop}
+    with open(g_person_trait_path, 'r') as in_fd:
+        csv_reader = csv.reader(in_fd, delimiter=',')
+        for row_idx, row in enumerate(csv_reader):
+            if row_idx == 0:
+                continue
+            d_raw['pid'].append(int(row[0]))
+            d_raw['hid'].append(int(row[1]))
+            d_raw['age'].append(int(row[2]))
+            d_raw['age_group'].append(row[3])
+            d_raw['gender'].append(int(row[4]))
+            d_raw['fips'].append(row[5])
+            d_raw['home_lat'].append(float(row[6]))
+            d_raw['home_lon'].append(float(row[7]))
+            d_raw['admin1'].append(row[8])
+            d_raw['admin2'].append(row[9])
+            d_raw['admin3'].append(row[10])
+            d_raw['admin4'].append(row[11])
+
+    np_pid = np.asarray(d_raw['pid'], dtype=np.int64)
+    np_order = np.argsort(np_pid, kind='stable')
+    d_col = {'pid': np_pid[np_order],
+             'hid': np.asarray(d_raw['hid'], dtype=np.int64)[np_order],
+             'age': np.asarray(d_raw['age'], dtype=np.int16)[np_order],
+             'gender': np.asarray(d_raw['gender'], dtype=np.int8)[np_order],
+             'home_lat': np.asarray(d_raw['home_lat'], dtype=np.float64)[np_order],
+             'home_lon': np.asarray(d_raw['home_lon'], dtype=np.float64)[np_order]}
+    d_num_code = dict()
+    for prop in g_l_person_str_prop:
+        l_val, np_code = np.unique(np.asarray(d_raw[prop], dtype=object), return_inverse=True)
+        d_col[prop] = np_code.astype(np.int32)[np_order]
+        d_num_code[prop] = len(l_val)
+        with open(path.join(out_folder, 'dict_%s.json' % prop), 'w+') as out_fd:
+            json.dump([str(val) for val in l_val], out_fd)
+    del d_raw
+
+    for prop in d_col:
+        np.save(path.join(out_folder, '%s.npy' % prop), d_col[prop])
+
+    # EQUALITY-ENCODED BITMAPS
+    for prop in g_l_person_eq_bm_prop:
+        np_val = np.unique(d_col[prop])
+        np_bm = np.stack([np.packbits(d_col[prop] == val) for val in np_val]) if len(np_val) > 0 \
+            else np.zeros((0, 0), dtype=np.uint8)
+        np.save(path.join(out_folder, 'bm_%s.npy' % prop), np_bm)
+        with open(path.join(out_folder, 'bm_%s_val.json' % prop), 'w+') as out_fd:
+            json.dump([int(val) for val in np_val], out_fd)
+
+    # ROW LISTS
+    for prop in g_l_person_eq_rows_prop:
+        np_row = np.argsort(d_col[prop], kind='stable').astype(np.int32)
+        np_offset = np.zeros(d_num_code[prop] + 1, dtype=np.int64)
+        np_offset[1:] = np.cumsum(np.bincount(d_col[prop], minlength=len(np_offset) - 1))
+        np.save(path.join(out_folder, 'rows_%s.npy' % prop), np_row)
+        np.save(path.join(out_folder, 'rows_%s_offset.npy' % prop), np_offset)
+
+    # RANGE-ENCODED BITMAPS
+    np_age_val = np.unique(d_col['age'])
+    np_bm = np.stack([np.packbits(d_col['age'] <= val) for val in np_age_val]) if len(np_age_val) > 0 \
+        else np.zeros((0, 0), dtype=np.uint8)
+    np.save(path.join(out_folder, 'bm_age.npy'), np_bm)
+    with open(path.join(out_folder, 'bm_age_val.json'), 'w+') as out_fd:
+        json.dump([int(val) for val in np_age_val], out_fd)
+
+    logging.critical('[build_person_col_store] All done with %s people in %s secs.'
+                     % (len(d_col['pid']), time.time() - timer_start))
+    return True
+
+
+def load_person_col_store(col_folder=None):
+    """
+    Open the person column store. Columns, bitmaps and row lists are memory-mapped.
+    :return: dict
+        '<prop>': (np.memmap) Column of each property.
+        'd_bm': (dict) Property -> 2D bitmap array.
+        'd_bm_val': (dict) Property -> list of values of the bitmaps.
+        'd_rows': (dict) Property -> (rows, offsets) of a row-indexed property.
+        'd_dict': (dict) Dictionary-encoded property -> list of values.
+        'num_person': (int)
+        None if the store does not exist.
+    """
+    if col_folder is None:
+        col_folder = g_person_col_folder
+    if not path.exists(path.join(col_folder, 'bm_age.npy')):
+        logging.error('[load_person_col_store] No person column store in %s.' % col_folder)
+        return None
+    if not path.exists(path.join(col_folder, 'rows_%s.npy' % g_l_person_eq_rows_prop[0])):
+        logging.error('[load_person_col_store] The person column store in %s is outdated. Run "build_person_col_store".'
+                      % col_folder)
+        return None
+
+    d_person = {'d_bm': dict(), 'd_bm_val': dict(), 'd_rows': dict(), 'd_dict': dict()}
+    for prop in g_l_person_num_prop + g_l_person_str_prop:
+        d_person[prop] = np.load(path.join(col_folder, '%s.npy' % prop), mmap_mode='r')
+    for prop in g_l_person_str_prop:
+        with open(path.join(col_folder, 'dict_%s.json' % prop), 'r') as in_fd:
+            d_person['d_dict'][prop] = json.load(in_fd)
+    for prop in g_l_person_eq_bm_prop + ['age']:
+        d_person['d_bm'][prop] = np.load(path.join(col_folder, 'bm_%s.npy' % prop), mmap_mode='r')
+        with open(path.join(col_folder, 'bm_%s_val.json' % prop), 'r') as in_fd:
+            d_person['d_bm_val'][prop] = json.load(in_fd)
+    for prop in g_l_person_eq_rows_prop:
+        d_person['d_rows'][prop] = (np.load(path.join(col_folder, 'rows_%s.npy' % prop), mmap_mode='r'),
+                                    np.load(path.join(col_folder, 'rows_%s_offset.npy' % prop), mmap_mode='r'))
+    d_person['num_person'] = len(d_person['pid'])
+    logging.critical('[load_person_col_store] Opened %s people.' % d_person['num_person'])
+    return d_person
+
+
+def person_bm_empty(d_person):
+    return np.zeros((d_person['num_person'] + 7) // 8, dtype=np.uint8)
+
+
+def person_bm_full(d_person):
+    return np.packbits(np.ones(d_person['num_person'], dtype=bool))
+
+
+def person_bm_eq(d_person, prop, l_val):
+    """
+    Bitmap of rows whose 'prop' is any of 'l_val'. String values are given as they are in the person trait file.
+    Only 'age' (through its range encoding), 'g_l_person_eq_bm_prop' and 'g_l_person_eq_rows_prop' are indexed.
+    """
+    if prop == 'age':
+        np_bm = person_bm_empty(d_person)
+        for val in l_val:
+            np_bm |= person_bm_age_range(d_person, val, val)
+        return np_bm
+    if prop not in g_l_person_eq_bm_prop + g_l_person_eq_rows_prop:
+        raise Exception('[person_bm_eq] "%s" is not indexed by the person column store.' % prop)
+    if prop in g_l_person_str_prop:
+        l_str_val = d_person['d_dict'][prop]
+        l_val = [l_str_val.index(val) for val in l_val if val in l_str_val]
+    if prop in g_l_person_eq_rows_prop:
+        np_row, np_offset = d_person['d_rows'][prop]
+        np_mask = np.zeros(d_person['num_person'], dtype=bool)
+        for code in l_val:
+            np_mask[np_row[np_offset[code]:np_offset[code + 1]]] = True
+        return np.packbits(np_mask)
+    l_bm_val = d_person['d_bm_val'][prop]
+    np_bm = person_bm_empty(d_person)
+    for val in l_val:
+        if val in l_bm_val:
+            np_bm |= d_person['d_bm'][prop][l_bm_val.index(val)]
+    return np_bm
+
+
+def person_bm_age_le(d_person, age):
+    l_bm_val = d_person['d_bm_val']['age']
+    # The largest indexed age not greater than 'age'.
+    k = int(np.searchsorted(l_bm_val, age, side='right')) - 1
+    if k < 0:
+        return person_bm_empty(d_person)
+    return d_person['d_bm']['age'][k]
+
+
+def person_bm_age_range(d_person, age_low, age_high):
+    """
+    Bitmap of rows with 'age_low <= age <= age_high'.
+    """
+    return person_bm_age_le(d_person, age_high) & ~person_bm_age_le(d_person, age_low - 1)
+
+
+def eval_person_pred(d_person, pred):
+    """
+    Evaluate a node predicate into a bitmap. A predicate is a nested tuple:
+        ('and', pred_1, pred_2, ...)
+        ('or', pred_1, pred_2, ...)
+        ('not', pred)
+        ('eq', prop, val)
+        ('in', prop, list of val)
+        ('range', 'age', low, high)     Both ends inclusive.
+    For example, 'n.age>=18 and n.age<=24 and n.gender=2' is
+        ('and', ('range', 'age', 18, 24), ('eq', 'gender', 2))
+    :return: ndarray of uint8
+        The bit-packed bitmap over rows.
+    """
+    op = pred[0]
+    if op == 'and':
+        np_bm = person_bm_full(d_person)
+        for sub_pred in pred[1:]:
+            np_bm &= eval_person_pred(d_person, sub_pred)
+        return np_bm
+    elif op == 'or':
+        np_bm = person_bm_empty(d_person)
+        for sub_pred in pred[1:]:
+            np_bm |= eval_person_pred(d_person, sub_pred)
+        return np_bm
+    elif op == 'not':
+        return ~eval_person_pred(d_person, pred[1]) & person_bm_full(d_person)
+    elif op == 'eq':
+        return person_bm_eq(d_person, pred[1], [pred[2]])
+    elif op == 'in':
+        return person_bm_eq(d_person, pred[1], pred[2])
+    elif op == 'range':
+        if pred[1] != 'age':
+            raise Exception('[eval_person_pred] Only "age" is range-encoded.')
+        return person_bm_age_range(d_person, pred[2], pred[3])
+    else:
+        raise Exception('[eval_person_pred] Unknown op: %s' % op)
+
+
+def can_eval_person_pred(pred):
+    """
+    Whether 'eval_person_pred' can evaluate every leaf of 'pred' by the indexes of the person column store.
+    """
+    if pred is None:
+        return True
+    op = pred[0]
+    if op in ['and', 'or', 'not']:
+        return all(can_eval_person_pred(sub_pred) for sub_pred in pred[1:])
+    elif op in ['eq', 'in']:
+        return pred[1] in ['age'] + g_l_person_eq_bm_prop + g_l_person_eq_rows_prop
+    elif op == 'range':
+        return pred[1] == 'age'
+    return False
+
+
+def person_bm_from_pids(d_person, l_pid):
+    """
+    Bitmap of rows of the given PIDs. Unknown PIDs are ignored.
+    """
+    np_row = pid_to_row(d_person['pid'], np.unique(np.asarray(l_pid, dtype=np.int64)))
+    np_mask = np.zeros(d_person['num_person'], dtype=bool)
+    np_mask[np_row[np_row >= 0]] = True
+    return np.packbits(np_mask)
+
+
+def person_bm_to_pids(d_person, np_bm):
+    np_mask = np.unpackbits(np_bm, count=d_person['num_person']).astype(bool)
+    return np.asarray(d_person['pid'][np_mask])
+
+
+def filter_pids_by_person_pred(d_person, pred, l_pid=None):
+    """
+    Return the sorted PIDs satisfying 'pred'. If 'l_pid' is given, only these PIDs are considered.
+    """
+    np_bm = eval_person_pred(d_person, pred)
+    if l_pid is not None:
+        np_bm &= person_bm_from_pids(d_person, l_pid)
+    return person_bm_to_pids(d_person, np_bm)
+
+
+g_query_1_person_pred = ('and', ('range', 'age', 18, 24), ('eq', 'gender', 2))
+g_query_3_person_pred = ('or',
+                         ('and', ('eq', 'gender', 2), ('range', 'age', 71, 90)),
+                         ('and', ('eq', 'gender', 1), ('range', 'age', 32, 39)))
+
+
+def query_1_person_col_1(d_person, df_pid, out_path):
+    """
+    The local counterpart of 'query_1_neo4j_1' answered by the person bitmap indexes.
+    If 'out_path' is None, the results are only returned.
+    """
+    logging.critical('[query_1_person_col_1] Starts.')
+    timer_start = time.time()
+
+    np_pid = filter_pids_by_person_pred(d_person, g_query_1_person_pred, df_pid['pid'].to_list())
+    df_ret = pd.DataFrame({'pid': np_pid})
+    if out_path is not None:
+        pd.to_pickle(df_ret, out_path)
+
+    logging.critical('[query_1_person_col_1] All done in %s secs.' % str(time.time() - timer_start))
+    return df_ret
+
+
+def query_3_person_col_1(d_person, d_csr, out_path):
+    """
+    The local counterpart of 'query_3_neo4j_1'. The node filter is answered by the person bitmap indexes, and the
+    incoming edges with 'src_act="1:2"' over all ticks are checked by the CSR contact network.
+    If 'out_path' is None, the results are only returned.
+    """
+    logging.critical('[query_3_person_col_1] Starts.')
+    timer_start = time.time()
+
+    np_cand_pid = filter_pids_by_person_pred(d_person, g_query_3_person_pred)
+    np_cand_row = pid_to_row(d_csr['pid'], np_cand_pid)
+    np_cand_row = np_cand_row[np_cand_row >= 0]
+    np_hit = np.zeros(len(np_cand_row), dtype=bool)
+    src_act_code = d_csr['d_act_code'].get('1:2', None)
+    if src_act_code is not None:
+        for tick in d_csr['l_tick']:
+            d_tick = get_cn_csr_tick(d_csr, tick)
+            np_slot, np_trg_row = csr_in_edge_slots(d_tick, np_cand_row[~np_hit])
+            np_hit_row = np.unique(np_trg_row[np.asarray(d_tick['src_act'][np_slot]) == src_act_code])
+            np_hit |= np.isin(np_cand_row, np_hit_row)
+    df_ret = pd.DataFrame({'pid': d_csr['pid'][np_cand_row[np_hit]]})
+    if out_path is not None:
+        pd.to_pickle(df_ret, out_path)
+
+    logging.critical('[query_3_person_col_1] All done in %s secs.' % str(time.time() - timer_start))
+    return df_ret
+
+
+################################################################################
+#   HOUSEHOLD INDEX
+################################################################################
+# The household index is built once when nodes are loaded. Members are sorted by (hid, age):
+#   hid.npy:            (int64) Sorted distinct HIDs.
+#   member_offset.npy:  (int64) Members of 'hid[i]' are in [member_offset[i], member_offset[i + 1]).
+#   member_pid.npy:     (int64) PID of each member.
+#   member_age.npy:     (int16) Age of each member.
+#   size.npy:           (int32) Number of members of each household.
+#   age_min.npy:        (int16) Min age of each household.
+#   age_max.npy:        (int16) Max age of each household.
+#   age_hist.npy:       (int16) 2D. age_hist[i, k] is the number of members of 'hid[i]' with
+#                       'g_household_age_bin[k] <= age < g_household_age_bin[k + 1]'.
+# TODO
+# The age bins can be modified case by case. Age ranges aligned with the bins are answered by 'age_hist' only.
+g_household_age_bin = [0, 5, 8, 15, 18, 25, 50, 65, 200]
+
+
+def build_household_index(out_folder=None):
+    """
+    Build the household index from the person trait file. See 'HOUSEHOLD INDEX'.
+    Return True if successes, False otherwise.
+    """
+    logging.critical('[build_household_index] Starts.')
+    timer_start = time.time()
+
+    if out_folder is None:
+        out_folder = g_household_folder
+    if not path.exists(out_folder):
+        os.makedirs(out_folder)
+
+    l_pid = []
+    l_hid = []
+    l_age = []
+    with open(g_person_trait_path, 'r') as in_fd:
+        csv_reader = csv.reader(in_fd, delimiter=',')
+        for row_idx, row in enumerate(csv_reader):
+            if row_idx == 0:
+                continue
+            l_pid.append(int(row[0]))
+            l_hid.append(int(row[1]))
+            l_age.append(int(row[2]))
+
+    np_pid = np.asarray(l_pid, dtype=np.int64)
+    np_hid = np.asarray(l_hid, dtype=np.int64)
+    np_age = np.asarray(l_age, dtype=np.int16)
+    np_order = np.lexsort((np_age, np_hid))
+    np_hid = np_hid[np_order]
+    np_age = np_age[np_order]
+
+    np_hid_val, np_hid_start, np_size = np.unique(np_hid, return_index=True, return_counts=True)
+    np_offset = np.append(np_hid_start, len(np_hid)).astype(np.int64)
+    d_hh = {'hid': np_hid_val,
+            'member_offset': np_offset,
+            'member_pid': np_pid[np_order],
+            'member_age': np_age,
+            'size': np_size.astype(np.int32)}
+    if len(np_hid_val) > 0:
+        # Members are sorted by age within each household.
+        d_hh['age_min'] = np_age[np_offset[:-1]]
+        d_hh['age_max'] = np_age[np_offset[1:] - 1]
+        np_bin = np.digitize(np_age, g_household_age_bin[1:-1])
+        np_hh_idx = np.repeat(np.arange(len(np_hid_val)), np_size)
+        np_age_hist = np.zeros((len(np_hid_val), len(g_household_age_bin) - 1), dtype=np.int16)
+        np.add.at(np_age_hist, (np_hh_idx, np_bin), 1)
+        d_hh['age_hist'] = np_age_hist
+    else:
+        d_hh['age_min'] = np.zeros(0, dtype=np.int16)
+        d_hh['age_max'] = np.zeros(0, dtype=np.int16)
+        d_hh['age_hist'] = np.zeros((0, len(g_household_age_bin) - 1), dtype=np.int16)
+
+    for key in d_hh:
+        np.save(path.join(out_folder, '%s.npy' % key), d_hh[key])
+    with open(path.join(out_folder, 'age_bin.json'), 'w+') as out_fd:
+        json.dump(g_household_age_bin, out_fd)
+
+    logging.critical('[build_household_index] All done with %s households in %s secs.'
+                     % (len(np_hid_val), time.time() - timer_start))
+    return True
+
+
+def load_household_index(hh_folder=None):
+    """
+    Open the household index. See 'HOUSEHOLD INDEX'.
+    :return: dict
+        Keys are the file names without '.npy', plus 'age_bin' (list of int). None if the index does not exist.
+    """
+    if hh_folder is None:
+        hh_folder = g_household_folder
+    if not path.exists(path.join(hh_folder, 'age_bin.json')):
+        logging.error('[load_household_index] No household index in %s.' % hh_folder)
+        return None
+
+    d_hh = dict()
+    for key in ['hid', 'member_offset', 'member_pid', 'member_age', 'size', 'age_min', 'age_max', 'age_hist']:
+        d_hh[key] = np.load(path.join(hh_folder, '%s.npy' % key), mmap_mode='r')
+    with open(path.join(hh_folder, 'age_bin.json'), 'r') as in_fd:
+        d_hh['age_bin'] = json.load(in_fd)
+    logging.critical('[load_household_index] Opened %s households.' % len(d_hh['hid']))
+    return d_hh
+
+
+def household_member_cnt_in_age_range(d_hh, age_low, age_high, np_hh_idx=None):
+    """
+    Count members with 'age_low <= age <= age_high' of each household in 'np_hh_idx' (all if None).
+    If the range is aligned with the age bins, only 'age_hist' is read. Otherwise, member ages are scanned.
+    """
+    if np_hh_idx is None:
+        np_hh_idx = np.arange(len(d_hh['hid']))
+    l_age_bin = d_hh['age_bin']
+    if age_low in l_age_bin and age_high + 1 in l_age_bin:
+        bin_start = l_age_bin.index(age_low)
+        bin_end = l_age_bin.index(age_high + 1)
+        return np.asarray(d_hh['age_hist'][np_hh_idx, bin_start:bin_end]).sum(axis=1)
+
+    if len(d_hh['hid']) <= 0:
+        return np.zeros(len(np_hh_idx), dtype=np.int64)
+    np_member_age = np.asarray(d_hh['member_age'])
+    np_in_range = ((np_member_age >= age_low) & (np_member_age <= age_high)).astype(np.int64)
+    # Every household has at least one member, so no segment of 'reduceat' is empty.
+    np_cnt = np.add.reduceat(np_in_range, np.asarray(d_hh['member_offset'][:-1]))
+    return np_cnt[np_hh_idx]
+
+
+def households_by_composition(d_hh, min_size=None, max_size=None, age_low=None, age_high=None, min_member_in_age=1):
+    """
+    Return the HIDs of households with 'min_size <= size <= max_size' that have at least 'min_member_in_age'
+    members with 'age_low <= age <= age_high'. Any bound can be None.
+    """
+    np_size = np.asarray(d_hh['size'])
+    np_mask = np.ones(len(np_size), dtype=bool)
+    if min_size is not None:
+        np_mask &= np_size >= min_size
+    if max_size is not None:
+        np_mask &= np_size <= max_size
+    if age_low is not None or age_high is not None:
+        if age_low is None:
+            age_low = 0
+        if age_high is None:
+            age_high = np.iinfo(np.int16).max - 1
+        # Households whose age span misses the range are dropped before counting.
+        np_mask &= (np.asarray(d_hh['age_max']) >= age_low) & (np.asarray(d_hh['age_min']) <= age_high)
+        np_hh_idx = np.nonzero(np_mask)[0]
+        np_cnt = household_member_cnt_in_age_range(d_hh, age_low, age_high, np_hh_idx)
+        np_hh_idx = np_hh_idx[np_cnt >= min_member_in_age]
+    else:
+        np_hh_idx = np.nonzero(np_mask)[0]
+    return np.asarray(d_hh['hid'][np_hh_idx])
+
+
+def query_5_household_1(d_hh, out_path):
+    """
+    The counterpart of 'query_5_neo4j_1' answered by the household index.
+    If 'out_path' is None, the results are only returned.
+    """
+    logging.critical('[query_5_household_1] Starts.')
+    timer_start = time.time()
+
+    np_hid = households_by_composition(d_hh, min_size=8, age_low=8, age_high=14)
+    df_ret = pd.DataFrame({'hid': np_hid})
+    if out_path is not None:
+        pd.to_pickle(df_ret, out_path)
+
+    logging.critical('[query_5_household_1] All done in %s secs.' % str(time.time() - timer_start))
+    return df_ret
+
+
+################################################################################
+#   PER-TICK DEGREE TABLES
+################################################################################
+# Degrees of each tick are materialized from the contact network file of the tick right after it is loaded, and
+# stored aligned to the sorted PIDs of the person trait file:
+#   <g_tick_degree_folder>/pid.npy:                     (int64) Sorted PIDs. Row i is for 'pid[i]'.
+#   <g_tick_degree_folder>/tick_<t>/in_deg.npy:         (int32) In-degree of each row at tick t.
+#   <g_tick_degree_folder>/tick_<t>/out_deg.npy:        (int32) Out-degree of each row at tick t.
+#   <g_tick_degree_folder>/tick_<t>/act_dict.json:      Activities at tick t. The code is the position.
+#   <g_tick_degree_folder>/tick_<t>/<dir>_deg_act_row.npy, <dir>_deg_act_code.npy, <dir>_deg_act_cnt.npy:
+#       Degrees split by activity as sorted (row, activity code, count) triples, where 'dir' is 'in' or 'out'.
+#       The activity of an in-edge is its 'trg_act', and that of an out-edge is its 'src_act'.
+# The initial contact network is stored as tick -1.
+def merge_key_counts(np_key, np_cnt):
+    """
+    Sum counts of equal keys. Return (sorted distinct keys, their counts).
+    """
+    np_key, np_inv = np.unique(np_key, return_inverse=True)
+    return np_key, np.bincount(np_inv, weights=np_cnt, minlength=len(np_key)).astype(np.int64)
+
+
+def tick_degrees_consumer(tick, out_folder=None):
+    """
+    (add_chunk, finish) materializing the degree tables of 'tick'. See 'run_cn_file_consumers'.
+    Per-activity degrees are kept as (row << 16 | activity code, count) pairs, merged whenever they double.
+    """
+    if out_folder is None:
+        out_folder = g_tick_degree_folder
+    pid_path = path.join(out_folder, 'pid.npy')
+    if path.exists(pid_path):
+        np_person_pid = np.load(pid_path)
+    else:
+        if not path.exists(out_folder):
+            os.makedirs(out_folder)
+        np_person_pid = read_person_pids(g_person_trait_path)
+        np.save(pid_path, np_person_pid)
+    num_person = len(np_person_pid)
+
+    timer_start = time.time()
+    d_act_code = dict()
+    d_state = {'num_edge': 0}
+    for deg_dir in ['in', 'out']:
+        d_state[deg_dir] = np.zeros(num_person, dtype=np.int64)
+        d_state[deg_dir + '_key'] = np.zeros(0, dtype=np.int64)
+        d_state[deg_dir + '_cnt'] = np.zeros(0, dtype=np.int64)
+        d_state[deg_dir + '_merged'] = 0
+
+    def add_chunk(d_chunk):
+        d_state['num_edge'] += len(d_chunk['trg_pid'])
+        for deg_dir, pid_col, act_col in [('in', 'trg_pid', 'trg_act'), ('out', 'src_pid', 'src_act')]:
+            np_row = pid_to_row(np_person_pid, d_chunk[pid_col])
+            np_act = encode_cn_acts(d_act_code, d_chunk[act_col])[np_row >= 0]
+            np_row = np_row[np_row >= 0]
+            d_state[deg_dir] += np.bincount(np_row, minlength=num_person)
+            np_key, np_cnt = np.unique((np_row << 16) | np_act, return_counts=True)
+            d_state[deg_dir + '_key'] = np.concatenate([d_state[deg_dir + '_key'], np_key])
+            d_state[deg_dir + '_cnt'] = np.concatenate([d_state[deg_dir + '_cnt'], np_cnt])
+            if len(d_state[deg_dir + '_key']) > 2 * d_state[deg_dir + '_merged']:
+                d_state[deg_dir + '_key'], d_state[deg_dir + '_cnt'] = \
+                    merge_key_counts(d_state[deg_dir + '_key'], d_state[deg_dir + '_cnt'])
+                d_state[deg_dir + '_merged'] = len(d_state[deg_dir + '_key'])
+
+    def finish():
+        tick_folder = path.join(out_folder, 'tick_%s' % tick)
+        if not path.exists(tick_folder):
+            os.makedirs(tick_folder)
+        for deg_dir in ['in', 'out']:
+            np_key, np_cnt = merge_key_counts(d_state[deg_dir + '_key'], d_state[deg_dir + '_cnt'])
+            np.save(path.join(tick_folder, '%s_deg.npy' % deg_dir), d_state[deg_dir].astype(np.int32))
+            np.save(path.join(tick_folder, '%s_deg_act_row.npy' % deg_dir), (np_key >> 16).astype(np.int64))
+            np.save(path.join(tick_folder, '%s_deg_act_code.npy' % deg_dir), (np_key & 0xFFFF).astype(np.int16))
+            np.save(path.join(tick_folder, '%s_deg_act_cnt.npy' % deg_dir), np_cnt.astype(np.int32))
+        l_act = sorted(d_act_code, key=lambda act: d_act_code[act])
+        with open(path.join(tick_folder, 'act_dict.json'), 'w+') as out_fd:
+            json.dump(l_act, out_fd)
+        logging.critical('[tick_degrees_consumer] Tick %s: %s edges done in %s secs.'
+                         % (tick, d_state['num_edge'], time.time() - timer_start))
+        return True
+
+    return add_chunk, finish
+
+
+def materialize_tick_degrees(tick, cn_file_path, out_folder=None):
+    """
+    Materialize the degree tables of 'tick' from its contact network file. See 'PER-TICK DEGREE TABLES'.
+    Return True if successes, False otherwise.
+    """
+    logging.critical('[materialize_tick_degrees] Tick %s starts.' % tick)
+    return run_cn_file_consumers(cn_file_path, [tick_degrees_consumer(tick, out_folder)])[0]
+
+
+def load_tick_degrees(tick, deg_folder=None):
+    """
+    Open the degree tables of 'tick'. Arrays are memory-mapped.
+    :return: dict
+        'pid', 'in_deg', 'out_deg', 'l_act', and the '<dir>_deg_act_*' arrays. None if not materialized.
+    """
+    if deg_folder is None:
+        deg_folder = g_tick_degree_folder
+    tick_folder = path.join(deg_folder, 'tick_%s' % tick)
+    if not path.exists(path.join(tick_folder, 'act_dict.json')):
+        return None
+
+    d_deg = {'pid': np.load(path.join(deg_folder, 'pid.npy'), mmap_mode='r')}
+    for deg_dir in ['in', 'out']:
+        d_deg['%s_deg' % deg_dir] = np.load(path.join(tick_folder, '%s_deg.npy' % deg_dir), mmap_mode='r')
+        for suffix in ['row', 'code', 'cnt']:
+            key = '%s_deg_act_%s' % (deg_dir, suffix)
+            d_deg[key] = np.load(path.join(tick_folder, '%s.npy' % key), mmap_mode='r')
+    with open(path.join(tick_folder, 'act_dict.json'), 'r') as in_fd:
+        d_deg['l_act'] = json.load(in_fd)
+    return d_deg
+
+
+def tick_degree_lookup(tick, l_pid, deg_dir='in', act=None, deg_folder=None):
+    """
+    Look up the degrees of the given PIDs at 'tick'.
+    :param
+        deg_dir: str
+            'in' or 'out'.
+    :param
+        act: str
+            If given, only edges of this activity are counted. See 'PER-TICK DEGREE TABLES'.
+    :return: pandas DataFrame
+        Columns: pid (int), deg (int)
+        None if the degree tables of 'tick' are not materialized.
+    """
+    d_deg = load_tick_degrees(tick, deg_folder)
+    if d_deg is None:
+        logging.error('[tick_degree_lookup] Degrees of tick %s are not materialized.' % tick)
+        return None
+
+    np_pid = np.unique(np.asarray(l_pid, dtype=np.int64))
+    np_row = pid_to_row(d_deg['pid'], np_pid)
+    np_pid = np_pid[np_row >= 0]
+    np_row = np_row[np_row >= 0]
+    if act is None:
+        np_deg = np.asarray(d_deg['%s_deg' % deg_dir][np_row], dtype=np.int64)
+    else:
+        np_deg = np.zeros(len(np_row), dtype=np.int64)
+        if act in d_deg['l_act']:
+            act_code = d_deg['l_act'].index(act)
+            np_act_row = np.asarray(d_deg['%s_deg_act_row' % deg_dir])
+            np_sel = np.asarray(d_deg['%s_deg_act_code' % deg_dir]) == act_code
+            np_act_row = np_act_row[np_sel]
+            np_act_cnt = np.asarray(d_deg['%s_deg_act_cnt' % deg_dir])[np_sel]
+            np_pos = np.searchsorted(np_act_row, np_row)
+            np_pos[np_pos >= len(np_act_row)] = 0
+            if len(np_act_row) > 0:
+                np_hit = np_act_row[np_pos] == np_row
+                np_deg[np_hit] = np_act_cnt[np_pos[np_hit]]
+    return pd.DataFrame({'pid': np_pid, 'deg': np_deg})
+
+
+def tick_degree_distribution(tick, l_pid=None, deg_dir='in', act=None, deg_folder=None):
+    """
+    Degree distribution at 'tick' over the given PIDs (all people if None).
+    :return: dict of int -> int
+        Degree -> number of people. None if the degree tables of 'tick' are not materialized.
+    """
+    if l_pid is None:
+        d_deg = load_tick_degrees(tick, deg_folder)
+        if d_deg is None:
+            return None
+        l_pid = d_deg['pid']
+    df_deg = tick_degree_lookup(tick, l_pid, deg_dir, act, deg_folder)
+    if df_deg is None:
+        return None
+    np_deg_val, np_cnt = np.unique(df_deg['deg'].to_numpy(), return_counts=True)
+    return {int(deg): int(cnt) for deg, cnt in zip(np_deg_val, np_cnt)}
+
+
+################################################################################
+#   APPROXIMATE DISTRIBUTION QUERIES
+################################################################################
+# A QuID (query inquiring about a distribution) is answered approximately by sampling core PIDs. Each sampled PID
+# is a unit contributing a histogram (e.g. durations of its incoming edges at a tick), i.e. edges are sampled as
+# clusters of their core PIDs. Units are drawn batch by batch, and the estimate is the weighted sum of the sampled
+# histograms normalized to a distribution. Confidence bands come from bootstrapping the sampled units. Sampling stops
+# when the budget is used up, or early when the Jensen-Shannon divergence between two successive estimates falls
+# below the tolerance.
+def normalize_dist(d_cnt):
+    total = float(sum(d_cnt.values()))
+    if total <= 0:
+        return dict()
+    return {key: val / total for key, val in d_cnt.items()}
+
+
+def js_divergence(d_p, d_q):
+    """
+    Jensen-Shannon divergence (base 2, in [0, 1]) between two distributions given as dict of value -> probability
+    or count. Both are normalized first.
+    """
+    d_p = normalize_dist(d_p)
+    d_q = normalize_dist(d_q)
+    l_key = sorted(set(d_p) | set(d_q))
+    if len(l_key) <= 0:
+        return 0.0
+    np_p = np.asarray([d_p.get(key, 0.0) for key in l_key])
+    np_q = np.asarray([d_q.get(key, 0.0) for key in l_key])
+    np_m = (np_p + np_q) / 2
+
+    def kl(np_a, np_b):
+        np_mask = np_a > 0
+        return float(np.sum(np_a[np_mask] * np.log2(np_a[np_mask] / np_b[np_mask])))
+
+    return (kl(np_p, np_m) + kl(np_q, np_m)) / 2
+
+
+def largest_remainder_alloc(d_share, total, d_cap=None):
+    """
+    Split 'total' into integers proportional to 'd_share' (key -> share) by the largest remainder method, so that
+    the parts sum up to 'total'. If 'd_cap' (key -> max part) is given, no part exceeds its cap, and what a capped
+    key cannot take is reallocated over the others. The sum is then min(total, sum of caps).
+    :return: dict
+        key -> int
+    """
+    d_alloc = {key: 0 for key in d_share}
+    if d_cap is None:
+        d_cap = {key: total for key in d_share}
+    left = min(total, sum(d_cap[key] for key in d_share))
+    while left > 0:
+        l_open = [key for key in d_share if d_alloc[key] < d_cap[key] and d_share[key] > 0]
+        if len(l_open) <= 0:
+            l_open = [key for key in d_share if d_alloc[key] < d_cap[key]]
+            d_share = {key: 1.0 for key in l_open}
+        share_sum = float(sum(d_share[key] for key in l_open))
+        d_quota = {key: left * d_share[key] / share_sum for key in l_open}
+        d_part = {key: min(int(d_quota[key]), d_cap[key] - d_alloc[key]) for key in l_open}
+        num_rest = left - sum(d_part.values())
+        for key in sorted(l_open, key=lambda key: d_quota[key] - int(d_quota[key]), reverse=True):
+            if num_rest <= 0:
+                break
+            if d_alloc[key] + d_part[key] < d_cap[key]:
+                d_part[key] += 1
+                num_rest -= 1
+        for key in l_open:
+            d_alloc[key] += d_part[key]
+        left -= sum(d_part.values())
+    return d_alloc
+
+
+def sample_units(l_unit, sample_size, rng, strategy='uniform', d_stratum=None, s_excluded=None):
+    """
+    Draw units without replacement.
+    :param
+        strategy: str
+            'uniform': Simple random sampling.
+            'stratified': Proportional allocation over strata given by 'd_stratum' (unit -> stratum), by the largest
+                          remainder method so that the sample size is never exceeded. A stratum without units left
+                          gives its share to the others.
+    :param
+        s_excluded: set
+            Units already drawn.
+    :return: list of (unit, weight)
+        The weight of a unit is the number of units left in its stratum divided by the number drawn from it for
+        'stratified', and 1 for 'uniform'. When sampling over several calls, use 'stratified_unit_weights' to
+        reweight all drawn units together.
+    """
+    if s_excluded is None:
+        s_excluded = set()
+    l_avail = [unit for unit in l_unit if unit not in s_excluded]
+    if strategy == 'uniform' or d_stratum is None:
+        np_idx = rng.choice(len(l_avail), size=min(sample_size, len(l_avail)), replace=False)
+        return [(l_avail[idx], 1.0) for idx in np_idx]
+    elif strategy == 'stratified':
+        d_stratum_unit = dict()
+        for unit in l_avail:
+            d_stratum_unit.setdefault(d_stratum.get(unit, None), []).append(unit)
+        d_stratum_size = dict()
+        for unit in l_unit:
+            stratum = d_stratum.get(unit, None)
+            d_stratum_size[stratum] = d_stratum_size.get(stratum, 0) + 1
+        d_alloc = largest_remainder_alloc({stratum: d_stratum_size[stratum] for stratum in d_stratum_unit},
+                                          sample_size,
+                                          {stratum: len(l_stratum_unit)
+                                           for stratum, l_stratum_unit in d_stratum_unit.items()})
+        l_sample = []
+        for stratum, l_stratum_unit in d_stratum_unit.items():
+            stratum_sample_size = d_alloc[stratum]
+            if stratum_sample_size <= 0:
+                continue
+            weight = len(l_stratum_unit) / float(stratum_sample_size)
+            np_idx = rng.choice(len(l_stratum_unit), size=stratum_sample_size, replace=False)
+            l_sample += [(l_stratum_unit[idx], weight) for idx in np_idx]
+        return l_sample
+    else:
+        raise Exception('[sample_units] strategy can only be "uniform" or "stratified"!')
+
+
+def stratified_unit_weights(l_unit, l_drawn, d_stratum):
+    """
+    Weights of all units drawn so far by 'sample_units' with 'stratified'. Each drawn unit stands for the size of
+    its stratum divided by the number of units drawn from the stratum, so that the strata keep their shares however
+    the draws are spread over rounds, including strata drawn out.
+    :return: list of float
+        Aligned with 'l_drawn'.
+    """
+    d_stratum_size = dict()
+    for unit in l_unit:
+        stratum = d_stratum.get(unit, None)
+        d_stratum_size[stratum] = d_stratum_size.get(stratum, 0) + 1
+    d_stratum_drawn = dict()
+    for unit in l_drawn:
+        stratum = d_stratum.get(unit, None)
+        d_stratum_drawn[stratum] = d_stratum_drawn.get(stratum, 0) + 1
+    return [d_stratum_size[d_stratum.get(unit, None)] / float(d_stratum_drawn[d_stratum.get(unit, None)])
+            for unit in l_drawn]
+
+
+def weighted_unit_dist(l_unit_hist, np_weight):
+    d_cnt = dict()
+    for d_hist, weight in zip(l_unit_hist, np_weight):
+        for key, cnt in d_hist.items():
+            d_cnt[key] = d_cnt.get(key, 0.0) + cnt * weight
+    return normalize_dist(d_cnt)
+
+
+def approx_distribution(l_unit, unit_hist_fn, budget, batch_size=None, strategy='uniform', d_stratum=None,
+                        tol=0.001, num_boot=200, conf=0.95, seed=None):
+    """
+    Estimate a distribution by sampling units. See 'APPROXIMATE DISTRIBUTION QUERIES'.
+    :param
+        l_unit: list
+            All units, typically core PIDs.
+    :param
+        unit_hist_fn: function
+            Takes a list of units, and returns dict of unit -> (dict of value -> count).
+    :param
+        budget: int
+            The max number of units to be sampled.
+    :param
+        batch_size: int
+            The number of units sampled per round. 1/10 of 'budget' if None.
+    :param
+        tol: float
+            Early stop once the JS divergence between two successive estimates is below 'tol'. None to disable.
+    :return: (pandas DataFrame, dict)
+        DataFrame: Columns: value, p_est, p_low, p_high. Sorted by value.
+        dict: 'num_unit', 'num_sampled', 'num_round', 'stopped_early', 'last_js_div', 'secs'.
+    """
+    timer_start = time.time()
+    rng = np.random.default_rng(seed)
+    if batch_size is None:
+        batch_size = max(1, budget // 10)
+    budget = min(budget, len(l_unit))
+
+    s_drawn = set()
+    l_drawn = []
+    l_unit_hist = []
+    l_weight = []
+    d_prev_est = None
+    js_div = None
+    stopped_early = False
+    num_round = 0
+    while len(s_drawn) < budget:
+        l_sample = sample_units(l_unit, min(batch_size, budget - len(s_drawn)), rng, strategy, d_stratum, s_drawn)
+        if len(l_sample) <= 0:
+            break
+        num_round += 1
+        d_unit_hist = unit_hist_fn([unit for unit, _ in l_sample])
+        for unit, weight in l_sample:
+            s_drawn.add(unit)
+            l_drawn.append(unit)
+            l_unit_hist.append(d_unit_hist.get(unit, dict()))
+            l_weight.append(weight)
+        if strategy == 'stratified' and d_stratum is not None:
+            l_weight = stratified_unit_weights(l_unit, l_drawn, d_stratum)
+        d_est = weighted_unit_dist(l_unit_hist, l_weight)
+        if d_prev_est is not None:
+            js_div = js_divergence(d_prev_est, d_est)
+            if tol is not None and js_div < tol:
+                stopped_early = len(s_drawn) < budget
+                break
+        d_prev_est = d_est
+
+    d_est = weighted_unit_dist(l_unit_hist, l_weight)
+    l_value = sorted(d_est)
+    np_boot = np.zeros((num_boot, len(l_value)))
+    np_weight = np.asarray(l_weight)
+    d_value_idx = {value: idx for idx, value in enumerate(l_value)}
+    for boot_idx in range(num_boot):
+        np_idx = rng.integers(0, len(l_unit_hist), size=len(l_unit_hist)) if len(l_unit_hist) > 0 else []
+        d_boot = weighted_unit_dist([l_unit_hist[idx] for idx in np_idx], np_weight[np_idx])
+        for value, prob in d_boot.items():
+            np_boot[boot_idx, d_value_idx[value]] = prob
+    alpha = (1 - conf) / 2
+    df_est = pd.DataFrame({'value': l_value,
+                           'p_est': [d_est[value] for value in l_value],
+                           'p_low': np.quantile(np_boot, alpha, axis=0) if len(l_value) > 0 else [],
+                           'p_high': np.quantile(np_boot, 1 - alpha, axis=0) if len(l_value) > 0 else []})
+    d_info = {'num_unit': len(l_unit), 'num_sampled': len(s_drawn), 'num_round': num_round,
+              'stopped_early': stopped_early, 'last_js_div': js_div, 'secs': time.time() - timer_start}
+    return df_est, d_info
+
+
+def neo4j_unit_duration_hist_fn(neo4j_driver, tick):
+    """
+    Unit histogram function for 'approx_distribution': durations of the incoming edges of each PID at 'tick'.
+    """
+    neo4j_session_config = {'database': g_neo4j_db_name}
+    query_str = '''unwind $l_pid as pid
+                   match (n:PERSON {pid: pid})
+                   match ()-[r:CONTACT]->(n) where r.occur = $tick
+                   return pid, r.duration, count(*)'''
+
+    def unit_hist_fn(l_pid):
+        l_ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [query_str],
+                                      l_query_param=[{'l_pid': l_pid, 'tick': tick}], need_ret=True)
+        if l_ret is None:
+            raise Exception('[neo4j_unit_duration_hist_fn] Neo4j query failed at tick %s.' % tick)
+        d_unit_hist = dict()
+        for rec in l_ret[0]:
+            d_unit_hist.setdefault(int(rec[0]), dict())[int(rec[1])] = int(rec[2])
+        return d_unit_hist
+
+    return unit_hist_fn
+
+
+def neo4j_unit_in_degree_hist_fn(neo4j_driver, tick):
+    """
+    Unit histogram function for 'approx_distribution': the in-degree of each PID at 'tick'.
+    """
+    neo4j_session_config = {'database': g_neo4j_db_name}
+    query_str = '''unwind $l_pid as pid
+                   match (n:PERSON {pid: pid})
+                   optional match ()-[r:CONTACT]->(n) where r.occur = $tick
+                   return pid, count(r)'''
+
+    def unit_hist_fn(l_pid):
+        l_ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [query_str],
+                                      l_query_param=[{'l_pid': l_pid, 'tick': tick}], need_ret=True)
+        if l_ret is None:
+            raise Exception('[neo4j_unit_in_degree_hist_fn] Neo4j query failed at tick %s.' % tick)
+        return {int(rec[0]): {int(rec[1]): 1} for rec in l_ret[0]}
+
+    return unit_hist_fn
+
+
+def neo4j_unit_age_hist_fn(neo4j_driver):
+    """
+    Unit histogram function for 'approx_distribution': the age of each PID.
+    """
+    neo4j_session_config = {'database': g_neo4j_db_name}
+    query_str = '''unwind $l_pid as pid
+                   match (n:PERSON {pid: pid})
+                   return pid, n.age'''
+
+    def unit_hist_fn(l_pid):
+        l_ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [query_str],
+                                      l_query_param=[{'l_pid': l_pid}], need_ret=True)
+        if l_ret is None:
+            raise Exception('[neo4j_unit_age_hist_fn] Neo4j query failed.')
+        return {int(rec[0]): {int(rec[1]): 1} for rec in l_ret[0]}
+
+    return unit_hist_fn
+
+
+def csr_unit_duration_hist_fn(d_csr, tick):
+    """
+    The CSR counterpart of 'neo4j_unit_duration_hist_fn'.
+    """
+    def unit_hist_fn(l_pid):
+        df_edge = csr_in_1nn(d_csr, tick, l_pid)
+        d_unit_hist = dict()
+        for (trg_pid, duration), cnt in df_edge.groupby(['trg_pid', 'duration']).size().items():
+            d_unit_hist.setdefault(int(trg_pid), dict())[int(duration)] = int(cnt)
+        return d_unit_hist
+
+    return unit_hist_fn
+
+
+def duration_hist_fn_by_tick(neo4j_driver, d_csr=None):
+    """
+    Returns a function taking a tick and returning the duration unit histogram function at the tick, on the CSR
+    contact network if 'd_csr' is given and on Neo4j otherwise.
+    """
+    def unit_hist_fn_by_tick(tick):
+        if d_csr is not None:
+            return csr_unit_duration_hist_fn(d_csr, tick)
+        return neo4j_unit_duration_hist_fn(neo4j_driver, tick)
+
+    return unit_hist_fn_by_tick
+
+
+def approx_duration_distribution(unit_hist_fn_by_tick, df_output_pid_over_time, budget, l_t=None, **kwargs):
+    """
+    The approximate counterpart of 'duration_distribution'.
+    :param
+        unit_hist_fn_by_tick: function
+            Takes a tick and returns a unit histogram function, e.g. returned by 'duration_hist_fn_by_tick'.
+    :param
+        kwargs:
+            Passed to 'approx_distribution'.
+    :return: pandas DataFrame
+        Index: tick (int)
+        Columns: duration_dist_est (pandas DataFrame returned by 'approx_distribution'), info (dict)
+    """
+    logging.critical('[approx_duration_distribution] Starts.')
+    timer_start = time.time()
+
+    if l_t is None:
+        l_t = df_output_pid_over_time.index.to_list()
+
+    l_dist_rec = []
+    for tick, pid_rec in df_output_pid_over_time.loc[l_t].iterrows():
+        l_core_pid = list(set(pid_rec['pid']))
+        df_est, d_info = approx_distribution(l_core_pid, unit_hist_fn_by_tick(tick), budget, **kwargs)
+        logging.critical('[approx_duration_distribution] Tick %s: %s' % (tick, d_info))
+        l_dist_rec.append((tick, df_est, d_info))
+
+    df_dist = pd.DataFrame(l_dist_rec, columns=['tick', 'duration_dist_est', 'info'])
+    df_dist = df_dist.set_index('tick')
+    logging.critical('[approx_duration_distribution] All done in %s secs.' % str(time.time() - timer_start))
+    return df_dist
+
+
+################################################################################
+#   SSAQF BENCHMARKING
+################################################################################
+# The Sample-Size Approximation-Quality Function (SSAQF) of a QuID maps the sample size to the divergence between the
+# approximate answer and the exact one. The harness computes the histogram of every unit once (the exact answer is
+# their sum), and then re-runs the query on samples of increasing size with several sampling strategies. Samples are
+# evaluated in parallel across a process pool.
+g_ssaqf_unit_hist = None
+g_ssaqf_d_stratum = None
+g_ssaqf_d_exact = None
+
+
+def wasserstein_distance_1d(d_p, d_q):
+    """
+    1st Wasserstein distance between two distributions over numeric values given as dict of value -> prob or count.
+    """
+    d_p = normalize_dist(d_p)
+    d_q = normalize_dist(d_q)
+    np_val = np.asarray(sorted(set(d_p) | set(d_q)), dtype=np.float64)
+    if len(np_val) <= 1:
+        return 0.0
+    np_cdf_p = np.cumsum([d_p.get(val, 0.0) for val in np_val])
+    np_cdf_q = np.cumsum([d_q.get(val, 0.0) for val in np_val])
+    return float(np.sum(np.abs(np_cdf_p - np_cdf_q)[:-1] * np.diff(np_val)))
+
+
+def energy_distance_1d(d_p, d_q):
+    """
+    Energy distance between two distributions over numeric values given as dict of value -> prob or count.
+    In 1D, it is sqrt(2 * integral of (F_p - F_q)^2).
+    """
+    d_p = normalize_dist(d_p)
+    d_q = normalize_dist(d_q)
+    np_val = np.asarray(sorted(set(d_p) | set(d_q)), dtype=np.float64)
+    if len(np_val) <= 1:
+        return 0.0
+    np_cdf_p = np.cumsum([d_p.get(val, 0.0) for val in np_val])
+    np_cdf_q = np.cumsum([d_q.get(val, 0.0) for val in np_val])
+    return float(np.sqrt(2 * np.sum(((np_cdf_p - np_cdf_q) ** 2)[:-1] * np.diff(np_val))))
+
+
+def ssaqf_init_worker(d_unit_hist, d_stratum, d_exact):
+    global g_ssaqf_unit_hist, g_ssaqf_d_stratum, g_ssaqf_d_exact
+    g_ssaqf_unit_hist = d_unit_hist
+    g_ssaqf_d_stratum = d_stratum
+    g_ssaqf_d_exact = d_exact
+
+
+def ssaqf_single_task(task):
+    """
+    Evaluate one sample. 'task' is (strategy, sample_size, rep, seed).
+    """
+    strategy, sample_size, rep, seed = task
+    d_exact = g_ssaqf_d_exact
+    rng = np.random.default_rng(seed)
+    l_unit = list(g_ssaqf_unit_hist.keys())
+    l_sample = sample_units(l_unit, sample_size, rng, strategy, g_ssaqf_d_stratum)
+    d_est = weighted_unit_dist([g_ssaqf_unit_hist[unit] for unit, _ in l_sample], [weight for _, weight in l_sample])
+    return (strategy, sample_size, rep, len(l_sample), js_divergence(d_exact, d_est),
+            wasserstein_distance_1d(d_exact, d_est), energy_distance_1d(d_exact, d_est))
+
+
+def ssaqf_curve(d_unit_hist, l_sample_size, l_strategy=('uniform',), d_stratum=None, num_rep=10, seed=0,
+                num_proc=None):
+    """
+    Compute the SSAQF of a QuID given the histograms of all its units.
+    :param
+        d_unit_hist: dict
+            Unit -> (dict of value -> count). The exact answer is the sum over all units.
+    :param
+        l_sample_size: list of int
+            Sample sizes in units.
+    :param
+        l_strategy: list of str
+            See 'sample_units'. 'stratified' requires 'd_stratum'.
+    :param
+        num_rep: int
+            Number of samples per (strategy, sample size).
+    :return: (pandas DataFrame, pandas DataFrame)
+        Raw: Columns: strategy, sample_size, rep, num_sampled, js, wasserstein, energy.
+        Curve: Mean and std of the divergences grouped by (strategy, sample_size).
+    """
+    logging.critical('[ssaqf_curve] Starts.')
+    timer_start = time.time()
+
+    if num_proc is None:
+        num_proc = g_concurrency
+    d_exact = weighted_unit_dist(list(d_unit_hist.values()), [1.0] * len(d_unit_hist))
+    np_seed = np.random.default_rng(seed).integers(0, 2 ** 31, size=len(l_strategy) * len(l_sample_size) * num_rep)
+    l_task = []
+    for strategy in l_strategy:
+        for sample_size in l_sample_size:
+            for rep in range(num_rep):
+                l_task.append((strategy, sample_size, rep, int(np_seed[len(l_task)])))
+
+    with multiprocessing.Pool(processes=num_proc, initializer=ssaqf_init_worker,
+                              initargs=(d_unit_hist, d_stratum, d_exact)) as pool:
+        l_ret = pool.map(ssaqf_single_task, l_task)
+
+    df_raw = pd.DataFrame(l_ret, columns=['strategy', 'sample_size', 'rep', 'num_sampled', 'js', 'wasserstein',
+                                          'energy'])
+    df_curve = df_raw.groupby(['strategy', 'sample_size'])[['js', 'wasserstein', 'energy']].agg(['mean', 'std'])
+    logging.critical('[ssaqf_curve] All done with %s samples in %s secs.' % (len(l_task), time.time() - timer_start))
+    return df_raw, df_curve
+
+
+def ssaqf_duration_distribution(unit_hist_fn_by_tick, df_output_pid_over_time, l_sample_size, out_folder, l_t=None,
+                                l_strategy=('uniform', 'stratified'), num_rep=10, num_deg_stratum=4):
+    """
+    Run the SSAQF harness on 'duration_distribution' for each tick in 'l_t'. For 'stratified', core PIDs are
+    stratified by the quantiles of their in-degrees at the tick.
+    The raw results and the curves of each tick are pickled into 'out_folder'.
+    """
+    logging.critical('[ssaqf_duration_distribution] Starts.')
+    timer_start = time.time()
+
+    if l_t is None:
+        l_t = df_output_pid_over_time.index.to_list()
+    if not path.exists(out_folder):
+        os.makedirs(out_folder)
+
+    for tick, pid_rec in df_output_pid_over_time.loc[l_t].iterrows():
+        l_core_pid = list(set(pid_rec['pid']))
+        d_unit_hist = unit_hist_fn_by_tick(tick)(l_core_pid)
+        for pid in l_core_pid:
+            if pid not in d_unit_hist:
+                d_unit_hist[pid] = dict()
+        l_pid = list(d_unit_hist.keys())
+        np_deg = np.asarray([sum(d_unit_hist[pid].values()) for pid in l_pid])
+        np_edge = np.unique(np.quantile(np_deg, np.linspace(0, 1, num_deg_stratum + 1)[1:-1])) \
+            if len(np_deg) > 0 else []
+        d_stratum = {pid: int(stratum) for pid, stratum in zip(l_pid, np.digitize(np_deg, np_edge))}
+        l_sample_size_at_t = [size for size in l_sample_size if size <= len(l_pid)]
+        df_raw, df_curve = ssaqf_curve(d_unit_hist, l_sample_size_at_t, l_strategy, d_stratum, num_rep)
+        pd.to_pickle(df_raw, path.join(out_folder, 'ssaqf_duration_raw_t%s.pickle' % tick))
+        pd.to_pickle(df_curve, path.join(out_folder, 'ssaqf_duration_curve_t%s.pickle' % tick))
+        logging.critical('[ssaqf_duration_distribution] Tick %s:\n%s' % (tick, df_curve))
+
+    logging.critical('[ssaqf_duration_distribution] All done in %s secs.' % str(time.time() - timer_start))
+
+
+################################################################################
+#   LOAD-TIME SKETCHES
+################################################################################
+# Mergeable sketches are built incrementally from the post-load pass over each tick (see 'process_loaded_tick'), and
+# persisted per tick as '<g_sketch_folder>/tick_<t>.npz':
+#   hll_pid:    HyperLogLog registers of the distinct people having contacts.
+#   hll_pair:   HyperLogLog registers of the distinct (source, target) contact pairs.
+#   cm:         Count-min sketch of activity frequencies with keys 'src:<act>', 'trg:<act>' and 'pair:<src>|<trg>'.
+#   td_mean, td_weight: Centroids of the t-digest of durations.
+#   act:        Activities seen at the tick. Used to enumerate count-min keys.
+#   num_edge:   Number of edges.
+# People are sketched once at node load as '<g_sketch_folder>/person.npz':
+#   hll_hid:    HyperLogLog registers of the distinct households.
+#   cm:         Count-min sketch with keys 'age_group:<g>' and 'gender:<g>'.
+#   age_group, gender: Values seen. Used to enumerate count-min keys.
+#   num_person: Number of people.
+# Sketches of ticks merge by 'np.maximum' (HLL), '+' (count-min) and re-compression (t-digest).
+g_hll_precision = 14
+g_cm_depth = 4
+g_cm_width = 2 ** 16
+g_td_compression = 200
+g_uint64_mask = 2 ** 64 - 1
+
+
+def hash64(np_key, seed=0):
+    """
+    SplitMix64 finalizer over an int array. Returns uint64 hashes.
+    """
+    offset = np.uint64((0x9E3779B97F4A7C15 * (seed + 1)) & g_uint64_mask)
+    with np.errstate(over='ignore'):
+        np_z = np.asarray(np_key).astype(np.uint64) + offset
+        np_z = (np_z ^ (np_z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        np_z = (np_z ^ (np_z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        np_z = np_z ^ (np_z >> np.uint64(31))
+    return np_z
+
+
+def str_keys_to_int(l_key):
+    return np.asarray([zlib.crc32(key.encode('utf-8')) for key in l_key], dtype=np.int64)
+
+
+def bit_length64(np_val):
+    np_val = np_val.copy()
+    np_len = np.zeros(len(np_val), dtype=np.int64)
+    for shift in [32, 16, 8, 4, 2, 1]:
+        np_mask = np_val >= (np.uint64(1) << np.uint64(shift))
+        np_val[np_mask] >>= np.uint64(shift)
+        np_len[np_mask] += shift
+    np_len += (np_val > 0)
+    return np_len
+
+
+def hll_new():
+    return np.zeros(2 ** g_hll_precision, dtype=np.uint8)
+
+
+def hll_add(np_reg, np_key):
+    """
+    Add int keys to HyperLogLog registers in place.
+    """
+    if len(np_key) <= 0:
+        return np_reg
+    np_hash = hash64(np_key)
+    num_rest_bit = 64 - g_hll_precision
+    np_idx = (np_hash >> np.uint64(num_rest_bit)).astype(np.int64)
+    np_rest = np_hash & np.uint64((1 << num_rest_bit) - 1)
+    np_rank = (num_rest_bit - bit_length64(np_rest) + 1).astype(np.uint8)
+    np.maximum.at(np_reg, np_idx, np_rank)
+    return np_reg
+
+
+def hll_estimate(np_reg):
+    num_reg = len(np_reg)
+    alpha = 0.7213 / (1 + 1.079 / num_reg)
+    est = alpha * num_reg * num_reg / np.sum(np.power(2.0, -np_reg.astype(np.float64)))
+    num_zero = int(np.count_nonzero(np_reg == 0))
+    if est <= 2.5 * num_reg and num_zero > 0:
+        est = num_reg * math.log(num_reg / num_zero)
+    return est
+
+
+def cm_new():
+    return np.zeros((g_cm_depth, g_cm_width), dtype=np.int64)
+
+
+def cm_add(np_cm, np_key, np_cnt=None):
+    """
+    Add int keys to a count-min sketch in place.
+    """
+    if np_cnt is None:
+        np_cnt = np.ones(len(np_key), dtype=np.int64)
+    for depth in range(g_cm_depth):
+        np_idx = (hash64(np_key, seed=depth + 1) % np.uint64(g_cm_width)).astype(np.int64)
+        np.add.at(np_cm[depth], np_idx, np_cnt)
+    return np_cm
+
+
+def cm_query(np_cm, np_key):
+    np_est = None
+    for depth in range(g_cm_depth):
+        np_idx = (hash64(np_key, seed=depth + 1) % np.uint64(g_cm_width)).astype(np.int64)
+        np_row_est = np_cm[depth][np_idx]
+        np_est = np_row_est if np_est is None else np.minimum(np_est, np_row_est)
+    return np_est
+
+
+def td_compress(np_mean, np_weight, compression=None):
+    """
+    Compress weighted points (or centroids) into t-digest centroids with the k1 scale function, i.e. each centroid
+    covers at most one unit of k(q) = compression / (2 * pi) * asin(2 * q - 1).
+    """
+    if compression is None:
+        compression = g_td_compression
+    if len(np_mean) <= 0:
+        return np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.float64)
+    np_order = np.argsort(np_mean, kind='stable')
+    np_mean = np.asarray(np_mean, dtype=np.float64)[np_order]
+    np_weight = np.asarray(np_weight, dtype=np.float64)[np_order]
+    np_cum = np.cumsum(np_weight)
+    np_q = (np_cum - np_weight / 2) / np_cum[-1]
+    np_k = compression / (2 * math.pi) * np.arcsin(2 * np_q - 1)
+    np_cid = np.floor(np_k - np_k[0]).astype(np.int64)
+    _, np_cid = np.unique(np_cid, return_inverse=True)
+    np_c_weight = np.bincount(np_cid, weights=np_weight)
+    np_c_mean = np.bincount(np_cid, weights=np_mean * np_weight) / np_c_weight
+    return np_c_mean, np_c_weight
+
+
+def td_quantile(np_mean, np_weight, l_q):
+    if len(np_mean) <= 0:
+        return [None] * len(l_q)
+    np_cum_mid = np.cumsum(np_weight) - np.asarray(np_weight) / 2
+    return [float(val) for val in np.interp(np.asarray(l_q) * np.sum(np_weight), np_cum_mid, np_mean)]
+
+
+def tick_sketches_consumer(tick, out_folder=None):
+    """
+    (add_chunk, finish) building the sketches of 'tick'. See 'run_cn_file_consumers'.
+    All sketches are updated chunk by chunk: HLL registers take each chunk, activity pairs are counted exactly (as
+    activities are few) and added to the count-min sketch at the end, and the t-digest re-compresses its centroids
+    with each chunk.
+    """
+    if out_folder is None:
+        out_folder = g_sketch_folder
+    if not path.exists(out_folder):
+        os.makedirs(out_folder)
+
+    timer_start = time.time()
+    d_act_code = dict()
+    d_pair_cnt = dict()
+    d_state = {'num_edge': 0, 'hll_pid': hll_new(), 'hll_pair': hll_new(),
+               'td_mean': np.zeros(0, dtype=np.float64), 'td_weight': np.zeros(0, dtype=np.float64)}
+
+    def add_chunk(d_chunk):
+        np_trg_pid = d_chunk['trg_pid']
+        np_src_pid = d_chunk['src_pid']
+        d_state['num_edge'] += len(np_trg_pid)
+        hll_add(hll_add(d_state['hll_pid'], np_trg_pid), np_src_pid)
+        with np.errstate(over='ignore'):
+            np_pair_key = hash64(np_src_pid, seed=101) ^ np_trg_pid.astype(np.uint64)
+        hll_add(d_state['hll_pair'], np_pair_key)
+
+        np_act_key = (encode_cn_acts(d_act_code, d_chunk['src_act']) << 16) \
+            | encode_cn_acts(d_act_code, d_chunk['trg_act'])
+        np_key, np_cnt = np.unique(np_act_key, return_counts=True)
+        for key, cnt in zip(np_key.tolist(), np_cnt.tolist()):
+            d_pair_cnt[key] = d_pair_cnt.get(key, 0) + cnt
+
+        np_duration = d_chunk['duration'].astype(np.float64)
+        d_state['td_mean'], d_state['td_weight'] = \
+            td_compress(np.concatenate([d_state['td_mean'], np_duration]),
+                        np.concatenate([d_state['td_weight'], np.ones(len(np_duration), dtype=np.float64)]))
+
+    def finish():
+        l_act = sorted(d_act_code, key=lambda act: d_act_code[act])
+        d_act_cnt = dict()
+        for key, cnt in d_pair_cnt.items():
+            src_act = l_act[key >> 16]
+            trg_act = l_act[key & 0xFFFF]
+            for act_key in ['pair:%s|%s' % (src_act, trg_act), 'src:' + src_act, 'trg:' + trg_act]:
+                d_act_cnt[act_key] = d_act_cnt.get(act_key, 0) + cnt
+        np_cm = cm_add(cm_new(), str_keys_to_int(list(d_act_cnt.keys())),
+                       np.asarray(list(d_act_cnt.values()), dtype=np.int64))
+        np.savez(path.join(out_folder, 'tick_%s.npz' % tick), hll_pid=d_state['hll_pid'],
+                 hll_pair=d_state['hll_pair'], cm=np_cm, td_mean=d_state['td_mean'], td_weight=d_state['td_weight'],
+                 act=np.asarray(sorted(l_act), dtype=str), num_edge=np.asarray(d_state['num_edge']))
+        logging.critical('[tick_sketches_consumer] Tick %s: %s edges done in %s secs.'
+                         % (tick, d_state['num_edge'], time.time() - timer_start))
+        return True
+
+    return add_chunk, finish
+
+
+def build_tick_sketches(tick, cn_file_path, out_folder=None):
+    """
+    Build the sketches of 'tick' from its contact network file. See 'LOAD-TIME SKETCHES'.
+    Return True if successes, False otherwise.
+    """
+    logging.critical('[build_tick_sketches] Tick %s starts.' % tick)
+    return run_cn_file_consumers(cn_file_path, [tick_sketches_consumer(tick, out_folder)])[0]
+
+
+def build_person_sketches(out_folder=None):
+    """
+    Build the sketches of people from the person trait file. See 'LOAD-TIME SKETCHES'.
+    Return True if successes, False otherwise.
+    """
+    logging.critical('[build_person_sketches] Starts.')
+    timer_start = time.time()
+
+    if out_folder is None:
+        out_folder = g_sketch_folder
+    if not path.exists(out_folder):
+        os.makedirs(out_folder)
+
+    l_hid = []
+    d_key_cnt = dict()
+    s_age_group = set()
+    s_gender = set()
+    with open(g_person_trait_path, 'r') as in_fd:
+        csv_reader = csv.reader(in_fd, delimiter=',')
+        for row_idx, row in enumerate(csv_reader):
+            if row_idx == 0:
+                continue
+            l_hid.append(int(row[1]))
+            s_age_group.add(row[3])
+            s_gender.add(row[4])
+            for key in ['age_group:' + row[3], 'gender:' + row[4]]:
+                d_key_cnt[key] = d_key_cnt.get(key, 0) + 1
+
+    np_hll_hid = hll_add(hll_new(), np.asarray(l_hid, dtype=np.int64))
+    np_cm = cm_add(cm_new(), str_keys_to_int(list(d_key_cnt.keys())),
+                   np.asarray(list(d_key_cnt.values()), dtype=np.int64))
+    np.savez(path.join(out_folder, 'person.npz'), hll_hid=np_hll_hid, cm=np_cm,
+             age_group=np.asarray(sorted(s_age_group), dtype=str), gender=np.asarray(sorted(s_gender), dtype=str),
+             num_person=np.asarray(len(l_hid)))
+    logging.critical('[build_person_sketches] All done in %s secs.' % str(time.time() - timer_start))
+    return True
+
+
+def load_tick_sketches(l_tick, sketch_folder=None):
+    """
+    Load and merge the sketches of the given ticks. Ticks without sketches are skipped.
+    :return: dict
+        Same keys as the persisted sketches, plus 'l_tick' (list of int) for the merged ticks.
+        None if no tick has sketches.
+    """
+    if sketch_folder is None:
+        sketch_folder = g_sketch_folder
+
+    d_sketch = None
+    for tick in l_tick:
+        sketch_path = path.join(sketch_folder, 'tick_%s.npz' % tick)
+        if not path.exists(sketch_path):
+            logging.error('[load_tick_sketches] No sketches for tick %s.' % tick)
+            continue
+        with np.load(sketch_path) as npz_sketch:
+            d_tick = {key: npz_sketch[key] for key in npz_sketch.files}
+        if d_sketch is None:
+            d_sketch = d_tick
+            d_sketch['l_tick'] = [tick]
+            continue
+        d_sketch['hll_pid'] = np.maximum(d_sketch['hll_pid'], d_tick['hll_pid'])
+        d_sketch['hll_pair'] = np.maximum(d_sketch['hll_pair'], d_tick['hll_pair'])
+        d_sketch['cm'] = d_sketch['cm'] + d_tick['cm']
+        d_sketch['td_mean'], d_sketch['td_weight'] = \
+            td_compress(np.concatenate((d_sketch['td_mean'], d_tick['td_mean'])),
+                        np.concatenate((d_sketch['td_weight'], d_tick['td_weight'])))
+        d_sketch['act'] = np.union1d(d_sketch['act'], d_tick['act'])
+        d_sketch['num_edge'] = d_sketch['num_edge'] + d_tick['num_edge']
+        d_sketch['l_tick'].append(tick)
+    return d_sketch
+
+
+def sketch_stats_distinct(l_tick):
+    """
+    Estimated distinct people having contacts and distinct contact pairs over the given ticks.
+    """
+    d_sketch = load_tick_sketches(l_tick)
+    if d_sketch is None:
+        return None
+    return {'num_edge': int(d_sketch['num_edge']),
+            'distinct_pid': hll_estimate(d_sketch['hll_pid']),
+            'distinct_pair': hll_estimate(d_sketch['hll_pair'])}
+
+
+def sketch_stats_act_dist(l_tick, role='src'):
+    """
+    Estimated activity frequencies over the given ticks. The sketch counterpart of 'src_act_dist' in neo4j_test.py.
+    :param
+        role: str
+            'src', 'trg' or 'pair'.
+    :return: dict
+        Activity (or 'src|trg' for 'pair') -> frequency.
+    """
+    d_sketch = load_tick_sketches(l_tick)
+    if d_sketch is None:
+        return None
+    l_act = [str(act) for act in d_sketch['act']]
+    if role == 'pair':
+        l_key_val = ['%s|%s' % (src_act, trg_act) for src_act in l_act for trg_act in l_act]
+    else:
+        l_key_val = l_act
+    np_est = cm_query(d_sketch['cm'], str_keys_to_int(['%s:%s' % (role, key_val) for key_val in l_key_val]))
+    return {key_val: int(est) for key_val, est in zip(l_key_val, np_est) if est > 0}
+
+
+def sketch_stats_duration_quantiles(l_tick, l_q=(0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99)):
+    d_sketch = load_tick_sketches(l_tick)
+    if d_sketch is None:
+        return None
+    return dict(zip(l_q, td_quantile(d_sketch['td_mean'], d_sketch['td_weight'], l_q)))
+
+
+def sketch_stats_population_dist(prop='age_group', sketch_folder=None):
+    """
+    Estimated population by 'age_group' or 'gender'. The sketch counterpart of 'population_dist_by_age_group' in
+    neo4j_test.py.
+    """
+    if sketch_folder is None:
+        sketch_folder = g_sketch_folder
+    sketch_path = path.join(sketch_folder, 'person.npz')
+    if not path.exists(sketch_path):
+        logging.error('[sketch_stats_population_dist] No person sketches in %s.' % sketch_folder)
+        return None
+    with np.load(sketch_path) as npz_sketch:
+        l_val = [str(val) for val in npz_sketch[prop]]
+        np_est = cm_query(npz_sketch['cm'], str_keys_to_int(['%s:%s' % (prop, val) for val in l_val]))
+        num_hh = hll_estimate(npz_sketch['hll_hid'])
+    logging.critical('[sketch_stats_population_dist] Estimated %s households.' % num_hh)
+    return {val: int(est) for val, est in zip(l_val, np_est)}
+
+
+################################################################################
+#   STATISTICS CATALOG
+################################################################################
+# Exact counts maintained as nodes and ticks are loaded, stored in the SQLite DB 'g_stats_catalog_db_path':
+#   stats_catalog (scope, tick, key, value, cnt)
+#       scope = 'node': tick = NULL_TICK, key is a PERSON property, cnt is the number of people with the value.
+#       scope = 'edge': tick is the tick, key is one of
+#                       'all' (value ''): number of edges,
+#                       'src_act', 'trg_act': number of edges with the activity,
+#                       'act_pair' (value '<src_act>|<trg_act>'): number of edges with the activity pair.
+# Reloading the nodes or a tick replaces its counts, so the updates are idempotent.
+g_stats_catalog_tb_name = 'stats_catalog'
+g_stats_catalog_null_tick = -999999
+g_l_stats_catalog_node_prop = ['age', 'age_group', 'gender', 'fips', 'admin1', 'admin2', 'admin3', 'admin4']
+
+
+def connect_to_stats_catalog():
+    """
+    Open the statistics catalog, creating its table if necessary. The timeout allows concurrent loaders.
+    """
+    db_con = connect_to_sqlite(g_stats_catalog_db_path, timeout=600)
+    sql_str = '''create table if not exists %s
+                 (
+                    scope text not null,
+                    tick integer not null,
+                    key text not null,
+                    value text not null,
+                    cnt integer not null,
+                    primary key (scope, tick, key, value)
+                 ) without rowid
+              ''' % g_stats_catalog_tb_name
+    db_con.execute(sql_str)
+    return db_con
+
+
+def replace_stats_catalog_scope(scope, tick, d_cnt):
+    """
+    Replace the counts of (scope, tick) by 'd_cnt' in one transaction.
+    :param
+        d_cnt: dict
+            (key, value) -> cnt
+    Return True if successes, False otherwise.
+    """
+    try:
+        db_con = connect_to_stats_catalog()
+    except Exception as e:
+        logging.error('[replace_stats_catalog_scope] %s' % e)
+        return False
+
+    sql_str_del = '''delete from %s where scope=? and tick=?''' % g_stats_catalog_tb_name
+    sql_str_ins = '''insert into %s (scope, tick, key, value, cnt) values (?,?,?,?,?)''' % g_stats_catalog_tb_name
+    try:
+        with db_con:
+            db_con.execute(sql_str_del, (scope, tick))
+            db_con.executemany(sql_str_ins, [(scope, tick, key, str(value), cnt)
+                                             for (key, value), cnt in d_cnt.items()])
+    except Exception as e:
+        logging.error('[replace_stats_catalog_scope] %s' % e)
+        return False
+    finally:
+        db_con.close()
+    return True
+
+
+def update_stats_catalog_for_nodes():
+    """
+    Count people by each property in 'g_l_stats_catalog_node_prop' from the person trait file.
+    Return True if successes, False otherwise.
+    """
+    logging.critical('[update_stats_catalog_for_nodes] Starts.')
+    timer_start = time.time()
+
+    d_prop_col = {'age': 2, 'age_group': 3, 'gender': 4, 'fips': 5, 'admin1': 8, 'admin2': 9, 'admin3': 10,
+                  'admin4': 11}
+    d_cnt = dict()
+    with open(g_person_trait_path, 'r') as in_fd:
+        csv_reader = csv.reader(in_fd, delimiter=',')
+        for row_idx, row in enumerate(csv_reader):
+            if row_idx == 0:
+                continue
+            for prop in g_l_stats_catalog_node_prop:
+                key = (prop, row[d_prop_col[prop]])
+                d_cnt[key] = d_cnt.get(key, 0) + 1
+
+    ret = replace_stats_catalog_scope('node', g_stats_catalog_null_tick, d_cnt)
+    logging.critical('[update_stats_catalog_for_nodes] All done in %s secs.' % str(time.time() - timer_start))
+    return ret
+
+
+def stats_catalog_tick_consumer(tick):
+    """
+    (add_chunk, finish) counting the edges of 'tick' in total, by source activity, by target activity and by activity
+    pair, and replacing its counts in the statistics catalog. See 'run_cn_file_consumers'.
+    """
+    timer_start = time.time()
+    d_act_code = dict()
+    d_pair_cnt = dict()
+
+    def add_chunk(d_chunk):
+        np_act_key = (encode_cn_acts(d_act_code, d_chunk['src_act']) << 16) \
+            | encode_cn_acts(d_act_code, d_chunk['trg_act'])
+        np_key, np_cnt = np.unique(np_act_key, return_counts=True)
+        for key, cnt in zip(np_key.tolist(), np_cnt.tolist()):
+            d_pair_cnt[key] = d_pair_cnt.get(key, 0) + cnt
+
+    def finish():
+        l_act = sorted(d_act_code, key=lambda act: d_act_code[act])
+        d_cnt = {('all', ''): sum(d_pair_cnt.values())}
+        for key, cnt in d_pair_cnt.items():
+            src_act = l_act[key >> 16]
+            trg_act = l_act[key & 0xFFFF]
+            d_cnt[('act_pair', '%s|%s' % (src_act, trg_act))] = cnt
+            d_cnt[('src_act', src_act)] = d_cnt.get(('src_act', src_act), 0) + cnt
+            d_cnt[('trg_act', trg_act)] = d_cnt.get(('trg_act', trg_act), 0) + cnt
+        ret = replace_stats_catalog_scope('edge', tick, d_cnt)
+        logging.critical('[stats_catalog_tick_consumer] Tick %s done in %s secs.' % (tick, time.time() - timer_start))
+        return ret
+
+    return add_chunk, finish
+
+
+def update_stats_catalog_for_tick(tick, cn_file_path):
+    """
+    Count edges of 'tick' in total, by source activity, by target activity and by activity pair.
+    Return True if successes, False otherwise.
+    """
+    logging.critical('[update_stats_catalog_for_tick] Tick %s starts.' % tick)
+    return run_cn_file_consumers(cn_file_path, [stats_catalog_tick_consumer(tick)])[0]
+
+
+def stats_catalog_lookup(scope, key, l_tick=None):
+    """
+    Look up counts in the statistics catalog.
+    :param
+        l_tick: list of int
+            Only meaningful for 'edge'. Counts are summed over these ticks, or over all ticks if None.
+    :return: dict
+        value -> cnt. None if fails.
+    """
+    try:
+        db_con = connect_to_stats_catalog()
+    except Exception as e:
+        logging.error('[stats_catalog_lookup] %s' % e)
+        return None
+
+    sql_str = '''select value, sum(cnt) from %s where scope=? and key=?''' % g_stats_catalog_tb_name
+    l_param = [scope, key]
+    if scope == 'edge' and l_tick is not None:
+        sql_str += ''' and tick in (%s)''' % ','.join(['?'] * len(l_tick))
+        l_param += [int(tick) for tick in l_tick]
+    sql_str += ''' group by value'''
+    try:
+        rows = db_con.execute(sql_str, l_param).fetchall()
+    except Exception as e:
+        logging.error('[stats_catalog_lookup] %s' % e)
+        return None
+    finally:
+        db_con.close()
+    return {row[0]: int(row[1]) for row in rows}
+
+
+################################################################################
+#   TRANSMISSION TREE
+################################################################################
+# The transmission forest is built from the records of the EpiHiper output DB with 'contact_pid' set, i.e. 'pid' was
+# infected by 'contact_pid' at 'tick'. Only the first such record of each PID is used, so each PID has at most one
+# infector. Infectors never infected in the output are roots. Arrays are aligned to the sorted PIDs of the forest:
+#   pid:            (int64) Sorted PIDs of all infectors and infectees.
+#   parent:         (int64) Row of the infector. -1 for roots.
+#   infect_tick:    (int32) Tick of the infection. -1 for roots.
+#   lid:            (int64) LID of the infection. -1 if None.
+#   child_offset, child: Children CSR. Children of row i are 'child[child_offset[i]:child_offset[i + 1]]'.
+#   depth:          (int32) Generation. 0 for roots.
+#   tin, tout:      (int64) Euler tour intervals. Row a is an ancestor of (or the same as) row b iff
+#                   tin[a] <= tin[b] and tout[b] <= tout[a].
+#   subtree_size:   (int64) Number of descendants including itself.
+#   height:         (int32) Length of the longest transmission chain starting from the row.
+def build_transmission_tree(out_path=None):
+    """
+    Build the transmission forest from the EpiHiper output DB. See 'TRANSMISSION TREE'.
+    Return True if successes, False otherwise.
+    """
+    logging.critical('[build_transmission_tree] Starts.')
+    timer_start = time.time()
+
+    if out_path is None:
+        out_path = g_transmission_tree_path
+
+    try:
+        db_con = connect_to_sqlite(g_epihiper_output_db_path)
+        db_cur = db_con.cursor()
+    except Exception as e:
+        logging.error(e)
+        return False
+
+    sql_str = '''select tick, pid, contact_pid, lid from %s where contact_pid is not null order by tick, out_id''' \
+              % g_epihiper_output_tb_name
+    try:
         db_cur.execute(sql_str)
         rows = db_cur.fetchall()
     except Exception as e:
-        logging.error('[query_1_sqlite_1] %s' % e)
-        return None
+        logging.error('[build_transmission_tree] %s' % e)
+        return False
+    finally:
+        db_con.close()
+
+    d_infection = dict()
+    for row in rows:
+        pid = int(row[1])
+        if pid in d_infection:
+            continue
+        d_infection[pid] = (int(row[0]), int(row[2]), -1 if row[3] is None else int(row[3]))
+
+    np_pid = np.unique(np.asarray(list(d_infection.keys()) + [rec[1] for rec in d_infection.values()],
+                                  dtype=np.int64))
+    num_node = len(np_pid)
+    np_parent = np.full(num_node, -1, dtype=np.int64)
+    np_infect_tick = np.full(num_node, -1, dtype=np.int32)
+    np_lid = np.full(num_node, -1, dtype=np.int64)
+    if len(d_infection) > 0:
+        np_infectee_row = pid_to_row(np_pid, np.asarray(list(d_infection.keys()), dtype=np.int64))
+        np_rec = np.asarray(list(d_infection.values()), dtype=np.int64)
+        np_parent[np_infectee_row] = pid_to_row(np_pid, np_rec[:, 1])
+        np_infect_tick[np_infectee_row] = np_rec[:, 0]
+        np_lid[np_infectee_row] = np_rec[:, 2]
+
+    # EULER TOUR
+    # Rows unreachable from the roots, which only happens when the output has an infection cycle, become roots.
+    np_tin = np.full(num_node, -1, dtype=np.int64)
+    np_tout = np.full(num_node, -1, dtype=np.int64)
+    np_depth = np.zeros(num_node, dtype=np.int32)
+    timer = 0
+    l_root = list(np.nonzero(np_parent < 0)[0])
+    while True:
+        np_child_offset, np_child = build_children_csr(np_parent)
+        for root in l_root:
+            if np_tin[root] >= 0:
+                continue
+            l_stack = [(root, False)]
+            while len(l_stack) > 0:
+                row, done = l_stack.pop()
+                if done:
+                    np_tout[row] = timer - 1
+                    continue
+                np_tin[row] = timer
+                timer += 1
+                l_stack.append((row, True))
+                for child in np_child[np_child_offset[row]:np_child_offset[row + 1]][::-1]:
+                    if np_tin[child] < 0:
+                        np_depth[child] = np_depth[row] + 1
+                        l_stack.append((child, False))
+        np_unvisited = np.nonzero(np_tin < 0)[0]
+        if len(np_unvisited) <= 0:
+            break
+        logging.error('[build_transmission_tree] Infection cycle found. PID %s is made a root.'
+                      % np_pid[np_unvisited[0]])
+        np_parent[np_unvisited[0]] = -1
+        l_root = [np_unvisited[0]]
+
+    np_subtree_size = np_tout - np_tin + 1
+    # Heights are propagated from the deepest rows up.
+    np_height = np.zeros(num_node, dtype=np.int32)
+    for row in np.argsort(-np_depth, kind='stable'):
+        if np_parent[row] >= 0:
+            np_height[np_parent[row]] = max(np_height[np_parent[row]], np_height[row] + 1)
+
+    np.savez(out_path, pid=np_pid, parent=np_parent, infect_tick=np_infect_tick, lid=np_lid,
+             child_offset=np_child_offset, child=np_child, depth=np_depth, tin=np_tin, tout=np_tout,
+             subtree_size=np_subtree_size, height=np_height)
+    logging.critical('[build_transmission_tree] All done with %s nodes and %s roots in %s secs.'
+                     % (num_node, int(np.sum(np_parent < 0)), time.time() - timer_start))
+    return True
+
+
+def build_children_csr(np_parent):
+    np_has_parent = np_parent >= 0
+    np_child = np.nonzero(np_has_parent)[0]
+    np_child = np_child[np.argsort(np_parent[np_child], kind='stable')]
+    np_child_cnt = np.bincount(np_parent[np_has_parent], minlength=len(np_parent))
+    np_child_offset = np.concatenate(([0], np.cumsum(np_child_cnt))).astype(np.int64)
+    return np_child_offset, np_child.astype(np.int64)
+
+
+def load_transmission_tree(tree_path=None):
+    """
+    :return: dict
+        See 'TRANSMISSION TREE'. None if the tree does not exist.
+    """
+    if tree_path is None:
+        tree_path = g_transmission_tree_path
+    if not path.exists(tree_path):
+        logging.error('[load_transmission_tree] No transmission tree at %s.' % tree_path)
+        return None
+    with np.load(tree_path) as npz_tree:
+        d_tree = {key: npz_tree[key] for key in npz_tree.files}
+    logging.critical('[load_transmission_tree] Opened %s nodes.' % len(d_tree['pid']))
+    return d_tree
+
+
+def transmission_is_ancestor(d_tree, l_ancestor_pid, l_descendant_pid):
+    """
+    Element-wise test if each PID in 'l_ancestor_pid' is an ancestor of (or the same as) the corresponding PID in
+    'l_descendant_pid'. PIDs not in the tree are never ancestors.
+    :return: ndarray of bool
+    """
+    np_a = pid_to_row(d_tree['pid'], l_ancestor_pid)
+    np_b = pid_to_row(d_tree['pid'], l_descendant_pid)
+    np_valid = (np_a >= 0) & (np_b >= 0)
+    np_ret = np.zeros(len(np_a), dtype=bool)
+    np_a = np_a[np_valid]
+    np_b = np_b[np_valid]
+    np_ret[np_valid] = (d_tree['tin'][np_a] <= d_tree['tin'][np_b]) & (d_tree['tout'][np_b] <= d_tree['tout'][np_a])
+    return np_ret
+
+
+def transmission_ancestry(d_tree, pid):
+    """
+    Return the infection chain from the root down to 'pid' as a list of PIDs.
+    """
+    row = int(pid_to_row(d_tree['pid'], [pid])[0])
+    l_chain = []
+    while row >= 0:
+        l_chain.append(int(d_tree['pid'][row]))
+        row = int(d_tree['parent'][row])
+    return l_chain[::-1]
+
+
+def transmission_stats(d_tree, l_pid):
+    """
+    Descendant counts, generations and the longest downstream chain lengths of the given PIDs.
+    :return: pandas DataFrame
+        Columns: pid, infect_tick, depth, num_descendant, max_chain_len. PIDs not in the tree are dropped.
+    """
+    np_pid = np.asarray(l_pid, dtype=np.int64)
+    np_row = pid_to_row(d_tree['pid'], np_pid)
+    np_pid = np_pid[np_row >= 0]
+    np_row = np_row[np_row >= 0]
+    return pd.DataFrame({'pid': np_pid,
+                         'infect_tick': d_tree['infect_tick'][np_row],
+                         'depth': d_tree['depth'][np_row],
+                         'num_descendant': d_tree['subtree_size'][np_row] - 1,
+                         'max_chain_len': d_tree['height'][np_row]})
+
+
+def transmission_edges_with_traits(d_tree, d_person, l_prop=('age', 'age_group', 'gender', 'fips')):
+    """
+    All (infector, infectee) pairs joined with the traits of both ends from the person column store.
+    :return: pandas DataFrame
+        Columns: infector_pid, infectee_pid, infect_tick, and 'infector_<prop>' and 'infectee_<prop>' for each prop.
+    """
+    np_infectee_row = np.nonzero(d_tree['parent'] >= 0)[0]
+    np_infector_pid = d_tree['pid'][d_tree['parent'][np_infectee_row]]
+    np_infectee_pid = d_tree['pid'][np_infectee_row]
+    d_col = {'infector_pid': np_infector_pid, 'infectee_pid': np_infectee_pid,
+             'infect_tick': d_tree['infect_tick'][np_infectee_row]}
+    for role, np_role_pid in [('infector', np_infector_pid), ('infectee', np_infectee_pid)]:
+        np_person_row = pid_to_row(d_person['pid'], np_role_pid)
+        np_valid = np_person_row >= 0
+        for prop in l_prop:
+            np_val = np.asarray(d_person[prop])[np.where(np_valid, np_person_row, 0)]
+            if prop in g_l_person_str_prop:
+                np_val = np.asarray(d_person['d_dict'][prop], dtype=object)[np_val]
+            np_val = np.where(np_valid, np_val, None)
+            d_col['%s_%s' % (role, prop)] = np_val
+    return pd.DataFrame(d_col)
+
+
+################################################################################
+#   EPIHIPER OUTPUT PREFIX-SUM CUBE
+################################################################################
+# Record counts of the EpiHiper output by tick x exit_state x demographic group, cumulated over ticks:
+#   <g_output_cube_folder>/cube.npy:    (int64) Shape (num_tick + 1, num_exit_state, num_group).
+#                                       cube[i, s, g] = the number of records of exit state s and group g at ticks
+#                                       before 'tick_min + i'. So the count over ticks [t1, t2] is
+#                                       cube[t2 - tick_min + 1] - cube[t1 - tick_min].
+#   <g_output_cube_folder>/meta.json:   'tick_min', 'l_exit_state' (exit state of each code) and 'l_group' (
+#                                       [age_group, gender, fips] of each group code). PIDs missing from the person
+#                                       trait file fall into the group [None, None, None].
+# Ticks are dense from 'tick_min' to the max tick, and only groups that exist in the population are kept.
+g_l_output_cube_dim = ['age_group', 'gender', 'fips']
+
+
+def build_output_prefix_cube(out_folder=None):
+    """
+    Build the prefix-sum cube from the EpiHiper output DB and the person trait file.
+    See 'EPIHIPER OUTPUT PREFIX-SUM CUBE'.
+    Return True if successes, False otherwise.
+    """
+    logging.critical('[build_output_prefix_cube] Starts.')
+    timer_start = time.time()
+
+    if out_folder is None:
+        out_folder = g_output_cube_folder
+    if not path.exists(out_folder):
+        os.makedirs(out_folder)
+
+    # DEMOGRAPHIC GROUP OF EACH PERSON
+    l_person_pid = []
+    l_person_key = []
+    with open(g_person_trait_path, 'r') as in_fd:
+        csv_reader = csv.reader(in_fd, delimiter=',')
+        for row_idx, row in enumerate(csv_reader):
+            if row_idx == 0:
+                continue
+            l_person_pid.append(int(row[0]))
+            l_person_key.append((row[3], int(row[4]), row[5]))
+    d_group_code = dict()
+    for key in sorted(set(l_person_key)):
+        d_group_code[key] = len(d_group_code)
+    l_group = [list(key) for key in d_group_code] + [[None, None, None]]
+    unknown_group = len(d_group_code)
+    np_person_pid = np.asarray(l_person_pid, dtype=np.int64)
+    np_order = np.argsort(np_person_pid, kind='stable')
+    np_person_pid = np_person_pid[np_order]
+    np_person_group = np.asarray([d_group_code[key] for key in l_person_key], dtype=np.int64)[np_order]
+    del l_person_pid, l_person_key
+
+    # OUTPUT RECORDS
+    # The tick range and the exit states are fetched first, so that the records can be counted chunk by chunk into
+    # the flat cube without holding them.
+    try:
+        db_con = connect_to_sqlite(g_epihiper_output_db_path)
+        db_cur = db_con.cursor()
+    except Exception as e:
+        logging.error('[build_output_prefix_cube] %s' % e)
+        return False
+    try:
+        tick_min, tick_max = db_cur.execute('''select min(tick), max(tick) from %s'''
+                                            % g_epihiper_output_tb_name).fetchone()
+        l_exit_state_val = sorted([row[0] for row in db_cur.execute('''select distinct exit_state from %s'''
+                                                                    % g_epihiper_output_tb_name).fetchall()])
+        tick_min = int(tick_min) if tick_min is not None else 0
+        num_tick = int(tick_max) - tick_min + 1 if tick_max is not None else 0
+        num_exit_state = len(l_exit_state_val)
+        num_group = len(l_group)
+        d_exit_state_code = {exit_state: code for code, exit_state in enumerate(l_exit_state_val)}
+        np_cnt = np.zeros(num_tick * num_exit_state * num_group, dtype=np.int64)
+        num_rec = 0
+
+        db_cur.execute('''select tick, exit_state, pid from %s''' % g_epihiper_output_tb_name)
+        while True:
+            rows = db_cur.fetchmany(1000000)
+            if len(rows) <= 0:
+                break
+            np_tick = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+            np_exit_state = np.fromiter((d_exit_state_code[row[1]] for row in rows), dtype=np.int64,
+                                        count=len(rows))
+            np_person_row = pid_to_row(np_person_pid, np.fromiter((row[2] for row in rows), dtype=np.int64,
+                                                                  count=len(rows)))
+            del rows
+            np_group = np.where(np_person_row >= 0, np_person_group[np.maximum(np_person_row, 0)], unknown_group)
+            np_flat = ((np_tick - tick_min) * num_exit_state + np_exit_state) * num_group + np_group
+            np_cnt += np.bincount(np_flat, minlength=len(np_cnt))
+            num_rec += len(np_flat)
+    except Exception as e:
+        logging.error('[build_output_prefix_cube] %s' % e)
+        return False
+    finally:
+        db_con.close()
+
+    np_cube = np.zeros((num_tick + 1, num_exit_state, num_group), dtype=np.int64)
+    np.cumsum(np_cnt.reshape((num_tick, num_exit_state, num_group)), axis=0, out=np_cube[1:])
+
+    np.save(path.join(out_folder, 'cube.npy'), np_cube)
+    with open(path.join(out_folder, 'meta.json'), 'w+') as out_fd:
+        json.dump({'tick_min': tick_min,
+                   'l_exit_state': [str(exit_state) for exit_state in l_exit_state_val],
+                   'l_group': l_group}, out_fd)
+    logging.critical('[build_output_prefix_cube] All done with %s recs, cube shape %s in %s secs.'
+                     % (num_rec, np_cube.shape, time.time() - timer_start))
+    return True
+
+
+def load_output_prefix_cube(cube_folder=None):
+    """
+    :return: dict
+        Keys: 'cube' (np.memmap), 'tick_min', 'l_exit_state', 'l_group', 'df_group' (pandas DataFrame of 'l_group'
+        with the columns in 'g_l_output_cube_dim'). None if the cube does not exist.
+    """
+    if cube_folder is None:
+        cube_folder = g_output_cube_folder
+    if not path.exists(path.join(cube_folder, 'meta.json')):
+        logging.error('[load_output_prefix_cube] No prefix-sum cube in %s.' % cube_folder)
+        return None
+    with open(path.join(cube_folder, 'meta.json'), 'r') as in_fd:
+        d_cube = json.load(in_fd)
+    d_cube['cube'] = np.load(path.join(cube_folder, 'cube.npy'), mmap_mode='r')
+    d_cube['df_group'] = pd.DataFrame(d_cube['l_group'], columns=g_l_output_cube_dim)
+    logging.critical('[load_output_prefix_cube] Opened cube of shape %s.' % str(d_cube['cube'].shape))
+    return d_cube
+
+
+def output_cube_window(d_cube, tick_start, tick_end):
+    """
+    Return the counts over ticks [tick_start, tick_end] as an array of shape (num_exit_state, num_group).
+    Ticks out of the cube are clipped.
+    """
+    num_tick = d_cube['cube'].shape[0] - 1
+    start = min(max(tick_start - d_cube['tick_min'], 0), num_tick)
+    end = min(max(tick_end - d_cube['tick_min'] + 1, start), num_tick)
+    return d_cube['cube'][end] - d_cube['cube'][start]
+
+
+def output_cube_count(d_cube, tick_start, tick_end, exit_state=None, exit_state_prefix=None, l_group_by=None,
+                      d_group_filter=None):
+    """
+    Count the records in ticks [tick_start, tick_end] of the exit state(s), optionally filtered and grouped by
+    demographics. Apart from grouping, the cost does not depend on the number of records or ticks.
+    :param
+        exit_state, exit_state_prefix: str
+            Same as 'col_store_select'. If both are None, all exit states are counted.
+        l_group_by: list of str
+            Subset of 'g_l_output_cube_dim'.
+        d_group_filter: dict
+            Dimension -> value or list of values, e.g. {'gender': 1, 'age_group': ['a', 'o']}.
+    :return: int or pandas DataFrame
+        The total count if 'l_group_by' is None. Otherwise a DataFrame with the columns in 'l_group_by' and 'cnt'.
+    """
+    np_win = output_cube_window(d_cube, tick_start, tick_end)
+    if exit_state is None and exit_state_prefix is None:
+        np_group_cnt = np_win.sum(axis=0)
+    else:
+        l_code = [code for code, each_exit_state in enumerate(d_cube['l_exit_state'])
+                  if (exit_state is not None and each_exit_state == exit_state)
+                  or (exit_state_prefix is not None and each_exit_state.startswith(exit_state_prefix))]
+        np_group_cnt = np_win[l_code].sum(axis=0)
+
+    df_group = d_cube['df_group']
+    np_mask = np.ones(len(df_group), dtype=bool)
+    if d_group_filter is not None:
+        for dim, val in d_group_filter.items():
+            l_val = val if isinstance(val, (list, tuple, set)) else [val]
+            np_mask &= df_group[dim].isin(l_val).to_numpy()
+    if l_group_by is None:
+        return int(np_group_cnt[np_mask].sum())
+    df_cnt = df_group[np_mask].assign(cnt=np_group_cnt[np_mask])
+    return df_cnt.groupby(l_group_by, dropna=False)['cnt'].sum().reset_index()
+
+
+################################################################################
+#   EXAMPLE QUERIES
+################################################################################
+def duration_distribution(neo4j_driver, df_output_pid_over_time, out_name_suffix, data_out_path, img_out_path,
+                          save_img=True, l_t=None, mode='in_1nn', server_agg=True):
+    """
+    Get the duration distribution over a subgraph of contact network at time points specified by 'l_t'.
+    The subgraph is defined by 'mode'.
+    :param
+        df_output_pid_over_time: pandas DataFrame
+            Filtered PIDs over time. The subgraph is constructed starting from these PIDs.
+    :param
+        l_t: list of int
+            The given time points. '-1' means the initial contact graph.
+    :param
+        mode: str
+            'in_1nn': The subgraph is the 1-nearest-neighbor graph induced by incoming edges based on 'l_core_pids'.
+    :param
+        server_agg: bool
+            True: All time points are queried at once, and durations are counted on the server. Only
+                  (tick, duration, count) triples are transferred.
+            False: Each time point is queried separately, and every duration value is transferred.
+    :return: 2D ndarray
+        Dim 0: Durations sorted in the ascending order.
+        Dim 1: Counts of durations.
+    """
+    logging.critical('[duration_distribution] Starts.')
+    timer_start = time.time()
+
+    neo4j_session_config = {'database': g_neo4j_db_name}
+
+    if mode == 'in_1nn':
+        query_str = '''with $l_core_pid as l_core_pid, $tick as tick
+                       match (n:PERSON) where n.pid in l_core_pid
+                       match ()-[r:CONTACT]->(n) where r.occur = tick
+                       return r.duration as d
+                    '''
+        agg_query_str = '''unwind $l_tick_pid as tick_pid
+                           with tick_pid.tick as tick, tick_pid.l_core_pid as l_core_pid
+                           unwind l_core_pid as core_pid
+                           match (n:PERSON {pid: core_pid})
+                           match ()-[r:CONTACT]->(n) where r.occur = tick
+                           return tick, r.duration as d, count(*) as cnt
+                        '''
+
+    if l_t is None:
+        l_t = df_output_pid_over_time.index.to_list()
+
+    l_dist_rec = []
+    if server_agg:
+        # PIDs are deduplicated here, as 'unwind' would otherwise count the edges of a repeated PID more than once.
+        l_tick_pid = [{'tick': int(tick), 'l_core_pid': list(set(pid_rec['pid']))}
+                      for tick, pid_rec in df_output_pid_over_time.loc[l_t].iterrows()]
+        l_ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [agg_query_str],
+                                      l_query_param=[{'l_tick_pid': l_tick_pid}], need_ret=True)
+        if l_ret is None:
+            raise Exception('[duration_distribution] Neo4j query failed.')
+        d_duration_by_tick = dict()
+        for rec in l_ret[0]:
+            tick = int(rec[0])
+            if tick not in d_duration_by_tick:
+                d_duration_by_tick[tick] = dict()
+            d_duration_by_tick[tick][int(rec[1])] = int(rec[2])
+        for tick in l_t:
+            if tick in d_duration_by_tick:
+                l_dist_rec.append((tick, d_duration_by_tick[tick]))
+    else:
+        for tick, pid_rec in df_output_pid_over_time.loc[l_t].iterrows():
+            d_duration = dict()
+            l_core_pids = pid_rec['pid']
+            query_param = {'l_core_pid': l_core_pids, 'tick': tick}
+            l_ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [query_str],
+                                          l_query_param=[query_param], need_ret=True)
+            if l_ret is None:
+                raise Exception('[duration_distribution] Neo4j query failed at tick %s.' % tick)
+            for rec in l_ret[0]:
+                duration = int(rec[0])
+                if duration not in d_duration:
+                    d_duration[duration] = 1
+                else:
+                    d_duration[duration] += 1
+            if len(d_duration) <= 0:
+                continue
+            l_dist_rec.append((tick, d_duration))
+
+    df_dist = pd.DataFrame(l_dist_rec, columns=['tick', 'duration_dist'])
+    df_dist = df_dist.set_index('tick')
+    pd.to_pickle(df_dist, data_out_path)
+    logging.critical('[duration_distribution] Output results.')
+
+    # PLOT
+    if save_img:
+        plot_duration_distribution(df_dist, out_name_suffix, img_out_path)
+
+    logging.critical('[duration_distribution] All done in %s secs.' % str(time.time() - timer_start))
+
+
+def plot_duration_distribution(df_dist, out_name_suffix, img_out_path, bins='auto'):
+    """
+    Plot the stacked duration histograms of all ticks in 'df_dist'. Counts are passed as weights, so the plotting cost
+    depends on the number of distinct durations rather than the number of contacts.
+    """
+    l_plot_rec = []
+    for tick, dist_rec in df_dist.iterrows():
+        d_dist = dist_rec['duration_dist']
+        for duration in d_dist:
+            l_plot_rec.append(('t' + str(tick), duration, d_dist[duration]))
+    df_plot = pd.DataFrame(l_plot_rec, columns=['tick', 'duration', 'count'])
+
+    fig, axes = plt.subplots(ncols=1, nrows=1)
+    sns.histplot(data=df_plot, x='duration', weights='count', hue='tick', bins=bins, multiple='stack', legend=True,
+                 ax=axes)
+    axes.set_title('Duration Distribution Over Time With Exit State %s' % out_name_suffix, fontsize=12,
+                   fontweight='semibold')
+    axes.set_xlabel('Duration', fontweight='semibold')
+    axes.set_ylabel('Frequency', fontweight='semibold')
+    plt.tight_layout(pad=1.0)
+    plt.savefig(img_out_path, format='PNG')
+    plt.show()
+    plt.clf()
+    plt.close()
+
+
+# Query 1
+# How many males between 18 and 24 years of age are newly infected
+# (i.e., are just transitioned to state I or its variants [this could be a set of states])
+# between times 5 and 15 inclusive? What are the PIDs of these males?
+#
+# Solution:
+#   (1) Query EpiHiper SQLite DB for all PIDs with 'exit_state="I..."' between times 5 and 15 inclusively.
+#   (2) Query Neo4j for 'n.pid' where 'n.age>=18 and n.age<=24' given the PIDs.
+#
+# Running Time:
+#   0.4s
+def query_1_sqlite_1_stream(d_col_store=None, chunk_size=10000):
+    """
+    Stream PIDs where 'exit_state' starts with 'I' and 'tick' between 5 and 15 inclusively.
+    If 'd_col_store' is given, the query is answered by the columnar store instead of SQLite.
+    SQLite errors are raised, so that a failed query is never taken (or cached) as an empty result.
+    :return: generator of pandas DataFrame
+        Columns: tick (int), pid (int)
+        Each DataFrame holds at most 'chunk_size' records.
+    """
+    if d_col_store is not None:
+        np_tick, np_pid = col_store_select(d_col_store, tick_start=5, tick_end=15, exit_state_prefix='I')
+        for i in range(0, len(np_pid), chunk_size):
+            yield pd.DataFrame({'tick': np_tick[i: i + chunk_size].astype(np.int64),
+                                'pid': np_pid[i: i + chunk_size]})
+        return
+
+    try:
+        db_con = connect_to_sqlite(g_epihiper_output_db_path)
+        db_cur = db_con.cursor()
+    except Exception as e:
+        raise Exception('[query_1_sqlite_1_stream] %s' % e)
 
-    l_pid_rec = []
-    for row in rows:
-        tick = int(row[0])
-        pid = int(row[1])
-        l_pid_rec.append((tick, pid))
+    try:
+        sql_str = '''PRAGMA case_sensitive_like=true'''
+        try:
+            db_cur.execute(sql_str)
+        except Exception as e:
+            raise Exception('[query_1_sqlite_1_stream] %s' % e)
 
-    df_pid = pd.DataFrame(l_pid_rec, columns=['tick', 'pid'])
-    pd.to_pickle(df_pid, out_path)
+        sql_str = '''select tick, pid from {0} where tick>=5 and tick<=15 and exit_state like "I%"'''\
+            .format(g_epihiper_output_tb_name)
+        try:
+            db_cur.execute(sql_str)
+        except Exception as e:
+            raise Exception('[query_1_sqlite_1_stream] %s' % e)
+
+        while True:
+            rows = db_cur.fetchmany(chunk_size)
+            if len(rows) <= 0:
+                break
+            yield pd.DataFrame([(int(row[0]), int(row[1])) for row in rows], columns=['tick', 'pid'])
+    finally:
+        db_con.close()
+
+
+def query_1_sqlite_1(out_path, d_col_store=None):
+    """
+    Query for PIDs where 'exit_state' starts with 'I' and 'tick' between 5 and 15 inclusively.
+    If 'd_col_store' is given, the query is answered by the columnar store instead of SQLite.
+    If 'out_path' is None, the results are only returned.
+    """
+    logging.critical('[query_1_sqlite_1] Starts.')
+    timer_start = time.time()
+
+    cache_key = None
+    if g_query_cache_enabled and d_col_store is None:
+        cache_key = query_cache_key('sqlite', 'query_1_sqlite_1')
+        hit, df_pid = query_cache_get(cache_key)
+    if cache_key is None or not hit:
+        l_df_pid = list(query_1_sqlite_1_stream(d_col_store, chunk_size=1000000))
+        if len(l_df_pid) > 0:
+            df_pid = pd.concat(l_df_pid, ignore_index=True)
+        else:
+            df_pid = pd.DataFrame([], columns=['tick', 'pid'])
+        if cache_key is not None:
+            query_cache_put(cache_key, df_pid)
+    if out_path is not None:
+        pd.to_pickle(df_pid, out_path)
 
-    db_con.close()
     logging.critical('[query_1_sqlite_1] All done in %s secs.' % str(time.time() - timer_start))
+    return df_pid
 
 
-def query_1_neo4j_1(neo4j_driver, df_pid, out_path):
+g_query_1_neo4j_1_str = '''unwind $infect_pid as infect_pid
+                            match (n:PERSON {pid: infect_pid})
+                            where n.age>=18 and n.age<=24 and n.gender=2
+                            return infect_pid'''
+
+
+g_query_1_neo4j_cohort_str_fmt = '''match (n:`%s`)
+                                     where n.age>=18 and n.age<=24 and n.gender=2
+                                     return n.pid'''
+
+
+def query_1_neo4j_1(neo4j_driver, df_pid, out_path, cohort_name=None):
     """
     Query for PIDs where 'n.age>=18 and n.age<=24 and n.gender=2'.
+    If 'out_path' is None, the results are only returned.
+    :param
+        cohort_name: str
+            If given, the query anchors on the label of this cohort, which should have been materialized from
+            'df_pid' by 'materialize_pid_cohort', and PIDs are not sent.
     """
     logging.critical('[query_1_neo4j_1] Starts.')
     timer_start = time.time()
 
     neo4j_session_config = {'database': g_neo4j_db_name}
 
-    l_infect_pid = list(set(df_pid['pid'].to_list()))
-
-    query_str = '''unwind $infect_pid as infect_pid
-                   match (n:PERSON {pid: infect_pid})
-                   where n.age>=18 and n.age<=24 and n.gender=2
-                   return infect_pid'''
-    query_param = {'infect_pid': l_infect_pid}
-    ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [query_str], l_query_param=[query_param],
-                                need_ret=True)
+    if cohort_name is not None:
+        ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config,
+                                    [g_query_1_neo4j_cohort_str_fmt % cohort_label(cohort_name)],
+                                    l_query_param=None, need_ret=True)
+        if ret is None:
+            raise Exception('[query_1_neo4j_1] Neo4j query failed on cohort %s.' % cohort_name)
+    else:
+        l_infect_pid = list(set(df_pid['pid'].to_list()))
+        query_param = {'infect_pid': l_infect_pid}
+        ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [g_query_1_neo4j_1_str],
+                                    l_query_param=[query_param], need_ret=True)
     df_ret = pd.DataFrame(ret[0], columns=['pid'])
-    pd.to_pickle(df_ret, out_path)
+    if out_path is not None:
+        pd.to_pickle(df_ret, out_path)
 
     logging.critical('[query_1_neo4j_1] All done in %s secs.' % str(time.time() - timer_start))
+    return df_ret
 
 
 # Query 2
@@ -1087,28 +4816,74 @@ def query_1_neo4j_1(neo4j_driver, df_pid, out_path):
 #
 # Running Time:
 #   18s
+g_query_2_neo4j_1_str = '''match ()-[r:CONTACT]->(n)
+                            where r.trg_act="1:3"
+                            return distinct n.pid'''
+
+
 def query_2_neo4j_1(neo4j_driver, out_path):
     """
     Query for n.pid with ()-[r]->(n) where r.trg_act="1:3" for all n.
+    If 'out_path' is None, the results are only returned.
     """
     logging.critical('[query_2_neo4j_1] Starts.')
     timer_start = time.time()
 
     neo4j_session_config = {'database': g_neo4j_db_name}
 
-    query_str = '''match ()-[r:CONTACT]->(n)
-                   where r.trg_act="1:3"
-                   return distinct n.pid'''
-    ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [query_str], l_query_param=None, need_ret=True)
+    ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [g_query_2_neo4j_1_str], l_query_param=None,
+                                need_ret=True)
     df_ret = pd.DataFrame(ret[0], columns=['pid'])
-    pd.to_pickle(df_ret, out_path)
+    if out_path is not None:
+        pd.to_pickle(df_ret, out_path)
 
     logging.critical('[query_2_neo4j_1] All done in %s secs.' % str(time.time() - timer_start))
+    return df_ret
+
+
+def exit_state_count_by_pids(db_cur, l_pid):
+    """
+    Count EpiHiper output records by exit state for the given PIDs. Shared by the SQLite stages of Query 2 and 3.
+    :return: pandas DataFrame
+        Columns: exit_state (str), count (int)
+        None if fails.
+    """
+    cache_key = None
+    if g_query_cache_enabled:
+        cache_key = query_cache_key('sqlite', 'exit_state_count_by_pids', sorted(set(int(pid) for pid in l_pid)))
+        hit, df_exit_state = query_cache_get(cache_key)
+        if hit:
+            return df_exit_state
+
+    tmp_tb_name = load_pids_into_sqlite_temp_table(db_cur, l_pid)
+    if tmp_tb_name is None:
+        return None
+
+    sql_str = "select exit_state, count(*) from {0} where pid in (select pid from {1}) group by exit_state" \
+        .format(g_epihiper_output_tb_name, tmp_tb_name)
+    try:
+        db_cur.execute(sql_str)
+        rows = db_cur.fetchall()
+    except Exception as e:
+        logging.error('[exit_state_count_by_pids] %s' % e)
+        return None
+
+    l_exit_state_rec = []
+    for row in rows:
+        exit_state = row[0]
+        count = int(row[1])
+        l_exit_state_rec.append((exit_state, count))
+
+    df_exit_state = pd.DataFrame(l_exit_state_rec, columns=['exit_state', 'count'])
+    if cache_key is not None:
+        query_cache_put(cache_key, df_exit_state)
+    return df_exit_state
 
 
 def query_2_sqlite_1(df_pid, out_path):
     """
     Query for exit_state with group by given PIDs.
+    If 'out_path' is None, the results are only returned.
     """
     logging.critical('[query_2_sqlite_1] Starts.')
     timer_start = time.time()
@@ -1116,138 +4891,995 @@ def query_2_sqlite_1(df_pid, out_path):
     l_pid = df_pid['pid'].to_list()
 
     try:
-        db_con = sqlite3.connect(g_epihiper_output_db_path)
+        db_con = connect_to_sqlite(g_epihiper_output_db_path)
+        db_cur = db_con.cursor()
+    except Exception as e:
+        logging.error(e)
+        return None
+
+    df_exit_state = exit_state_count_by_pids(db_cur, l_pid)
+    db_con.close()
+    if df_exit_state is None:
+        return None
+    if out_path is not None:
+        pd.to_pickle(df_exit_state, out_path)
+
+    logging.critical('[query_2_sqlite_1] All done in %s secs.' % str(time.time() - timer_start))
+    return df_exit_state
+
+
+# Query 3
+# What are the states that are transitioned to by males between 75 and 90 or by females 32 to 39
+# where the other node of an edge, if there is an edge, is activity work?
+#
+# Solution:
+#   (1) Query Neo4j for PIDs where (n.gender=2 and n.age>=71 and n.age<= 90) or (n.gender=1 and n.age>=32 and n.age<=39)
+#       with incoming edges where r.src_act="1:2".
+#   (2) Query SQLite for exit_state given PIDs.
+#
+# Running Time:
+#   47s
+g_query_3_neo4j_1_str = '''match ()-[r:CONTACT]->(n)
+                            where (r.src_act="1:2") and 
+                                  ((n.gender=2 and n.age>=71 and n.age<=90) 
+                                   or 
+                                   (n.gender=1 and n.age>=32 and n.age<=39))
+                            return distinct n.pid'''
+
+
+def query_3_neo4j_1(neo4j_driver, out_path):
+    """
+    Query Neo4j for PIDs where (n.gender=2 and n.age>=71 and n.age<= 90) or (n.gender=1 and n.age>=32 and n.age<=39)
+    with incoming edges where r.src_act="1:2".
+    If 'out_path' is None, the results are only returned.
+    """
+    logging.critical('[query_3_neo4j_1] Starts.')
+    timer_start = time.time()
+
+    neo4j_session_config = {'database': g_neo4j_db_name}
+
+    ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [g_query_3_neo4j_1_str], l_query_param=None,
+                                need_ret=True)
+    df_ret = pd.DataFrame(ret[0], columns=['pid'])
+    if out_path is not None:
+        pd.to_pickle(df_ret, out_path)
+
+    logging.critical('[query_3_neo4j_1] All done in %s secs.' % str(time.time() - timer_start))
+    return df_ret
+
+
+def query_3_sqlite_1(df_pid, out_path):
+    """
+    Query SQLite for exit_state given PIDs with group by.
+    If 'out_path' is None, the results are only returned.
+    """
+    logging.critical('[query_3_sqlite_1] Starts.')
+    timer_start = time.time()
+
+    l_pid = df_pid['pid'].to_list()
+
+    try:
+        db_con = connect_to_sqlite(g_epihiper_output_db_path)
         db_cur = db_con.cursor()
     except Exception as e:
         logging.error(e)
         return None
 
-    sql_str = "select exit_state, count(*) from {0} where pid in ({1}) group by exit_state" \
-        .format(g_epihiper_output_tb_name, ','.join(['?'] * len(l_pid)))
-    try:
-        db_cur.execute(sql_str, l_pid)
-        rows = db_cur.fetchall()
-    except Exception as e:
-        logging.error('[query_2_sqlite_1] %s' % e)
-        return None
+    df_exit_state = exit_state_count_by_pids(db_cur, l_pid)
+    db_con.close()
+    if df_exit_state is None:
+        return None
+    if out_path is not None:
+        pd.to_pickle(df_exit_state, out_path)
+
+    logging.critical('[query_3_sqlite_1] All done in %s secs.' % str(time.time() - timer_start))
+    return df_exit_state
+
+
+# Query 4
+# What people (individuals) are entering the recovered state (in an SIR epidemic) between times 5 and 15 inclusive,
+# where the household income is between $86,000 and $114,000 annually?
+#
+# Question:
+#   Where is the household income information?
+
+
+# Query 5
+# What are the household IDs of households where the number of people in the household is at least 6 and
+# there is at least one child between 8 and 14?
+#
+# Solution:
+#   (1) Only Neo4j is needed. Find all HIDs associated with more than 6 members, then for each HID check if it has
+#       at least one member between 8 and 14.
+def query_5_neo4j_1(neo4j_driver, out_path):
+    logging.critical('[query_5_neo4j_1] Starts.')
+    timer_start = time.time()
+
+    neo4j_session_config = {'database': g_neo4j_db_name}
+
+    query_str = '''match (n:PERSON)  
+                   with distinct n.hid as trg_hid, count(n) as cnt
+                   where cnt>=8
+                   match (m:PERSON)
+                   where m.hid=trg_hid and 8<=m.age<=14
+                   return distinct m.hid'''
+    ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [query_str], l_query_param=None, need_ret=True)
+    df_ret = pd.DataFrame(ret[0], columns=['hid'])
+    pd.to_pickle(df_ret, out_path)
+
+    logging.critical('[query_5_neo4j_1] All done in %s secs.' % str(time.time() - timer_start))
+
+
+################################################################################
+#   CROSS-STORE QUERY PIPELINE
+################################################################################
+# A two-stage cross-store query runs its first stage as a producer and its second stage as a consumer. The first
+# stage yields its results chunk by chunk as pandas DataFrames, and each chunk is handed over in memory through a
+# bounded queue to the second stage, which starts working as soon as the first chunk arrives. The partial results of
+# the second stage are combined at the end. Checkpointing to disk is optional.
+def stream_neo4j_query(neo4j_driver, neo4j_session_config, query_str, query_param=None, chunk_size=10000):
+    """
+    Run a read query in an auto-commit transaction and yield its records chunk by chunk as soon as they are received.
+    Set 'fetch_size' in 'neo4j_session_config' to control how many records are pulled from the server at a time.
+    :return: generator of list of list
+        Each list holds at most 'chunk_size' records, each of which is a list of values.
+    """
+    if neo4j_driver is None:
+        raise Exception('[stream_neo4j_query] neo4j_driver is None. Run "neo4j_driver" cmd first.')
+
+    neo4j_session = get_neo4j_session(neo4j_driver, session_config=neo4j_session_config)
+    d_rec = None
+    if g_instrument_enabled:
+        d_rec = record_query_metric('neo4j', query_str, 0.0, param_bytes=payload_bytes(query_param))
+    try:
+        # Only the time spent in the driver is measured, not the time the consumer holds each chunk.
+        timer_fetch = time.time()
+        results = neo4j_session.run(query_str, query_param)
+        l_chunk = []
+        for record in results:
+            l_chunk.append(record.values())
+            if len(l_chunk) >= chunk_size:
+                if d_rec is not None:
+                    d_rec['secs'] += time.time() - timer_fetch
+                    d_rec['rows'] += len(l_chunk)
+                    d_rec['row_bytes'] += payload_bytes(l_chunk)
+                yield l_chunk
+                timer_fetch = time.time()
+                l_chunk = []
+        if d_rec is not None:
+            d_rec['secs'] += time.time() - timer_fetch
+            d_rec['rows'] += len(l_chunk)
+            d_rec['row_bytes'] += payload_bytes(l_chunk)
+        if len(l_chunk) > 0:
+            yield l_chunk
+    except Exception as e:
+        # Raised again, so that a failure in the middle of the stream is not taken as the end of the stream.
+        logging.error('[stream_neo4j_query] Failed query: %s' % e)
+        raise
+    finally:
+        neo4j_session.close()
+
+
+def run_cross_store_pipeline(stage_1_stream, stage_2_fn, combine_fn, queue_size=8, checkpoint_folder=None,
+                             stage_1_out_name=None, stage_2_out_name=None):
+    """
+    Run a two-stage cross-store query with the stages overlapped.
+    :param
+        stage_1_stream: generator of pandas DataFrame
+            The first stage. It is consumed in a separate thread.
+    :param
+        stage_2_fn: function
+            Takes a chunk of the first stage, and returns the partial result (pandas DataFrame) of the second stage.
+            Called in the calling thread in the order of the chunks. Returning None is taken as a failure.
+    :param
+        combine_fn: function
+            Takes the list of partial results, and returns the final result.
+    :param
+        queue_size: int
+            The max number of chunks waiting for the second stage. It bounds the memory of the hand-off.
+    :param
+        checkpoint_folder: str
+            If given, the concatenated results of the first stage and the final results are pickled into this folder
+            as 'stage_1_out_name' and 'stage_2_out_name' respectively.
+    :return: pandas DataFrame
+        The final results. Raises an exception if either stage fails.
+    """
+    logging.critical('[run_cross_store_pipeline] Starts.')
+    timer_start = time.time()
+
+    q_chunk = queue.Queue(maxsize=queue_size)
+    end_marker = object()
+    l_err = []
+    # Set when the second stage stops, so that the first stage is never blocked on a full queue.
+    stop_event = threading.Event()
+
+    def put_chunk(item):
+        while not stop_event.is_set():
+            try:
+                q_chunk.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run_stage_1():
+        try:
+            for df_chunk in stage_1_stream:
+                if not put_chunk(df_chunk):
+                    break
+        except Exception as e:
+            logging.error('[run_cross_store_pipeline] Stage 1 failed: %s' % e)
+            l_err.append(e)
+        finally:
+            put_chunk(end_marker)
+
+    stage_1_thread = threading.Thread(target=run_with_instrument_cmd, args=(instrument_cmd(), run_stage_1),
+                                      name='stage_1')
+    stage_1_thread.start()
+
+    l_stage_1_ret = []
+    l_stage_2_ret = []
+    chunk_cnt = 0
+    try:
+        while True:
+            df_chunk = q_chunk.get()
+            if df_chunk is end_marker:
+                break
+            chunk_cnt += 1
+            if checkpoint_folder is not None:
+                l_stage_1_ret.append(df_chunk)
+            df_part = stage_2_fn(df_chunk)
+            if df_part is None:
+                raise Exception('[run_cross_store_pipeline] Stage 2 failed on chunk %s.' % chunk_cnt)
+            l_stage_2_ret.append(df_part)
+            logging.critical('[run_cross_store_pipeline] Chunk %s with %s recs done in %s secs.'
+                             % (chunk_cnt, len(df_chunk), time.time() - timer_start))
+    finally:
+        stop_event.set()
+        while True:
+            try:
+                q_chunk.get_nowait()
+            except queue.Empty:
+                break
+        stage_1_thread.join()
+    if len(l_err) > 0:
+        raise Exception('[run_cross_store_pipeline] Stage 1 failed: %s' % l_err[0])
+
+    df_ret = combine_fn(l_stage_2_ret)
+
+    if checkpoint_folder is not None:
+        if not path.exists(checkpoint_folder):
+            os.makedirs(checkpoint_folder)
+        if stage_1_out_name is not None and len(l_stage_1_ret) > 0:
+            pd.to_pickle(pd.concat(l_stage_1_ret, ignore_index=True), path.join(checkpoint_folder, stage_1_out_name))
+        if stage_2_out_name is not None:
+            pd.to_pickle(df_ret, path.join(checkpoint_folder, stage_2_out_name))
+
+    logging.critical('[run_cross_store_pipeline] All done with %s chunks in %s secs.'
+                     % (chunk_cnt, time.time() - timer_start))
+    return df_ret
+
+
+def concat_partial_pids(l_df_part, col_name='pid'):
+    if len(l_df_part) <= 0:
+        return pd.DataFrame([], columns=[col_name])
+    return pd.concat(l_df_part, ignore_index=True).drop_duplicates(col_name).reset_index(drop=True)
+
+
+def sum_partial_exit_state_counts(l_df_part):
+    if len(l_df_part) <= 0:
+        return pd.DataFrame([], columns=['exit_state', 'count'])
+    return pd.concat(l_df_part, ignore_index=True).groupby('exit_state', as_index=False)['count'].sum()
+
+
+def example_query_1_pipeline(neo4j_driver, d_col_store=None, chunk_size=10000, checkpoint_folder=None,
+                             d_person=None):
+    """
+    Query 1 with the SQLite stage streamed into the Neo4j stage. PIDs already sent to Neo4j are skipped.
+    If 'd_person' is given, the second stage is answered by the person bitmap indexes instead of Neo4j.
+    """
+    neo4j_session_config = {'database': g_neo4j_db_name}
+    s_seen_pid = set()
+
+    def stage_2_fn(df_chunk):
+        l_infect_pid = [pid for pid in set(df_chunk['pid'].to_list()) if pid not in s_seen_pid]
+        s_seen_pid.update(l_infect_pid)
+        if len(l_infect_pid) <= 0:
+            return pd.DataFrame([], columns=['pid'])
+        if d_person is not None:
+            return pd.DataFrame({'pid': filter_pids_by_person_pred(d_person, g_query_1_person_pred, l_infect_pid)})
+        ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [g_query_1_neo4j_1_str],
+                                    l_query_param=[{'infect_pid': l_infect_pid}], need_ret=True)
+        if ret is None:
+            return None
+        return pd.DataFrame(ret[0], columns=['pid'])
+
+    return run_cross_store_pipeline(query_1_sqlite_1_stream(d_col_store, chunk_size), stage_2_fn,
+                                    concat_partial_pids, checkpoint_folder=checkpoint_folder,
+                                    stage_1_out_name='sqlite_pid.pickle', stage_2_out_name='results.pickle')
+
+
+def example_query_neo4j_to_sqlite_pipeline(neo4j_driver, neo4j_query_str, chunk_size=10000, checkpoint_folder=None):
+    """
+    Query 2 and 3 with the Neo4j stage streamed into the SQLite stage.
+    NOTE:
+        'neo4j_query_str' should return distinct PIDs, so that the partial counts of chunks can be summed up.
+    """
+    neo4j_session_config = {'database': g_neo4j_db_name, 'fetch_size': chunk_size}
+    stage_1_stream = (pd.DataFrame(l_chunk, columns=['pid'])
+                      for l_chunk in stream_neo4j_query(neo4j_driver, neo4j_session_config, neo4j_query_str,
+                                                        chunk_size=chunk_size))
+    # The SQLite connection is only used in the calling thread.
+    db_con = connect_to_sqlite(g_epihiper_output_db_path)
+    db_cur = db_con.cursor()
+
+    def stage_2_fn(df_chunk):
+        return exit_state_count_by_pids(db_cur, df_chunk['pid'].to_list())
+
+    try:
+        df_ret = run_cross_store_pipeline(stage_1_stream, stage_2_fn, sum_partial_exit_state_counts,
+                                          checkpoint_folder=checkpoint_folder, stage_1_out_name='neo4j_pid.pickle',
+                                          stage_2_out_name='results.pickle')
+    finally:
+        db_con.close()
+    return df_ret
+
+
+################################################################################
+#   CROSS-STORE QUERY PLANNER
+################################################################################
+# A two-store query is declared as a spec instead of a hard-coded join order:
+#   'node_pred':    Predicate on PERSON nodes in the format of 'eval_person_pred'. None means all people.
+#   'edge_pred':    dict. Incoming CONTACT edges of the PERSON must include one with these properties, e.g.
+#                   {'src_act': '1:2'}. Keys: 'src_act', 'trg_act' and 'l_tick' (list of 'occur'). None means no
+#                   constraint on edges.
+#   'output_pred':  dict. EpiHiper output records of the PERSON must include one satisfying these, e.g.
+#                   {'tick_start': 5, 'tick_end': 15, 'exit_state_prefix': 'I'}. Keys: 'tick_start', 'tick_end',
+#                   'exit_state' and 'exit_state_prefix'. None means no constraint on records.
+#   'result':       'pid': Distinct PIDs satisfying all predicates.
+#                   'exit_state_count': Counts of output records satisfying 'output_pred' by exit state over these
+#                   PIDs.
+# The planner estimates the cardinality of each side from the statistics catalog and the prefix-sum cube, and picks
+# the join order and join strategy of the least estimated cost:
+#   'sqlite_first': Output records are selected first, and their PIDs are checked on the Neo4j side.
+#   'neo4j_first':  PERSONs are selected first, and their PIDs are checked on the SQLite side.
+# Join strategies:
+#   'in_list':      PIDs are sent inline, i.e. as a Cypher list parameter or a SQL 'in (...)' list.
+#   'temp_table':   PIDs are loaded into a SQLite temp table first. See 'load_pids_into_sqlite_temp_table'.
+#   'bitmap':       Node predicates are answered by the person bitmap indexes without Neo4j. Only available when the
+#                   person column store is open and there is no edge predicate.
+# Costs are in seconds per row. The defaults are rough calibrations from the running times of the example queries.
+g_planner_cost = {'sqlite_row': 1e-6,
+                  'sqlite_seek': 2e-5,
+                  'neo4j_node': 5e-6,
+                  'neo4j_edge': 2e-6,
+                  'neo4j_seek': 5e-5,
+                  'ship_pid': 1e-6,
+                  'bitmap_pid': 5e-8}
+# SQLite 'in (...)' lists longer than this use a temp table instead.
+g_planner_in_list_max = 1000
+
+g_query_1_spec = {'node_pred': g_query_1_person_pred,
+                  'edge_pred': None,
+                  'output_pred': {'tick_start': 5, 'tick_end': 15, 'exit_state_prefix': 'I'},
+                  'result': 'pid'}
+g_query_2_spec = {'node_pred': None,
+                  'edge_pred': {'trg_act': '1:3'},
+                  'output_pred': None,
+                  'result': 'exit_state_count'}
+g_query_3_spec = {'node_pred': g_query_3_person_pred,
+                  'edge_pred': {'src_act': '1:2'},
+                  'output_pred': None,
+                  'result': 'exit_state_count'}
+
+
+def check_person_pred(pred):
+    """
+    Raise if a predicate in the format of 'eval_person_pred' is malformed, refers to a property not in
+    'g_l_person_num_prop' or 'g_l_person_str_prop', or compares to a value that is not a scalar. Predicates from
+    clients are pasted into Cypher, so they must be checked first.
+    """
+    if not isinstance(pred, (list, tuple)) or len(pred) <= 0:
+        raise Exception('[check_person_pred] Malformed predicate: %s' % str(pred))
+    op = pred[0]
+    if op in ['and', 'or', 'not']:
+        if len(pred) < 2 or (op == 'not' and len(pred) != 2):
+            raise Exception('[check_person_pred] Malformed predicate: %s' % str(pred))
+        for sub_pred in pred[1:]:
+            check_person_pred(sub_pred)
+        return
+    if op not in ['eq', 'in', 'range']:
+        raise Exception('[check_person_pred] Unknown op: %s' % op)
+    if len(pred) != {'eq': 3, 'in': 3, 'range': 4}[op]:
+        raise Exception('[check_person_pred] Malformed predicate: %s' % str(pred))
+    if pred[1] not in g_l_person_num_prop + g_l_person_str_prop:
+        raise Exception('[check_person_pred] Unknown property: %s' % pred[1])
+    l_val = list(pred[2]) if op == 'in' else list(pred[2:])
+    for val in l_val:
+        if not isinstance(val, (str, int, float)) or isinstance(val, bool):
+            raise Exception('[check_person_pred] Bad value for %s: %s' % (pred[1], val))
+
+
+def person_pred_to_cypher(pred, var='n'):
+    """
+    Translate a predicate in the format of 'eval_person_pred' into a Cypher condition on 'var'. The predicate should
+    have passed 'check_person_pred'.
+    """
+    op = pred[0]
+    if op in ['and', 'or']:
+        return '(' + (' %s ' % op).join([person_pred_to_cypher(sub_pred, var) for sub_pred in pred[1:]]) + ')'
+    elif op == 'not':
+        return '(not %s)' % person_pred_to_cypher(pred[1], var)
+    elif op == 'eq':
+        return '%s.%s=%s' % (var, pred[1], json.dumps(pred[2]))
+    elif op == 'in':
+        return '%s.%s in %s' % (var, pred[1], json.dumps(list(pred[2])))
+    elif op == 'range':
+        return '(%s.%s>=%s and %s.%s<=%s)' % (var, pred[1], json.dumps(pred[2]), var, pred[1], json.dumps(pred[3]))
+    else:
+        raise Exception('[person_pred_to_cypher] Unknown op: %s' % op)
+
+
+def edge_pred_to_cypher(edge_pred, var='r'):
+    l_cond = []
+    for key in ['src_act', 'trg_act']:
+        if key in edge_pred:
+            l_cond.append('%s.%s=%s' % (var, key, json.dumps(edge_pred[key])))
+    if 'l_tick' in edge_pred:
+        l_cond.append('%s.occur in %s' % (var, json.dumps([int(tick) for tick in edge_pred['l_tick']])))
+    return ' and '.join(l_cond) if len(l_cond) > 0 else 'true'
+
+
+def output_pred_to_sql(output_pred):
+    """
+    :return: (str, list)
+        The 'where' condition and its parameters. 'exit_state_prefix' needs 'PRAGMA case_sensitive_like=true'.
+    """
+    l_cond = []
+    l_param = []
+    if output_pred is not None:
+        if 'tick_start' in output_pred:
+            l_cond.append('tick>=?')
+            l_param.append(int(output_pred['tick_start']))
+        if 'tick_end' in output_pred:
+            l_cond.append('tick<=?')
+            l_param.append(int(output_pred['tick_end']))
+        if 'exit_state' in output_pred:
+            l_cond.append('exit_state=?')
+            l_param.append(output_pred['exit_state'])
+        if 'exit_state_prefix' in output_pred:
+            l_cond.append('exit_state like ?')
+            l_param.append(output_pred['exit_state_prefix'] + '%')
+    return ' and '.join(l_cond) if len(l_cond) > 0 else '1', l_param
+
+
+def planner_node_selectivity(pred, d_prop_dist, num_person):
+    """
+    Estimate the selectivity of a node predicate from per-property value counts, assuming independence.
+    """
+    if pred is None or num_person <= 0:
+        return 1.0
+    op = pred[0]
+    if op == 'and':
+        return float(np.prod([planner_node_selectivity(sub_pred, d_prop_dist, num_person) for sub_pred in pred[1:]]))
+    elif op == 'or':
+        return 1.0 - float(np.prod([1.0 - planner_node_selectivity(sub_pred, d_prop_dist, num_person)
+                                    for sub_pred in pred[1:]]))
+    elif op == 'not':
+        return 1.0 - planner_node_selectivity(pred[1], d_prop_dist, num_person)
+    d_dist = d_prop_dist.get(pred[1])
+    if not d_dist:
+        return 1.0
+    if op == 'eq':
+        return d_dist.get(str(pred[2]), 0) / num_person
+    elif op == 'in':
+        return sum(d_dist.get(str(val), 0) for val in pred[2]) / num_person
+    elif op == 'range':
+        return sum(cnt for val, cnt in d_dist.items() if pred[2] <= float(val) <= pred[3]) / num_person
+    else:
+        raise Exception('[planner_node_selectivity] Unknown op: %s' % op)
+
+
+def person_pred_props(pred):
+    if pred is None:
+        return set()
+    if pred[0] in ['and', 'or', 'not']:
+        return set().union(*[person_pred_props(sub_pred) for sub_pred in pred[1:]])
+    return {pred[1]}
+
+
+def planner_output_count(output_pred, d_cube=None):
+    """
+    Count output records satisfying 'output_pred' by the prefix-sum cube if given, or by SQLite otherwise.
+    """
+    if output_pred is None:
+        output_pred = dict()
+    if d_cube is not None:
+        return output_cube_count(d_cube, output_pred.get('tick_start', -sys.maxsize),
+                                 output_pred.get('tick_end', sys.maxsize), output_pred.get('exit_state'),
+                                 output_pred.get('exit_state_prefix'))
+    where_str, l_param = output_pred_to_sql(output_pred)
+    db_con = connect_to_sqlite(g_epihiper_output_db_path)
+    try:
+        db_con.execute('''PRAGMA case_sensitive_like=true''')
+        return int(db_con.execute('''select count(*) from %s where %s''' % (g_epihiper_output_tb_name, where_str),
+                                  l_param).fetchone()[0])
+    finally:
+        db_con.close()
+
+
+def planner_estimate(spec, d_cube=None, neo4j_driver=None, d_person=None):
+    """
+    Estimate the cardinalities of both sides of 'spec'.
+    If the stats catalog has no node stats (see 'STATS CATALOG'), the number of people is taken from 'd_person' or
+    counted by Neo4j, and node predicates are not discounted.
+    :return: dict
+        num_person:         Number of people.
+        num_node:           People satisfying 'node_pred'.
+        num_edge_scanned:   Edges scanned on the Neo4j side, i.e. all edges at the ticks of 'edge_pred'.
+        num_edge_match:     Edges satisfying 'edge_pred'.
+        num_neo4j_pid:      PIDs satisfying 'node_pred' and 'edge_pred'.
+        num_output_total:   Output records.
+        num_output:         Output records satisfying 'output_pred'.
+    """
+    d_gender_dist = stats_catalog_lookup('node', 'gender') or dict()
+    num_person = sum(d_gender_dist.values())
+    if num_person <= 0:
+        logging.error('[planner_estimate] No node stats in the stats catalog. Run "update_stats_catalog" for better '
+                      'plans. The number of people is counted instead.')
+        if d_person is not None:
+            num_person = d_person['num_person']
+        elif neo4j_driver is not None:
+            ret = execute_neo4j_queries(neo4j_driver, {'database': g_neo4j_db_name, 'default_access_mode': 'READ'},
+                                        ['match (n:PERSON) return count(n)'], need_ret=True)
+            if ret is not None:
+                num_person = int(ret[0][0][0])
+    d_prop_dist = {prop: stats_catalog_lookup('node', prop) for prop in person_pred_props(spec['node_pred'])}
+    s_node = planner_node_selectivity(spec['node_pred'], d_prop_dist, num_person)
+
+    edge_pred = spec['edge_pred']
+    l_tick = None if edge_pred is None else edge_pred.get('l_tick')
+    num_edge_scanned = sum((stats_catalog_lookup('edge', 'all', l_tick) or dict()).values())
+    num_edge_match = num_edge_scanned
+    if edge_pred is not None:
+        if 'src_act' in edge_pred and 'trg_act' in edge_pred:
+            d_pair_dist = stats_catalog_lookup('edge', 'act_pair', l_tick) or dict()
+            num_edge_match = d_pair_dist.get('%s|%s' % (edge_pred['src_act'], edge_pred['trg_act']), 0)
+        elif 'src_act' in edge_pred:
+            num_edge_match = (stats_catalog_lookup('edge', 'src_act', l_tick) or dict()).get(edge_pred['src_act'], 0)
+        elif 'trg_act' in edge_pred:
+            num_edge_match = (stats_catalog_lookup('edge', 'trg_act', l_tick) or dict()).get(edge_pred['trg_act'], 0)
+    if edge_pred is None or num_person <= 0:
+        num_edge_target = num_person
+    else:
+        # Expected distinct targets of 'num_edge_match' edges thrown uniformly onto 'num_person' people.
+        num_edge_target = num_person * (1.0 - math.exp(-num_edge_match / num_person))
+
+    num_output_total = planner_output_count(None, d_cube)
+    num_output = num_output_total if spec['output_pred'] is None else planner_output_count(spec['output_pred'],
+                                                                                           d_cube)
+    return {'num_person': num_person,
+            'num_node': num_person * s_node,
+            'num_edge_scanned': num_edge_scanned,
+            'num_edge_match': num_edge_match,
+            'num_neo4j_pid': num_edge_target * s_node,
+            'num_output_total': num_output_total,
+            'num_output': num_output}
+
+
+def planner_choose(spec, d_est, d_person=None):
+    """
+    Cost every (join order, join strategy) candidate and pick the cheapest.
+    :return: dict
+        'order', 'join', 'est_cost' of the chosen plan, and 'd_cost': (order, join) -> est_cost of all candidates.
+    """
+    c = g_planner_cost
+    has_edge_pred = spec['edge_pred'] is not None
+    can_bitmap = d_person is not None and not has_edge_pred and can_eval_person_pred(spec['node_pred'])
+    avg_in_deg = d_est['num_edge_scanned'] / max(d_est['num_person'], 1)
+    # Output records are indexed by tick, so only a tick window avoids a full scan.
+    if spec['output_pred'] is not None and ('tick_start' in spec['output_pred'] or 'tick_end' in spec['output_pred']):
+        num_output_scanned = d_est['num_output']
+    else:
+        num_output_scanned = d_est['num_output_total']
+    num_output_pid = d_est['num_output']
+    frac_neo4j = d_est['num_neo4j_pid'] / max(d_est['num_person'], 1)
+    num_final = num_output_pid * frac_neo4j
+
+    def sqlite_stage_cost(num_pid):
+        join = 'in_list' if num_pid <= g_planner_in_list_max else 'temp_table'
+        return join, (c['ship_pid'] + c['sqlite_seek']) * num_pid
+
+    d_cost = dict()
+    # SQLITE FIRST
+    cost_1 = c['sqlite_row'] * num_output_scanned
+    cost_final = sqlite_stage_cost(num_final)[1] if spec['result'] == 'exit_state_count' else 0.0
+    d_cost[('sqlite_first', 'in_list')] = cost_1 + cost_final \
+        + (c['ship_pid'] + c['neo4j_seek']) * num_output_pid \
+        + (c['neo4j_edge'] * avg_in_deg * num_output_pid if has_edge_pred else 0.0)
+    if can_bitmap:
+        d_cost[('sqlite_first', 'bitmap')] = cost_1 + cost_final + c['bitmap_pid'] * num_output_pid
+    # NEO4J FIRST
+    if can_bitmap:
+        cost_1 = c['bitmap_pid'] * d_est['num_person']
+    elif has_edge_pred:
+        cost_1 = c['neo4j_edge'] * d_est['num_edge_scanned']
+    else:
+        cost_1 = c['neo4j_node'] * d_est['num_person']
+    join, cost_2 = sqlite_stage_cost(d_est['num_neo4j_pid'])
+    d_cost[('neo4j_first', join)] = cost_1 + c['ship_pid'] * d_est['num_neo4j_pid'] + cost_2
+
+    order, join = min(d_cost, key=lambda plan: d_cost[plan])
+    return {'order': order, 'join': join, 'est_cost': d_cost[(order, join)], 'd_cost': d_cost,
+            'neo4j_stage': 'bitmap' if can_bitmap else 'neo4j'}
+
 
-    l_exit_state_rec = []
-    for row in rows:
-        exit_state = row[0]
-        count = int(row[1])
-        l_exit_state_rec.append((exit_state, count))
+def planner_sqlite_stage(db_cur, l_pid, output_pred, result, join):
+    """
+    Run the SQLite side given PIDs. If 'l_pid' is None, PIDs are not constrained.
+    :return: pandas DataFrame
+        Columns: pid, or exit_state and count, by 'result'.
+    """
+    where_str, l_param = output_pred_to_sql(output_pred)
+    if l_pid is not None:
+        l_pid = [int(pid) for pid in l_pid]
+        if join == 'temp_table':
+            tmp_tb_name = load_pids_into_sqlite_temp_table(db_cur, l_pid)
+            if tmp_tb_name is None:
+                return None
+            where_str += ' and pid in (select pid from %s)' % tmp_tb_name
+        else:
+            where_str += ' and pid in (%s)' % ','.join([str(pid) for pid in l_pid])
+    db_cur.execute('''PRAGMA case_sensitive_like=true''')
+    cache_param = l_pid if join == 'temp_table' else None
+    if result == 'pid':
+        sql_str = '''select distinct pid from %s where %s''' % (g_epihiper_output_tb_name, where_str)
+        return pd.DataFrame(sqlite_fetchall_cached(db_cur, sql_str, l_param, cache_param), columns=['pid'])
+    sql_str = '''select exit_state, count(*) from %s where %s group by exit_state''' \
+              % (g_epihiper_output_tb_name, where_str)
+    return pd.DataFrame(sqlite_fetchall_cached(db_cur, sql_str, l_param, cache_param),
+                        columns=['exit_state', 'count'])
+
+
+def planner_neo4j_stage(neo4j_driver, spec, l_pid, d_person=None, read_only=False):
+    """
+    Run the Neo4j side, or the person bitmap indexes if 'd_person' is given. If 'l_pid' is None, PIDs are not
+    constrained. If 'read_only', the Neo4j session is opened in the READ access mode.
+    :return: ndarray of PIDs
+    """
+    if d_person is not None:
+        if spec['node_pred'] is None:
+            return np.unique(np.asarray(l_pid, dtype=np.int64)) if l_pid is not None else np.asarray(d_person['pid'])
+        return filter_pids_by_person_pred(d_person, spec['node_pred'], l_pid)
+
+    l_cypher = []
+    if l_pid is not None:
+        l_cypher.append('unwind $l_pid as pid match (n:PERSON {pid: pid})')
+    else:
+        l_cypher.append('match (n:PERSON)')
+    if spec['node_pred'] is not None:
+        check_person_pred(spec['node_pred'])
+        l_cypher.append('where %s' % person_pred_to_cypher(spec['node_pred']))
+    if spec['edge_pred'] is not None:
+        l_cypher.append('match ()-[r:CONTACT]->(n) where %s' % edge_pred_to_cypher(spec['edge_pred']))
+    l_cypher.append('return distinct n.pid')
+    query_param = None if l_pid is None else {'l_pid': [int(pid) for pid in l_pid]}
+    neo4j_session_config = {'database': g_neo4j_db_name}
+    if read_only:
+        neo4j_session_config['default_access_mode'] = 'READ'
+    ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, ['\n'.join(l_cypher)],
+                                l_query_param=[query_param], need_ret=True)
+    if ret is None:
+        raise Exception('[planner_neo4j_stage] Neo4j query failed.')
+    return np.asarray([rec[0] for rec in ret[0]], dtype=np.int64)
 
-    df_exit_state = pd.DataFrame(l_exit_state_rec, columns=['exit_state', 'count'])
-    pd.to_pickle(df_exit_state, out_path)
 
-    db_con.close()
-    logging.critical('[query_2_sqlite_1] All done in %s secs.' % str(time.time() - timer_start))
+def run_planned_query(neo4j_driver, spec, d_cube=None, d_col_store=None, d_person=None, read_only=False):
+    """
+    Plan and run a two-store query. See 'CROSS-STORE QUERY PLANNER'.
+    :param
+        d_cube: dict
+            Used for output cardinalities if given. See 'load_output_prefix_cube'.
+    :param
+        d_col_store: dict
+            Used for the output side of 'sqlite_first' if given and 'result' is 'pid'.
+    :param
+        d_person: dict
+            Enables the 'bitmap' strategy if given.
+    :param
+        read_only: bool
+            If True, Neo4j is queried in the READ access mode and SQLite is opened read-only.
+    :return: (pandas DataFrame, dict)
+        The results and the plan with its estimated and actual costs.
+    """
+    timer_start = time.time()
+    d_est = planner_estimate(spec, d_cube, neo4j_driver, d_person)
+    d_plan = planner_choose(spec, d_est, d_person)
+    d_plan['d_est'] = d_est
+    plan_secs = time.time() - timer_start
+    logging.critical('[run_planned_query] Plan: %s + %s, est_cost = %.3f secs, candidates = %s, est = %s'
+                     % (d_plan['order'], d_plan['join'], d_plan['est_cost'], d_plan['d_cost'], d_est))
+
+    stage_d_person = d_person if d_plan['neo4j_stage'] == 'bitmap' else None
+    if read_only:
+        db_con = connect_to_sqlite('file:%s?mode=ro' % g_epihiper_output_db_path, uri=True)
+    else:
+        db_con = connect_to_sqlite(g_epihiper_output_db_path)
+    db_cur = db_con.cursor()
+    try:
+        timer_stage = time.time()
+        if d_plan['order'] == 'sqlite_first':
+            if d_col_store is not None and spec['output_pred'] is not None:
+                output_pred = spec['output_pred']
+                _, np_pid = col_store_select(d_col_store, output_pred.get('tick_start'), output_pred.get('tick_end'),
+                                             output_pred.get('exit_state'), output_pred.get('exit_state_prefix'))
+                np_pid = np.unique(np_pid)
+            else:
+                np_pid = planner_sqlite_stage(db_cur, None, spec['output_pred'], 'pid', None)['pid'].to_numpy()
+            num_stage_1 = len(np_pid)
+            stage_1_secs = time.time() - timer_stage
+            timer_stage = time.time()
+            np_pid = planner_neo4j_stage(neo4j_driver, spec, np_pid, stage_d_person, read_only)
+            if spec['result'] == 'pid':
+                df_ret = pd.DataFrame({'pid': np_pid})
+            else:
+                join = 'in_list' if len(np_pid) <= g_planner_in_list_max else 'temp_table'
+                df_ret = planner_sqlite_stage(db_cur, np_pid, spec['output_pred'], spec['result'], join)
+        else:
+            np_pid = planner_neo4j_stage(neo4j_driver, spec, None, stage_d_person, read_only)
+            num_stage_1 = len(np_pid)
+            stage_1_secs = time.time() - timer_stage
+            timer_stage = time.time()
+            # The planned join is from the estimated number of PIDs. Pick it again from the actual number.
+            join = 'in_list' if len(np_pid) <= g_planner_in_list_max else 'temp_table'
+            df_ret = planner_sqlite_stage(db_cur, np_pid, spec['output_pred'], spec['result'], join)
+        stage_2_secs = time.time() - timer_stage
+    finally:
+        db_con.close()
+
+    d_plan['actual'] = {'plan_secs': plan_secs, 'stage_1_secs': stage_1_secs, 'stage_1_rows': num_stage_1,
+                        'stage_2_secs': stage_2_secs, 'stage_2_rows': 0 if df_ret is None else len(df_ret),
+                        'total_secs': time.time() - timer_start}
+    est_stage_1_rows = d_est['num_output'] if d_plan['order'] == 'sqlite_first' else d_est['num_neo4j_pid']
+    logging.critical('[run_planned_query] Done: est_cost = %.3f secs vs actual %.3f secs, '
+                     'stage 1 est %d rows vs actual %d rows. Actual: %s'
+                     % (d_plan['est_cost'], d_plan['actual']['total_secs'], est_stage_1_rows, num_stage_1,
+                        d_plan['actual']))
+    return df_ret, d_plan
 
 
-# Query 3
-# What are the states that are transitioned to by males between 75 and 90 or by females 32 to 39
-# where the other node of an edge, if there is an edge, is activity work?
-#
-# Solution:
-#   (1) Query Neo4j for PIDs where (n.gender=2 and n.age>=71 and n.age<= 90) or (n.gender=1 and n.age>=32 and n.age<=39)
-#       with incoming edges where r.src_act="1:2".
-#   (2) Query SQLite for exit_state given PIDs.
-#
-# Running Time:
-#   47s
-def query_3_neo4j_1(neo4j_driver, out_path):
+################################################################################
+#   MULTI-COHORT QUERIES
+################################################################################
+# Many named PID lists (cohorts), e.g. one per tick or per exit state, are filtered by the same node predicate in one
+# pass: PIDs are deduplicated across cohorts, each distinct PID is sent and seeked once, and the PIDs passing the
+# predicate are fanned back out to every cohort containing them.
+def query_1_neo4j_multi_cohort(neo4j_driver, d_cohort_pid, batch_size=100000, query_str=None, d_person=None):
     """
-    Query Neo4j for PIDs where (n.gender=2 and n.age>=71 and n.age<= 90) or (n.gender=1 and n.age>=32 and n.age<=39)
-    with incoming edges where r.src_act="1:2".
+    Batched 'query_1_neo4j_1' over many cohorts.
+    :param
+        d_cohort_pid: dict
+            Cohort name -> list of PIDs.
+    :param
+        query_str: str
+            A Cypher query taking the PID list '$infect_pid' and returning the PIDs passing its predicate.
+            'g_query_1_neo4j_1_str' by default.
+    :param
+        d_person: dict
+            If given, 'g_query_1_person_pred' is answered by the person bitmap indexes instead of Neo4j, and
+            'query_str' is ignored.
+    :return: dict
+        Cohort name -> pandas DataFrame with the column 'pid'.
     """
-    logging.critical('[query_3_neo4j_1] Starts.')
+    logging.critical('[query_1_neo4j_multi_cohort] Starts with %s cohorts.' % len(d_cohort_pid))
     timer_start = time.time()
 
+    if query_str is None:
+        query_str = g_query_1_neo4j_1_str
     neo4j_session_config = {'database': g_neo4j_db_name}
 
-    query_str = '''match ()-[r:CONTACT]->(n)
-                   where (r.src_act="1:2") and 
-                         ((n.gender=2 and n.age>=71 and n.age<=90) 
-                          or 
-                          (n.gender=1 and n.age>=32 and n.age<=39))
-                   return distinct n.pid'''
-    ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [query_str], l_query_param=None, need_ret=True)
-    df_ret = pd.DataFrame(ret[0], columns=['pid'])
-    pd.to_pickle(df_ret, out_path)
+    l_np_pid = [np.asarray(l_pid, dtype=np.int64) for l_pid in d_cohort_pid.values()]
+    np_all_pid = np.unique(np.concatenate(l_np_pid)) if len(l_np_pid) > 0 else np.zeros(0, dtype=np.int64)
+    num_total_pid = sum(len(np_pid) for np_pid in l_np_pid)
 
-    logging.critical('[query_3_neo4j_1] All done in %s secs.' % str(time.time() - timer_start))
+    if d_person is not None:
+        np_pass_pid = filter_pids_by_person_pred(d_person, g_query_1_person_pred, np_all_pid)
+    else:
+        l_pass_pid = []
+        for i in range(0, len(np_all_pid), batch_size):
+            query_param = {'infect_pid': np_all_pid[i: i + batch_size].tolist()}
+            ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [query_str],
+                                        l_query_param=[query_param], need_ret=True)
+            if ret is None:
+                raise Exception('[query_1_neo4j_multi_cohort] Failed at batch %s.' % (i // batch_size))
+            l_pass_pid += [rec[0] for rec in ret[0]]
+        np_pass_pid = np.unique(np.asarray(l_pass_pid, dtype=np.int64))
+
+    d_cohort_ret = dict()
+    for cohort_name, np_pid in zip(d_cohort_pid.keys(), l_np_pid):
+        np_cohort_pid = np.unique(np_pid)
+        d_cohort_ret[cohort_name] = pd.DataFrame({'pid': np_cohort_pid[np.isin(np_cohort_pid, np_pass_pid,
+                                                                                assume_unique=True)]})
+
+    logging.critical('[query_1_neo4j_multi_cohort] All done in %s secs: %s PIDs over cohorts, %s distinct, %s passed.'
+                     % (time.time() - timer_start, num_total_pid, len(np_all_pid), len(np_pass_pid)))
+    return d_cohort_ret
+
+
+def cohorts_by_tick(df_pid, cohort_name_fmt='tick_{0}'):
+    """
+    Split a (tick, pid) DataFrame, e.g. the result of 'query_1_sqlite_1', into one cohort per tick.
+    """
+    return {cohort_name_fmt.format(tick): df_tick['pid'].to_list() for tick, df_tick in df_pid.groupby('tick')}
 
 
-def query_3_sqlite_1(df_pid, out_path):
+def benchmark_query_1_multi_cohort(neo4j_driver, d_cohort_pid, out_path=None, batch_size=100000):
     """
-    Query SQLite for exit_state given PIDs with group by.
+    Compare the per-cohort loop of 'query_1_neo4j_1' with 'query_1_neo4j_multi_cohort', and check that both give
+    the same results.
+    :return: dict
+        For each of 'loop' and 'batched': 'secs', 'cohorts_per_sec', 'pids_per_sec'. Also 'num_cohort',
+        'num_total_pid', 'num_distinct_pid', 'speedup' and 'consistent'.
     """
-    logging.critical('[query_3_sqlite_1] Starts.')
-    timer_start = time.time()
+    logging.critical('[benchmark_query_1_multi_cohort] Starts.')
+    num_total_pid = sum(len(l_pid) for l_pid in d_cohort_pid.values())
+    num_distinct_pid = len(set().union(*[set(l_pid) for l_pid in d_cohort_pid.values()])) \
+        if len(d_cohort_pid) > 0 else 0
 
-    l_pid = df_pid['pid'].to_list()
+    timer_start = time.time()
+    d_loop_ret = {cohort_name: query_1_neo4j_1(neo4j_driver, pd.DataFrame({'pid': l_pid}), None)
+                  for cohort_name, l_pid in d_cohort_pid.items()}
+    loop_secs = time.time() - timer_start
 
-    try:
-        db_con = sqlite3.connect(g_epihiper_output_db_path)
-        db_cur = db_con.cursor()
-    except Exception as e:
-        logging.error(e)
-        return None
+    timer_start = time.time()
+    d_batched_ret = query_1_neo4j_multi_cohort(neo4j_driver, d_cohort_pid, batch_size)
+    batched_secs = time.time() - timer_start
+
+    consistent = all(set(d_loop_ret[cohort_name]['pid']) == set(d_batched_ret[cohort_name]['pid'])
+                     for cohort_name in d_cohort_pid)
+    d_bench = {'num_cohort': len(d_cohort_pid), 'num_total_pid': num_total_pid, 'num_distinct_pid': num_distinct_pid,
+               'consistent': consistent}
+    for mode, secs in [('loop', loop_secs), ('batched', batched_secs)]:
+        d_bench[mode] = {'secs': secs,
+                         'cohorts_per_sec': len(d_cohort_pid) / secs if secs > 0 else None,
+                         'pids_per_sec': num_total_pid / secs if secs > 0 else None}
+    d_bench['speedup'] = loop_secs / batched_secs if batched_secs > 0 else None
+    if out_path is not None:
+        with open(out_path, 'w+') as out_fd:
+            json.dump(d_bench, out_fd, indent=4)
+    logging.critical('[benchmark_query_1_multi_cohort] All done: %s' % d_bench)
+    return d_bench
 
-    sql_str = "select exit_state, count(*) from {0} where pid in ({1}) group by exit_state" \
-        .format(g_epihiper_output_tb_name, ','.join(['?'] * len(l_pid)))
-    try:
-        db_cur.execute(sql_str, l_pid)
-        rows = db_cur.fetchall()
-    except Exception as e:
-        logging.error('[query_3_sqlite_1] %s' % e)
-        return None
 
-    l_exit_state_rec = []
-    for row in rows:
-        exit_state = row[0]
-        count = int(row[1])
-        l_exit_state_rec.append((exit_state, count))
+################################################################################
+#   COHORT LABELS
+################################################################################
+# A PID set reused by several Cypher queries is pushed into Neo4j once as a temporary label on its PERSON nodes, named
+# 'g_cohort_label_prefix' + the cohort name. Later queries anchor on the label, e.g. 'match (n:`COHORT_x`)', instead of
+# sending the PIDs as a list parameter and seeking each of them again. The label is set by parallel batched writes,
+# and should be removed by 'drop_pid_cohort' when the cohort is no longer needed.
+# !!!CAUTION!!!
+# Concurrent jobs on the same DB should use distinct cohort names.
+g_cohort_label_prefix = 'COHORT_'
+g_cohort_batch_size = 50000
 
-    df_exit_state = pd.DataFrame(l_exit_state_rec, columns=['exit_state', 'count'])
-    pd.to_pickle(df_exit_state, out_path)
 
-    db_con.close()
-    logging.critical('[query_3_sqlite_1] All done in %s secs.' % str(time.time() - timer_start))
+def cohort_label(cohort_name):
+    return g_cohort_label_prefix + re.sub(r'[^0-9A-Za-z_]', '_', str(cohort_name))
 
 
-# Query 4
-# What people (individuals) are entering the recovered state (in an SIR epidemic) between times 5 and 15 inclusive,
-# where the household income is between $86,000 and $114,000 annually?
-#
-# Question:
-#   Where is the household income information?
+def set_cohort_label_single_task(task_id, neo4j_driver, neo4j_session_config, label, l_pid, batch_size):
+    query_str = '''unwind $l_pid as pid
+                   match (n:PERSON {pid: pid})
+                   set n:`%s`
+                   return count(n)''' % label
+    num_labeled = 0
+    for i in range(0, len(l_pid), batch_size):
+        ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [query_str],
+                                    l_query_param=[{'l_pid': l_pid[i: i + batch_size]}], need_ret=True)
+        if ret is None:
+            raise Exception('[set_cohort_label_single_task] Task %s: Failed at batch %s.' % (task_id, i // batch_size))
+        num_labeled += ret[0][0][0]
+    return num_labeled
 
 
-# Query 5
-# What are the household IDs of households where the number of people in the household is at least 6 and
-# there is at least one child between 8 and 14?
-#
-# Solution:
-#   (1) Only Neo4j is needed. Find all HIDs associated with more than 6 members, then for each HID check if it has
-#       at least one member between 8 and 14.
-def query_5_neo4j_1(neo4j_driver, out_path):
-    logging.critical('[query_5_neo4j_1] Starts.')
+def materialize_pid_cohort(neo4j_driver, cohort_name, l_pid, batch_size=None, num_task=None):
+    """
+    Label the PERSON nodes of 'l_pid'. PIDs are split over 'num_task' threads, and each thread writes in batches of
+    'batch_size'. Nodes are disjoint between threads, so the writes do not contend for locks.
+    If any batch fails, or not every PID is labeled (e.g. a PID has no PERSON node), the partial label is dropped and
+    an exception is raised, so a cohort is never used incomplete.
+    :return: str
+        The label. Cypher needs it in backticks.
+    """
+    logging.critical('[materialize_pid_cohort] Starts with %s PIDs.' % len(l_pid))
     timer_start = time.time()
 
+    if batch_size is None:
+        batch_size = g_cohort_batch_size
+    if num_task is None:
+        num_task = g_concurrency
     neo4j_session_config = {'database': g_neo4j_db_name}
+    label = cohort_label(cohort_name)
+    l_pid = [int(pid) for pid in np.unique(np.asarray(l_pid, dtype=np.int64))]
 
-    query_str = '''match (n:PERSON)  
-                   with distinct n.hid as trg_hid, count(n) as cnt
-                   where cnt>=8
-                   match (m:PERSON)
-                   where m.hid=trg_hid and 8<=m.age<=14
-                   return distinct m.hid'''
-    ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [query_str], l_query_param=None, need_ret=True)
-    df_ret = pd.DataFrame(ret[0], columns=['hid'])
-    pd.to_pickle(df_ret, out_path)
+    task_size = max(math.ceil(len(l_pid) / max(num_task, 1)), 1)
+    l_num_labeled = [0] * math.ceil(len(l_pid) / task_size)
+    l_task_err = []
 
-    logging.critical('[query_5_neo4j_1] All done in %s secs.' % str(time.time() - timer_start))
+    def run_task(task_num_id, l_task_pid):
+        try:
+            l_num_labeled[task_num_id] = set_cohort_label_single_task('Task %s' % task_num_id, neo4j_driver,
+                                                                      neo4j_session_config, label, l_task_pid,
+                                                                      batch_size)
+        except Exception as e:
+            l_task_err.append(e)
+
+    l_task_instance = []
+    for task_num_id, i in enumerate(range(0, len(l_pid), task_size)):
+        task_instance = threading.Thread(target=run_with_instrument_cmd,
+                                         args=(instrument_cmd(), run_task, task_num_id, l_pid[i: i + task_size]),
+                                         name='Task %s' % task_num_id)
+        task_instance.start()
+        l_task_instance.append(task_instance)
+    for task_instance in l_task_instance:
+        task_instance.join()
+
+    if len(l_task_err) > 0 or sum(l_num_labeled) != len(l_pid):
+        drop_pid_cohort(neo4j_driver, cohort_name, batch_size)
+        if len(l_task_err) > 0:
+            raise Exception('[materialize_pid_cohort] Failed to label %s: %s' % (label, l_task_err[0]))
+        raise Exception('[materialize_pid_cohort] Only %s of %s PIDs labeled as %s.'
+                        % (sum(l_num_labeled), len(l_pid), label))
+
+    logging.critical('[materialize_pid_cohort] All done: %s of %s PIDs labeled as %s in %s secs.'
+                     % (sum(l_num_labeled), len(l_pid), label, time.time() - timer_start))
+    return label
+
+
+def drop_pid_cohort(neo4j_driver, cohort_name, batch_size=None):
+    """
+    Remove the label of a cohort from all nodes. Raises if the removal fails in any batch, since a leftover label
+    would leak into the next cohort of the same name.
+    """
+    logging.critical('[drop_pid_cohort] Starts.')
+    timer_start = time.time()
+
+    if batch_size is None:
+        batch_size = g_cohort_batch_size
+    neo4j_session_config = {'database': g_neo4j_db_name}
+    label = cohort_label(cohort_name)
+    query_str = \
+        '''
+        CALL apoc.periodic.iterate
+        (
+            "match (n:`%s`) return n",
+            "remove n:`%s`",
+            {parallel:true, batchSize:%s, concurrency:%s}
+        )
+        yield failedOperations, errorMessages
+        return failedOperations, errorMessages
+        ''' % (label, label, batch_size, g_concurrency)
+    ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [query_str], need_ret=True)
+    if ret is None:
+        raise Exception('[drop_pid_cohort] Failed to drop %s.' % label)
+    num_failed, d_err = ret[0][0]
+    if num_failed > 0:
+        raise Exception('[drop_pid_cohort] %s nodes failed to drop %s: %s' % (num_failed, label, d_err))
+    logging.critical('[drop_pid_cohort] %s dropped in %s secs.' % (label, time.time() - timer_start))
+
+
+def run_with_pid_cohort(neo4j_driver, cohort_name, l_pid, query_fn):
+    """
+    Materialize a cohort, call 'query_fn(cohort_name)', and always drop the cohort afterwards. 'query_fn' gets the
+    cohort name rather than the label, so it anchors on the cohort that was actually materialized.
+    :return: The return of 'query_fn'.
+    """
+    materialize_pid_cohort(neo4j_driver, cohort_name, l_pid)
+    try:
+        return query_fn(cohort_name)
+    finally:
+        drop_pid_cohort(neo4j_driver, cohort_name)
 
 
 ################################################################################
@@ -1399,7 +6031,14 @@ def neo4j_query_to_ttables(neo4j_driver, neo4j_session_config, neo4j_query_str,
     return True
 
 
-def output_in_1nn_batch(neo4j_driver, df_output_pid_over_time, batch_size, out_folder, out_suffix):
+def output_in_1nn_batch(neo4j_driver, df_output_pid_over_time, batch_size, out_folder, out_suffix,
+                        use_cohort_label=False):
+    """
+    :param
+        use_cohort_label: bool
+            If True, the PIDs of each tick are materialized once as a cohort label, and every batch anchors on the
+            label instead of resending the PIDs. See 'COHORT LABELS'.
+    """
     logging.critical('[output_in_1nn_batch] Starts.')
     timer_start = time.time()
 
@@ -1410,30 +6049,591 @@ def output_in_1nn_batch(neo4j_driver, df_output_pid_over_time, batch_size, out_f
                        return s, t, r
                        skip %s limit %s
                     '''
-
+    cohort_query_str_fmt = '''with $tick as tick
+                              match (t:`%s`)
+                              match (s:PERSON)-[r:CONTACT]->(t) where r.occur = tick
+                              return s, t, r
+                              skip %s limit %s
+                           '''
+
+    # One cohort name is reused for all ticks, so that no new label token is left in the DB per tick.
+    cohort_name = 'in_1nn_%s' % out_suffix if use_cohort_label else None
     for tick, pid_rec in df_output_pid_over_time.iterrows():
         l_core_pids = pid_rec['pid']
-        query_param = {'l_core_pid': l_core_pids, 'tick': tick}
+        if use_cohort_label:
+            label = materialize_pid_cohort(neo4j_driver, cohort_name, l_core_pids)
+            query_param = {'tick': tick}
+        else:
+            query_param = {'l_core_pid': l_core_pids, 'tick': tick}
         skip = 0
         limit = batch_size
         batch_cnt = 0
+        try:
+            while True:
+                if use_cohort_label:
+                    neo4j_query_str = cohort_query_str_fmt % (label, skip, limit)
+                else:
+                    neo4j_query_str = query_str_fmt % (skip, limit)
+                ret = neo4j_query_to_ttables(neo4j_driver, neo4j_session_config, neo4j_query_str, query_param,
+                                             out_folder, ''.join([out_suffix, '_', str(batch_cnt)]))
+                if not ret:
+                    print('[output_in_1nn_batch] Done graph output with %s batches for tick %s' % (batch_cnt, tick))
+                    break
+                skip += limit
+                batch_cnt += 1
+        finally:
+            if cohort_name is not None:
+                drop_pid_cohort(neo4j_driver, cohort_name)
+    logging.critical('[output_in_1nn_batch] All done in %s secs.' % str(time.time() - timer_start))
+
+
+################################################################################
+#   COMMAND PIPELINE
+################################################################################
+# Commands linked by '->' are run as a DAG. Each command declares the resources it reads and writes in
+# 'g_d_pipeline_cmd_io'. A resource is either an object held by '__main__' (e.g. 'neo4j_driver', 'd_col_store') or a
+# store prefixed by its kind (e.g. 'neo4j:graph', 'sqlite:output', 'file:cn_csr').
+# A command depends on an earlier one if it reads what the earlier one writes, or writes what the earlier one reads or
+# writes. A command not declared is a barrier, i.e. it waits for all earlier commands and all later ones wait for it.
+# So a pipeline of undeclared commands runs exactly as before.
+# At most 'g_pipeline_num_workers' commands run at a time, and at most 'g_d_pipeline_store_limit[kind]' of them touch
+# stores of the same kind. If 'g_pipeline_parallel' is False, commands are run one by one in order.
+# The timeline of a run is written to 'g_pipeline_trace_path' in the Chrome trace event format, which can be viewed
+# by chrome://tracing or Perfetto.
+# Commands run in worker threads, so Ctrl-C only reaches the main thread waiting in 'run_pipeline'. Long-running
+# commands (e.g. 'query_daemon') add a threading.Event to 'g_l_pipeline_stop_event' while they run, and watch it.
+# On Ctrl-C, 'run_pipeline' sets all of them, starts no more commands, and waits for the running ones. A second Ctrl-C
+# stops waiting.
+g_pipeline_parallel = True
+g_pipeline_num_workers = 4
+g_d_pipeline_store_limit = {'neo4j': 2, 'sqlite': 2}
+g_l_pipeline_stop_event = []
+g_d_pipeline_cmd_io = {
+    # NEO4J
+    'neo4j_driver': ([], ['neo4j_driver']),
+    'create_db': (['neo4j_driver'], ['neo4j:schema']),
+    'create_constraints': (['neo4j_driver'], ['neo4j:schema']),
+    'create_indexes': (['neo4j_driver'], ['neo4j:schema']),
+    'create_nodes': (['neo4j_driver', 'neo4j:schema'], ['neo4j:graph', 'file:household_index']),
+    'create_init_cn_edges': (['neo4j_driver', 'neo4j:schema'], ['neo4j:graph', 'file:tick_degrees', 'file:sketches',
+                                                                'sqlite:stats_catalog']),
+    'create_int_cn_edges': (['neo4j_driver', 'neo4j:schema'], ['neo4j:graph', 'file:tick_degrees', 'file:sketches',
+                                                               'sqlite:stats_catalog']),
+    # SQLITE
+    'create_epihiper_output_db': ([], ['sqlite:output']),
+    'load_epihiper_output_data': ([], ['sqlite:output', 'file:output_cube']),
+    'create_epihiper_output_db_indexes': ([], ['sqlite:output']),
+    'build_output_cube': (['sqlite:output'], ['file:output_cube']),
+    'build_transmission_tree': (['sqlite:output'], ['file:transmission_tree']),
+    'update_stats_catalog': ([], ['sqlite:stats_catalog']),
+    'population_dist_by_age_group': (['sqlite:stats_catalog'], []),
+    'src_act_dist': (['sqlite:stats_catalog'], []),
+    # FILE STORES
+    'build_household_index': ([], ['file:household_index']),
+    'household_index': (['file:household_index'], ['d_hh']),
+    'build_epihiper_output_col_store': ([], ['file:output_col_store']),
+    'epihiper_output_col_store': (['file:output_col_store'], ['d_col_store']),
+    'build_pidset_store': (['d_col_store', 'sqlite:output'], ['file:pidset_store']),
+    'pidset_store': (['file:pidset_store'], ['d_pidset_store']),
+    'build_cn_csr': ([], ['file:cn_csr']),
+    'cn_csr': (['file:cn_csr'], ['d_csr']),
+    'build_person_col_store': ([], ['file:person_col_store']),
+    'person_col_store': (['file:person_col_store'], ['d_person']),
+    'materialize_tick_degrees': ([], ['file:tick_degrees']),
+    'build_sketches': ([], ['file:sketches']),
+    'output_cube_count': (['file:output_cube'], []),
+    # QUERIES
+    'fetch_pids_by_exit_state': (['sqlite:output', 'd_col_store', 'd_pidset_store'], ['file:pid_over_time']),
+    'fetch_new_pids_by_exit_state': (['d_pidset_store'], ['file:new_pid_over_time']),
+    'duration_distribution': (['neo4j_driver', 'neo4j:graph', 'file:pid_over_time'], []),
+    'approx_duration_distribution': (['neo4j_driver', 'neo4j:graph', 'd_csr', 'file:pid_over_time'], []),
+    'ssaqf_duration_distribution': (['neo4j_driver', 'neo4j:graph', 'd_csr', 'file:pid_over_time'], []),
+    'output_in_1nn_batch': (['neo4j_driver', 'neo4j:graph', 'file:pid_over_time'], ['neo4j:cohort']),
+    'infect_in_deg_dist_at_t': (['neo4j_driver', 'neo4j:graph', 'd_col_store', 'file:tick_degrees'], []),
+    'example_query_1': (['neo4j_driver', 'neo4j:graph', 'sqlite:output', 'd_col_store', 'd_person'], []),
+    'example_query_1_cohort': (['neo4j_driver', 'neo4j:graph', 'sqlite:output', 'd_col_store'], ['neo4j:cohort']),
+    'example_query_1_multi_cohort': (['neo4j_driver', 'neo4j:graph', 'sqlite:output', 'd_col_store'], []),
+    'example_query_2': (['neo4j_driver', 'neo4j:graph', 'sqlite:output'], []),
+    'example_query_3': (['neo4j_driver', 'neo4j:graph', 'sqlite:output', 'd_csr', 'd_person'], []),
+    'example_query_5': (['neo4j_driver', 'neo4j:graph', 'd_hh'], []),
+    'planned_query': (['neo4j_driver', 'neo4j:graph', 'sqlite:output', 'sqlite:stats_catalog', 'file:output_cube',
+                       'd_col_store', 'd_person'], []),
+}
+
+
+def pipeline_cmd_io(cmd):
+    """
+    :return: (set, set) or None
+        (Resources read, resources written). None if 'cmd' is not declared, i.e. it is a barrier.
+    """
+    if cmd not in g_d_pipeline_cmd_io:
+        return None
+    l_in, l_out = g_d_pipeline_cmd_io[cmd]
+    return set(l_in), set(l_out)
+
+
+def pipeline_cmd_store_kinds(cmd):
+    """
+    :return: set
+        Kinds of stores touched by 'cmd' that are limited by 'g_d_pipeline_store_limit'.
+    """
+    io = pipeline_cmd_io(cmd)
+    if io is None:
+        return set()
+    return set([res.split(':', 1)[0] for res in io[0] | io[1]
+                if ':' in res and res.split(':', 1)[0] in g_d_pipeline_store_limit])
+
+
+def build_pipeline_dag(l_cmd):
+    """
+    :return: list of set
+        For each command in 'l_cmd', the indexes of the earlier commands it depends on.
+    """
+    l_io = [pipeline_cmd_io(cmd) for cmd in l_cmd]
+    l_dep = []
+    for idx, io in enumerate(l_io):
+        s_dep = set()
+        for prev_idx in range(idx):
+            prev_io = l_io[prev_idx]
+            if io is None or prev_io is None \
+                    or io[0] & prev_io[1] or io[1] & prev_io[0] or io[1] & prev_io[1]:
+                s_dep.add(prev_idx)
+        l_dep.append(s_dep)
+    return l_dep
+
+
+def run_pipeline(l_cmd, run_cmd_fn, num_workers=None, trace_path=None):
+    """
+    Run 'run_cmd_fn(cmd)' for each command in 'l_cmd' by worker threads as soon as its dependencies are done and the
+    limits allow. Among ready commands, earlier ones are started first. If a command fails (including 'sys.exit'),
+    no more commands are started, the running ones are waited for, and the error is raised again. Ctrl-C is handled
+    the same way after setting the events in 'g_l_pipeline_stop_event'.
+    :return: list of dict
+        The timeline, one record per command started.
+    """
+    if num_workers is None:
+        num_workers = g_pipeline_num_workers if g_pipeline_parallel else 1
+    timer_start = time.time()
+    l_dep = build_pipeline_dag(l_cmd)
+    l_kind = [pipeline_cmd_store_kinds(cmd) for cmd in l_cmd]
+    for idx, cmd in enumerate(l_cmd):
+        logging.critical('[run_pipeline] %s: %s depends on %s' % (idx, cmd, sorted(l_dep[idx])))
+
+    cond = threading.Condition()
+    s_started = set()
+    s_done = set()
+    d_slot = dict()
+    d_kind_use = {kind: 0 for kind in g_d_pipeline_store_limit}
+    l_error = []
+    l_timeline = []
+
+    def run_pipeline_stage(idx, slot):
+        cmd = l_cmd[idx]
+        stage_start = time.time()
+        error = None
+        try:
+            run_with_instrument_cmd(cmd, run_cmd_fn, cmd)
+        except BaseException as e:
+            error = e
+        stage_end = time.time()
+        with cond:
+            l_timeline.append({'idx': idx, 'cmd': cmd, 'slot': slot, 'start': stage_start - timer_start,
+                               'end': stage_end - timer_start, 'deps': sorted(l_dep[idx]),
+                               'kinds': sorted(l_kind[idx]), 'error': None if error is None else repr(error)})
+            if error is not None:
+                l_error.append(error)
+            s_done.add(idx)
+            del d_slot[idx]
+            for kind in l_kind[idx]:
+                d_kind_use[kind] -= 1
+            cond.notify_all()
+
+    with cond:
+        while len(s_done) < len(l_cmd) and not l_error:
+            for idx in range(len(l_cmd)):
+                if len(d_slot) >= num_workers:
+                    break
+                if idx in s_started or not l_dep[idx] <= s_done:
+                    continue
+                if any([d_kind_use[kind] >= g_d_pipeline_store_limit[kind] for kind in l_kind[idx]]):
+                    continue
+                slot = min(set(range(num_workers)) - set(d_slot.values()))
+                d_slot[idx] = slot
+                s_started.add(idx)
+                for kind in l_kind[idx]:
+                    d_kind_use[kind] += 1
+                threading.Thread(target=run_pipeline_stage, args=(idx, slot),
+                                 name='pipeline_%s_%s' % (idx, l_cmd[idx]), daemon=True).start()
+            try:
+                cond.wait()
+            except KeyboardInterrupt as e:
+                logging.critical('[run_pipeline] Interrupted. Stopping %s running commands.' % len(d_slot))
+                l_error.append(e)
+                for stop_event in list(g_l_pipeline_stop_event):
+                    stop_event.set()
+        try:
+            while len(d_slot) > 0:
+                cond.wait()
+        except KeyboardInterrupt as e:
+            logging.critical('[run_pipeline] Interrupted again. Not waiting for %s running commands.' % len(d_slot))
+            l_error.insert(0, e)
+
+    l_timeline = sorted(l_timeline, key=lambda d_stage: d_stage['start'])
+    total_secs = time.time() - timer_start
+    logging.critical('[run_pipeline] %s of %s commands run in %s secs (%s secs if serial).'
+                     % (len(l_timeline), len(l_cmd), total_secs,
+                        sum([d_stage['end'] - d_stage['start'] for d_stage in l_timeline])))
+    write_pipeline_trace(l_timeline, trace_path)
+    if l_error:
+        raise l_error[0]
+    return l_timeline
+
+
+def write_pipeline_trace(l_timeline, trace_path=None):
+    """
+    Write the timeline in the Chrome trace event format. Each worker slot is a row.
+    """
+    if trace_path is None:
+        trace_path = g_pipeline_trace_path
+    l_event = []
+    for d_stage in l_timeline:
+        l_event.append({'name': d_stage['cmd'], 'cat': ','.join(d_stage['kinds']) or 'none', 'ph': 'X',
+                        'ts': int(d_stage['start'] * 1000000),
+                        'dur': int((d_stage['end'] - d_stage['start']) * 1000000),
+                        'pid': os.getpid(), 'tid': d_stage['slot'],
+                        'args': {'idx': d_stage['idx'], 'deps': d_stage['deps'], 'error': d_stage['error']}})
+    try:
+        if not path.exists(path.dirname(trace_path)):
+            os.makedirs(path.dirname(trace_path))
+        with open(trace_path, 'w+') as out_fd:
+            json.dump({'traceEvents': l_event, 'displayTimeUnit': 'ms'}, out_fd, indent=4)
+        logging.critical('[write_pipeline_trace] Trace written to %s.' % trace_path)
+    except Exception as e:
+        logging.error('[write_pipeline_trace] %s' % e)
+
+
+################################################################################
+#   QUERY DAEMON
+################################################################################
+# 'serve_query_daemon' keeps the Neo4j driver, the open stores and the caches of a pipeline warm, and serves requests
+# over the Unix socket at 'g_query_daemon_socket_path'. Connections are served by 'g_query_daemon_num_workers' worker
+# threads, and each worker keeps its own read-only SQLite connection. Neo4j is only queried in the READ access mode.
+# The socket is only accessible by its owner, and client SQL may only read.
+# A connection idle for 'g_query_daemon_idle_timeout' secs is closed, so idle clients do not hold workers. On stop,
+# open connections are shut down for reading, so that workers finish their current request and exit. It is meant to
+# be the last command of a pipeline, e.g.
+#   > python neo4j_ops.py "neo4j_driver->epihiper_output_col_store->person_col_store->pidset_store->query_daemon"
+# Each request and each response is a JSON object on one line, and a connection may send any number of requests.
+# Requests:
+#   {"op": "ping"}
+#   {"op": "planned_query", "query": "query_1"}                 One of 'g_query_daemon_spec'.
+#   {"op": "planned_query", "spec": {...}}                      See 'CROSS-STORE QUERY PLANNER' and 'check_person_pred'.
+#   {"op": "output_cube_count", "tick_start": 5, "tick_end": 15, "exit_state": "Isymp_s", "l_group_by": [...]}
+#   {"op": "pids_at_tick", "tick": 5, "exit_state": "Isymp_s", "newly_entered": false, "count_only": false}
+#   {"op": "cypher", "query": "...", "param": {...}}            Read-only.
+#   {"op": "sql", "query": "...", "param": [...]}               Select only, on the EpiHiper output DB.
+#   {"op": "stats"}
+#   {"op": "shutdown"}
+# Responses are {"ok": true, "secs": <server-side secs>, "result": ...} or {"ok": false, "error": "..."}. DataFrames
+# are sent as {"columns": [...], "index": [...], "data": [...]}.
+g_query_daemon_num_workers = 8
+g_query_daemon_accept_timeout = 1.0
+g_query_daemon_idle_timeout = 60.0
+g_query_daemon_spec = {'query_1': g_query_1_spec, 'query_2': g_query_2_spec, 'query_3': g_query_3_spec}
+# Actions allowed to client SQL. Anything else, e.g. ATTACH, PRAGMA or any write, is denied.
+g_query_daemon_sql_action = {sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ, sqlite3.SQLITE_FUNCTION,
+                             sqlite3.SQLITE_RECURSIVE}
+
+
+def query_daemon_sql_authorizer(action, arg_1, arg_2, db_name, trigger_name):
+    return sqlite3.SQLITE_OK if action in g_query_daemon_sql_action else sqlite3.SQLITE_DENY
+
+
+def query_daemon_jsonable(obj):
+    """
+    Convert results into what 'json.dumps' accepts. NaN becomes null.
+    """
+    if isinstance(obj, pd.DataFrame):
+        return {'columns': [query_daemon_jsonable(col) for col in obj.columns],
+                'index': query_daemon_jsonable(obj.index.to_list()),
+                'data': query_daemon_jsonable(obj.values.tolist())}
+    if isinstance(obj, pd.Series):
+        return query_daemon_jsonable(obj.to_frame())
+    if isinstance(obj, np.ndarray):
+        return query_daemon_jsonable(obj.tolist())
+    if isinstance(obj, np.generic):
+        return query_daemon_jsonable(obj.item())
+    if isinstance(obj, float) and math.isnan(obj):
+        return None
+    if isinstance(obj, dict):
+        return {key if isinstance(key, str) else '+'.join(map(str, key)) if isinstance(key, tuple) else str(key):
+                query_daemon_jsonable(val) for key, val in obj.items()}
+    if isinstance(obj, (list, tuple, set)):
+        return [query_daemon_jsonable(item) for item in obj]
+    if obj is None or isinstance(obj, (str, int, float, bool)):
+        return obj
+    return str(obj)
+
+
+def query_daemon_pred(pred):
+    """
+    Node predicates arrive as nested lists. Turn them back into nested tuples.
+    """
+    if isinstance(pred, list):
+        return tuple([query_daemon_pred(item) for item in pred])
+    return pred
+
+
+def handle_query_daemon_request(d_req, d_state):
+    """
+    :param
+        d_req: dict
+            A request. See 'QUERY DAEMON'.
+    :param
+        d_state: dict
+            Warm objects of the daemon. Keys: 'neo4j_driver', 'd_cube', 'd_col_store', 'd_person', 'd_pidset_store',
+            'thread_local', 'd_stats', 'lock', 'stop', 's_conn'.
+    :return: JSON-able object
+        The result. Raises an exception if the request cannot be served.
+    """
+    op = d_req.get('op')
+    if op == 'ping':
+        return 'pong'
+
+    elif op == 'planned_query':
+        if 'spec' in d_req:
+            spec = {'node_pred': query_daemon_pred(d_req['spec'].get('node_pred')),
+                    'edge_pred': d_req['spec'].get('edge_pred'),
+                    'output_pred': d_req['spec'].get('output_pred'),
+                    'result': d_req['spec'].get('result', 'pid')}
+            if spec['node_pred'] is not None:
+                check_person_pred(spec['node_pred'])
+        elif d_req.get('query') in g_query_daemon_spec:
+            spec = g_query_daemon_spec[d_req['query']]
+        else:
+            raise Exception('[handle_query_daemon_request] Unknown query: %s' % d_req.get('query'))
+        df_ret, d_plan = run_planned_query(d_state['neo4j_driver'], spec, d_state['d_cube'], d_state['d_col_store'],
+                                           d_state['d_person'], read_only=True)
+        return {'df': query_daemon_jsonable(df_ret),
+                'plan': query_daemon_jsonable({'order': d_plan['order'], 'join': d_plan['join'],
+                                               'est_cost': d_plan['est_cost'], 'actual': d_plan['actual']})}
+
+    elif op == 'output_cube_count':
+        if d_state['d_cube'] is None:
+            raise Exception('[handle_query_daemon_request] No output cube. Run "build_output_cube" first.')
+        df_cnt = output_cube_count(d_state['d_cube'], d_req['tick_start'], d_req['tick_end'],
+                                   exit_state=d_req.get('exit_state'),
+                                   exit_state_prefix=d_req.get('exit_state_prefix'),
+                                   l_group_by=d_req.get('l_group_by'), d_group_filter=d_req.get('d_group_filter'))
+        return query_daemon_jsonable(df_cnt)
+
+    elif op == 'pids_at_tick':
+        if d_state['d_pidset_store'] is None:
+            raise Exception('[handle_query_daemon_request] No PID set store. Run "pidset_store" first.')
+        if d_req.get('newly_entered', False):
+            d_pidset = pidset_store_newly_entered(d_state['d_pidset_store'], d_req['tick'], d_req.get('exit_state'),
+                                                  d_req.get('exit_state_prefix'))
+        else:
+            d_pidset = pidset_store_get(d_state['d_pidset_store'], d_req['tick'], d_req.get('exit_state'),
+                                        d_req.get('exit_state_prefix'))
+        if d_req.get('count_only', False):
+            return {'count': pidset_cardinality(d_pidset)}
+        np_pid = pidset_to_pids(d_pidset)
+        return {'count': len(np_pid), 'pid': np_pid.tolist()}
+
+    elif op == 'cypher':
+        if not is_cacheable_neo4j_query(d_req['query']):
+            raise Exception('[handle_query_daemon_request] Only read-only Cypher queries are served.')
+        neo4j_session_config = {'database': g_neo4j_db_name, 'default_access_mode': 'READ'}
+        l_ret = execute_neo4j_queries(d_state['neo4j_driver'], neo4j_session_config, [d_req['query']],
+                                      l_query_param=[d_req.get('param')], need_ret=True)
+        if l_ret is None:
+            raise Exception('[handle_query_daemon_request] Cypher query failed.')
+        return query_daemon_jsonable(l_ret[0])
+
+    elif op == 'sql':
+        thread_local = d_state['thread_local']
+        if getattr(thread_local, 'db_con', None) is None:
+            thread_local.db_con = connect_to_sqlite('file:%s?mode=ro' % g_epihiper_output_db_path, uri=True)
+            thread_local.db_con.set_authorizer(query_daemon_sql_authorizer)
+        db_cur = thread_local.db_con.cursor()
+        rows = sqlite_fetchall_cached(db_cur, d_req['query'], d_req.get('param'))
+        return query_daemon_jsonable(rows)
+
+    elif op == 'stats':
+        with d_state['lock']:
+            d_stats = dict(d_state['d_stats'])
+        d_stats['uptime_secs'] = time.time() - d_stats['start']
+        d_stats['query_cache'] = query_cache_stats()
+        return query_daemon_jsonable(d_stats)
+
+    elif op == 'shutdown':
+        d_state['stop'].set()
+        return 'bye'
+
+    else:
+        raise Exception('[handle_query_daemon_request] Unknown op: %s' % op)
+
+
+def serve_query_daemon_conn(conn, d_state):
+    """
+    Serve the requests on a connection until the client closes it, it is idle for 'g_query_daemon_idle_timeout'
+    secs, or the daemon stops.
+    """
+    conn.settimeout(g_query_daemon_idle_timeout)
+    with d_state['lock']:
+        d_state['s_conn'].add(conn)
+    try:
+        with conn, conn.makefile('rb') as in_fd:
+            for line in in_fd:
+                if d_state['stop'].is_set():
+                    return
+                if not line.strip():
+                    continue
+                timer_start = time.time()
+                op = None
+                try:
+                    d_req = json.loads(line)
+                    op = d_req.get('op')
+                    d_resp = {'ok': True, 'result': handle_query_daemon_request(d_req, d_state)}
+                except Exception as e:
+                    logging.error('[serve_query_daemon_conn] %s' % e)
+                    d_resp = {'ok': False, 'error': str(e)}
+                secs = time.time() - timer_start
+                d_resp['secs'] = secs
+                with d_state['lock']:
+                    d_stats = d_state['d_stats']
+                    d_stats['num_req'] += 1
+                    d_stats['num_error'] += 0 if d_resp['ok'] else 1
+                    d_stats['total_secs'] += secs
+                    d_stats['d_op_count'][str(op)] = d_stats['d_op_count'].get(str(op), 0) + 1
+                try:
+                    conn.sendall((json.dumps(d_resp, default=str) + '\n').encode('utf-8'))
+                except OSError as e:
+                    logging.error('[serve_query_daemon_conn] Client gone: %s' % e)
+                    return
+    except socket.timeout:
+        logging.critical('[serve_query_daemon_conn] Idle connection closed.')
+    finally:
+        with d_state['lock']:
+            d_state['s_conn'].discard(conn)
+
+
+def query_daemon_worker(q_conn, d_state):
+    thread_local = d_state['thread_local']
+    while True:
+        conn = q_conn.get()
+        if conn is None:
+            break
+        try:
+            serve_query_daemon_conn(conn, d_state)
+        except Exception as e:
+            logging.error('[query_daemon_worker] %s' % e)
+    if getattr(thread_local, 'db_con', None) is not None:
+        thread_local.db_con.close()
+
+
+def serve_query_daemon(neo4j_driver, d_col_store=None, d_person=None, d_pidset_store=None, socket_path=None,
+                       num_workers=None):
+    """
+    Serve requests until a 'shutdown' request, KeyboardInterrupt, or a stop from 'run_pipeline'. See 'QUERY DAEMON'.
+    """
+    if socket_path is None:
+        socket_path = g_query_daemon_socket_path
+    if num_workers is None:
+        num_workers = g_query_daemon_num_workers
+    d_cube = None
+    if path.exists(path.join(g_output_cube_folder, 'meta.json')):
+        d_cube = load_output_prefix_cube()
+    d_state = {'neo4j_driver': neo4j_driver, 'd_cube': d_cube, 'd_col_store': d_col_store, 'd_person': d_person,
+               'd_pidset_store': d_pidset_store, 'thread_local': threading.local(), 'lock': threading.Lock(),
+               'stop': threading.Event(), 's_conn': set(),
+               'd_stats': {'start': time.time(), 'num_req': 0, 'num_error': 0, 'total_secs': 0.0,
+                           'd_op_count': dict()}}
+
+    if path.exists(socket_path):
+        os.remove(socket_path)
+    server_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server_sock.bind(socket_path)
+    # Only the owner may connect. Nothing can connect before 'listen', so there is no window before 'chmod'.
+    os.chmod(socket_path, 0o600)
+    server_sock.listen(num_workers * 4)
+    server_sock.settimeout(g_query_daemon_accept_timeout)
+
+    q_conn = queue.Queue()
+    l_worker = [threading.Thread(target=run_with_instrument_cmd,
+                                 args=(instrument_cmd(), query_daemon_worker, q_conn, d_state),
+                                 name='query_daemon_%s' % i, daemon=True)
+                for i in range(num_workers)]
+    for worker in l_worker:
+        worker.start()
+    logging.critical('[serve_query_daemon] Serving on %s with %s workers.' % (socket_path, num_workers))
+
+    g_l_pipeline_stop_event.append(d_state['stop'])
+    try:
+        while not d_state['stop'].is_set():
+            try:
+                conn, _ = server_sock.accept()
+            except socket.timeout:
+                continue
+            q_conn.put(conn)
+    except KeyboardInterrupt:
+        logging.critical('[serve_query_daemon] Interrupted.')
+    finally:
+        d_state['stop'].set()
+        g_l_pipeline_stop_event.remove(d_state['stop'])
+        server_sock.close()
+        if path.exists(socket_path):
+            os.remove(socket_path)
         while True:
-            neo4j_query_str = query_str_fmt % (skip, limit)
-            ret = neo4j_query_to_ttables(neo4j_driver, neo4j_session_config, neo4j_query_str, query_param, out_folder,
-                                         ''.join([out_suffix, '_', str(batch_cnt)]))
-            if not ret:
-                print('[output_in_1nn_batch] Done graph output with %s batches for tick %s' % (batch_cnt, tick))
+            try:
+                conn = q_conn.get_nowait()
+            except queue.Empty:
                 break
-            skip += limit
-            batch_cnt += 1
-    logging.critical('[output_in_1nn_batch] All done in %s secs.' % str(time.time() - timer_start))
+            if conn is not None:
+                conn.close()
+        with d_state['lock']:
+            l_conn = list(d_state['s_conn'])
+        for conn in l_conn:
+            try:
+                conn.shutdown(socket.SHUT_RD)
+            except OSError:
+                pass
+        for _ in l_worker:
+            q_conn.put(None)
+        for worker in l_worker:
+            worker.join(g_query_daemon_idle_timeout)
+            if worker.is_alive():
+                logging.error('[serve_query_daemon] %s is still busy. Not waiting for it.' % worker.name)
+    logging.critical('[serve_query_daemon] All done: %s' % d_state['d_stats'])
+    return d_state['d_stats']
+
+
+def query_daemon_request(l_req, socket_path=None):
+    """
+    Send requests over one connection to the daemon.
+    :return: list of dict
+        Responses in the order of 'l_req'.
+    """
+    if socket_path is None:
+        socket_path = g_query_daemon_socket_path
+    l_resp = []
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_sock:
+        client_sock.connect(socket_path)
+        with client_sock.makefile('rb') as in_fd:
+            for d_req in l_req:
+                client_sock.sendall((json.dumps(d_req) + '\n').encode('utf-8'))
+                l_resp.append(json.loads(in_fd.readline()))
+    return l_resp
 
 
 if __name__ == '__main__':
     ############################################################
     #   USAGE
     #   You need to set up the environment variable 'NEO4J_HOSTNAME' to the hostname of the machine on which
-    #   the Neo4j server is running.
+    #   the Neo4j server is running. It is only checked by 'neo4j_driver', so SQLite-only pipelines do not need it.
+    #   pandas, neo4j, matplotlib, seaborn and snap are imported on first use, so commands not touching them do not
+    #   load them, and plotting and SNAP are optional.
     #   !!!CAUTION!!!
     #   When DB has already been pretty large, DO NOT use 'purge_db' due to high complexity. Instead, it'd be much
     #   easier simply removing the entire DB.
@@ -1451,30 +6651,44 @@ if __name__ == '__main__':
     #   > python neo4j_ops.py "neo4j_driver->build_int_cn"
     #   NOTE
     #   1. All commands should be linked by '->'.
-    #   2. The order of commands matters.
+    #   2. The order of commands matters. Commands declared in 'g_d_pipeline_cmd_io' run concurrently when they do not
+    #      depend on each other. See 'COMMAND PIPELINE'.
     ############################################################
     logging.basicConfig(level=logging.ERROR)
-
-    neo4j_hostname = os.getenv(g_neo4j_hostname_env_key)
-    if neo4j_hostname is None or neo4j_hostname == '':
-        logging.error('[main] The environment variable NEO4J_HOSTNAME is not set yet!')
-        sys.exit(-1)
-    g_neo4j_server_uri = g_neo4j_server_uri_fmt.format(neo4j_hostname)
-    logging.critical('[main] g_neo4j_server_uri is set to %s' % g_neo4j_server_uri)
+    logging.critical('[main] Module loaded in %s secs.' % str(time.time() - g_module_load_start))
 
     cmd_pipeline = sys.argv[1]
     l_cmd = [cmd.strip().lower() for cmd in cmd_pipeline.split('->')]
     logging.critical('[main] Commands to be executed: %s' % l_cmd)
 
     neo4j_driver = None
+    d_col_store = None
+    d_csr = None
+    d_person = None
+    d_hh = None
+    d_pidset_store = None
+
+    # Each command is run by 'run_cmd'. See 'COMMAND PIPELINE' for how the commands are scheduled.
+    def run_cmd(cmd):
+        global neo4j_driver, d_col_store, d_csr, d_person, d_hh, d_pidset_store
+        global g_neo4j_server_uri, g_instrument_enabled, g_instrument_profile, g_query_cache_enabled
+        # Any command that changes a DB invalidates the query result cache.
+        if cmd in g_l_load_epoch_cmd:
+            bump_load_epoch()
 
-    for cmd in l_cmd:
         if cmd == '':
             logging.critical('[main] Nothing to do.')
 
         # CONNECT TO NEO4J DRIVER
+        # Only Neo4j commands need 'NEO4J_HOSTNAME'.
         elif cmd == 'neo4j_driver':
             logging.critical('[main] neo4j_driver starts.')
+            neo4j_hostname = os.getenv(g_neo4j_hostname_env_key)
+            if neo4j_hostname is None or neo4j_hostname == '':
+                logging.error('[main] The environment variable NEO4J_HOSTNAME is not set yet!')
+                sys.exit(-1)
+            g_neo4j_server_uri = g_neo4j_server_uri_fmt.format(neo4j_hostname)
+            logging.critical('[main] g_neo4j_server_uri is set to %s' % g_neo4j_server_uri)
             neo4j_driver = connect_to_neo4j_driver(g_neo4j_server_uri, (g_neo4j_username, g_neo4j_password),
                                                    {'max_connection_lifetime': 1000})
             logging.critical('[main] neo4j_driver done.')
@@ -1611,8 +6825,26 @@ if __name__ == '__main__':
             batch_size = 100000
             method = 'apoc'
             create_nodes_for_init_cn(neo4j_driver, batch_size, method=method, task_carrier_type='thread')
+            build_household_index()
+            if g_build_sketches:
+                build_person_sketches()
+            if g_maintain_stats_catalog:
+                update_stats_catalog_for_nodes()
             logging.critical('[main] create_nodes done.')
 
+        # BUILD HOUSEHOLD INDEX
+        # Also run by "create_nodes". Run it alone only when nodes have been loaded already.
+        elif cmd == 'build_household_index':
+            logging.critical('[main] build_household_index starts.')
+            build_household_index()
+            logging.critical('[main] build_household_index done.')
+
+        # OPEN HOUSEHOLD INDEX
+        elif cmd == 'household_index':
+            logging.critical('[main] household_index starts.')
+            d_hh = load_household_index()
+            logging.critical('[main] household_index done.')
+
         # CREATE EDGES FOR INITIAL CONTACT NETWORK
         elif cmd == 'create_init_cn_edges':
             logging.critical('[main] create_init_cn_edges starts.')
@@ -1620,6 +6852,7 @@ if __name__ == '__main__':
             method = 'apoc'
             occur = -1
             create_edges(g_init_cn_file_name, occur, neo4j_driver, batch_size, method)
+            process_loaded_tick(occur, g_init_cn_path)
             logging.critical('[main] create_init_cn_edges done.')
 
         # CREATE EDGES FOR INTERMEDIATE CONTACT NETWORKS
@@ -1643,22 +6876,259 @@ if __name__ == '__main__':
             logging.critical('[main] load_epihiper_output_data starts.')
             batch_size = 10000
             load_epihiper_output_to_db(batch_size)
+            if g_materialize_output_cube:
+                build_output_prefix_cube()
             logging.critical('[main] load_epihiper_output_data done.')
 
+        # BUILD EPIHIPER OUTPUT PREFIX-SUM CUBE
+        # Also run by "load_epihiper_output_data". Run it alone only when the output has been loaded already.
+        elif cmd == 'build_output_cube':
+            logging.critical('[main] build_output_cube starts.')
+            build_output_prefix_cube()
+            logging.critical('[main] build_output_cube done.')
+
+        # COUNT ENTRIES INTO AN EXIT STATE OVER A TICK WINDOW BY DEMOGRAPHICS
+        elif cmd == 'output_cube_count':
+            logging.critical('[main] output_cube_count starts.')
+            timer_start = time.time()
+            d_cube = load_output_prefix_cube()
+            if d_cube is not None:
+                df_cnt = output_cube_count(d_cube, 5, 15, exit_state='Isymp_s', l_group_by=['age_group', 'gender'])
+                logging.critical('[main] Isymp_s in ticks [5, 15]:\n%s' % df_cnt)
+            logging.critical('[main] output_cube_count done in %s secs.' % str(time.time() - timer_start))
+
+        # BUILD EPIHIPER OUTPUT COLUMNAR STORE
+        elif cmd == 'build_epihiper_output_col_store':
+            logging.critical('[main] build_epihiper_output_col_store starts.')
+            build_epihiper_output_col_store()
+            logging.critical('[main] build_epihiper_output_col_store done.')
+
+        # OPEN EPIHIPER OUTPUT COLUMNAR STORE
+        # Following commands that support the columnar store use it instead of SQLite or the output CSV file.
+        elif cmd == 'epihiper_output_col_store':
+            logging.critical('[main] epihiper_output_col_store starts.')
+            d_col_store = load_epihiper_output_col_store()
+            logging.critical('[main] epihiper_output_col_store done.')
+
+        # BUILD PID SET STORE
+        # The columnar store is used if "epihiper_output_col_store" is run beforehand. Otherwise, SQLite is used.
+        elif cmd == 'build_pidset_store':
+            logging.critical('[main] build_pidset_store starts.')
+            build_pidset_store(d_col_store=d_col_store)
+            logging.critical('[main] build_pidset_store done.')
+
+        # OPEN PID SET STORE
+        elif cmd == 'pidset_store':
+            logging.critical('[main] pidset_store starts.')
+            d_pidset_store = load_pidset_store()
+            logging.critical('[main] pidset_store done.')
+
+        # BUILD CSR TEMPORAL CONTACT NETWORK
+        elif cmd == 'build_cn_csr':
+            logging.critical('[main] build_cn_csr starts.')
+            l_time_points = [5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15]
+            build_cn_csr(l_time_points)
+            logging.critical('[main] build_cn_csr done.')
+
+        # MATERIALIZE PER-TICK DEGREE TABLES
+        # Only needed for ticks loaded before degree materialization was enabled.
+        elif cmd == 'materialize_tick_degrees':
+            logging.critical('[main] materialize_tick_degrees starts.')
+            l_time_points = [5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15]
+            materialize_tick_degrees(-1, g_init_cn_path)
+            search_folder = path.join(g_init_cn_folder, g_int_cn_folder)
+            for time_point, dirpath, filename in search_int_cn_files(search_folder, l_time_points):
+                materialize_tick_degrees(time_point, path.join(dirpath, filename))
+            logging.critical('[main] materialize_tick_degrees done.')
+
+        # BUILD LOAD-TIME SKETCHES
+        # Only needed for nodes and ticks loaded before sketches were enabled.
+        elif cmd == 'build_sketches':
+            logging.critical('[main] build_sketches starts.')
+            l_time_points = [5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15]
+            build_person_sketches()
+            build_tick_sketches(-1, g_init_cn_path)
+            search_folder = path.join(g_init_cn_folder, g_int_cn_folder)
+            for time_point, dirpath, filename in search_int_cn_files(search_folder, l_time_points):
+                build_tick_sketches(time_point, path.join(dirpath, filename))
+            logging.critical('[main] build_sketches done.')
+
+        # QUERY SUMMARY STATISTICS FROM SKETCHES
+        elif cmd == 'sketch_stats':
+            logging.critical('[main] sketch_stats starts.')
+            timer_start = time.time()
+            l_tick = [-1, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15]
+            logging.critical('[main] distinct: %s' % sketch_stats_distinct(l_tick))
+            logging.critical('[main] src_act_dist: %s' % sketch_stats_act_dist(l_tick, role='src'))
+            logging.critical('[main] duration quantiles: %s' % sketch_stats_duration_quantiles(l_tick))
+            logging.critical('[main] population_dist_by_age_group: %s' % sketch_stats_population_dist('age_group'))
+            logging.critical('[main] sketch_stats done in %s secs.' % str(time.time() - timer_start))
+
+        # UPDATE STATISTICS CATALOG
+        # Only needed for nodes and ticks loaded before the catalog was maintained.
+        elif cmd == 'update_stats_catalog':
+            logging.critical('[main] update_stats_catalog starts.')
+            l_time_points = [5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15]
+            update_stats_catalog_for_nodes()
+            update_stats_catalog_for_tick(-1, g_init_cn_path)
+            search_folder = path.join(g_init_cn_folder, g_int_cn_folder)
+            for time_point, dirpath, filename in search_int_cn_files(search_folder, l_time_points):
+                update_stats_catalog_for_tick(time_point, path.join(dirpath, filename))
+            logging.critical('[main] update_stats_catalog done.')
+
+        # QUERY POPULATION DISTRIBUTION GROUPED BY age_group
+        elif cmd == 'population_dist_by_age_group':
+            logging.critical('[main] population_dist_by_age_group starts.')
+            timer_start = time.time()
+            logging.critical(stats_catalog_lookup('node', 'age_group'))
+            logging.critical('Running time: %s' % str(time.time() - timer_start))
+            logging.critical('[main] population_dist_by_age_group done.')
+
+        # QUERY SOURCE ACTIVITY DISTRIBUTION OVER ALL TICKS
+        elif cmd == 'src_act_dist':
+            logging.critical('[main] src_act_dist starts.')
+            timer_start = time.time()
+            logging.critical(stats_catalog_lookup('edge', 'src_act'))
+            logging.critical('Running time: %s' % str(time.time() - timer_start))
+            logging.critical('[main] src_act_dist done.')
+
+        # OPEN CSR TEMPORAL CONTACT NETWORK
+        elif cmd == 'cn_csr':
+            logging.critical('[main] cn_csr starts.')
+            d_csr = load_cn_csr()
+            logging.critical('[main] cn_csr done.')
+
+        # BENCHMARK CSR TEMPORAL CONTACT NETWORK AGAINST NEO4J
+        # If "neo4j_driver" is not run beforehand, only the CSR engine is timed.
+        elif cmd == 'benchmark_cn_csr':
+            logging.critical('[main] benchmark_cn_csr starts.')
+            if d_csr is None:
+                raise Exception('[main] d_csr is None. Run "cn_csr" first.')
+            exit_state = 'Isymp_s'
+            pid_file_path = path.join(g_epihiper_output_folder, g_int_cn_folder,
+                                      'pid_over_time_by_%s.pickle' % exit_state)
+            df_output_pid_over_time = pd.read_pickle(pid_file_path)
+            l_t = [tick for tick in df_output_pid_over_time.index.to_list() if tick in d_csr['l_tick']]
+            benchmark_cn_csr_vs_neo4j(neo4j_driver, d_csr, df_output_pid_over_time, l_t,
+                                      path.join(g_epihiper_output_folder, g_int_cn_folder,
+                                                'benchmark_cn_csr_%s.pickle' % exit_state))
+            logging.critical('[main] benchmark_cn_csr done.')
+
+        # BUILD PERSON COLUMN STORE WITH BITMAP INDEXES
+        elif cmd == 'build_person_col_store':
+            logging.critical('[main] build_person_col_store starts.')
+            build_person_col_store()
+            logging.critical('[main] build_person_col_store done.')
+
+        # OPEN PERSON COLUMN STORE
+        elif cmd == 'person_col_store':
+            logging.critical('[main] person_col_store starts.')
+            d_person = load_person_col_store()
+            logging.critical('[main] person_col_store done.')
+
         # CREATE INDEXES ON EPIHIPER OUTPUT DB
         elif cmd == 'create_epihiper_output_db_indexes':
             logging.critical('[main] create_epihiper_output_db_indexes starts.')
             create_indexes_on_epihipter_output_db()
             logging.critical('[main] create_epihiper_output_db_indexes done.')
 
+        # BUILD TRANSMISSION TREE FROM EPIHIPER OUTPUT DB
+        elif cmd == 'build_transmission_tree':
+            logging.critical('[main] build_transmission_tree starts.')
+            build_transmission_tree()
+            logging.critical('[main] build_transmission_tree done.')
+
+        # RUN EXAMPLE QUERY 1, 2 AND 3 BY THE CROSS-STORE QUERY PLANNER
+        # The columnar store and the person column store are used if opened beforehand.
+        elif cmd == 'planned_query':
+            logging.critical('[main] planned_query starts.')
+            d_cube = load_output_prefix_cube()
+            for query_name, spec in [('query_1', g_query_1_spec), ('query_2', g_query_2_spec),
+                                     ('query_3', g_query_3_spec)]:
+                df_ret, d_plan = run_planned_query(neo4j_driver, spec, d_cube, d_col_store, d_person)
+                pd.to_pickle(df_ret, path.join(g_epihiper_output_folder, g_int_cn_folder,
+                                               'planned_%s_results.pickle' % query_name))
+                with open(path.join(g_epihiper_output_folder, g_int_cn_folder, 'planned_%s_plan.json' % query_name),
+                          'w+') as out_fd:
+                    json.dump({'order': d_plan['order'], 'join': d_plan['join'], 'est_cost': d_plan['est_cost'],
+                               'd_cost': {'%s+%s' % plan: cost for plan, cost in d_plan['d_cost'].items()},
+                               'd_est': d_plan['d_est'], 'actual': d_plan['actual']}, out_fd, indent=4)
+            logging.critical('[main] planned_query done.')
+
+        # RUN QUERY 1 WITH ITS SQLITE PIDs PUSHED INTO NEO4J AS A COHORT LABEL
+        elif cmd == 'example_query_1_cohort':
+            logging.critical('[main] example_query_1_cohort starts.')
+            timer_start = time.time()
+            df_pid = query_1_sqlite_1(None, d_col_store)
+
+            def query_1_on_cohort(cohort_name):
+                return query_1_neo4j_1(neo4j_driver, None, None, cohort_name)
+
+            df_ret = run_with_pid_cohort(neo4j_driver, 'query_1', df_pid['pid'].to_list(), query_1_on_cohort)
+            out_folder = g_example_query_each_folder_fmt.format('1')
+            if not path.exists(out_folder):
+                os.makedirs(out_folder)
+            pd.to_pickle(df_ret, path.join(out_folder, 'results_cohort.pickle'))
+            logging.critical('[main] example_query_1_cohort done in %s secs.' % str(time.time() - timer_start))
+
+        # RUN QUERY 1 FOR ONE COHORT PER TICK IN A BATCH AND COMPARE WITH THE PER-COHORT LOOP
+        elif cmd == 'example_query_1_multi_cohort':
+            logging.critical('[main] example_query_1_multi_cohort starts.')
+            out_folder = g_example_query_each_folder_fmt.format('1')
+            if not path.exists(out_folder):
+                os.makedirs(out_folder)
+            d_cohort_pid = cohorts_by_tick(query_1_sqlite_1(None, d_col_store))
+            benchmark_query_1_multi_cohort(neo4j_driver, d_cohort_pid,
+                                           path.join(out_folder, 'multi_cohort_benchmark.json'))
+            logging.critical('[main] example_query_1_multi_cohort done.')
+
+        # ENABLE QUERY INSTRUMENTATION
+        # Following queries are recorded, and the report is written when the pipeline ends.
+        # "instrument_profile" also captures the PROFILE plan of every Neo4j query, which adds overhead.
+        elif cmd == 'instrument' or cmd == 'instrument_profile':
+            logging.critical('[main] %s starts.' % cmd)
+            g_instrument_enabled = True
+            g_instrument_profile = cmd == 'instrument_profile'
+            logging.critical('[main] %s done.' % cmd)
+
+        # ENABLE QUERY RESULT CACHE
+        # Following Neo4j read queries and SQLite query helpers go through the cache.
+        elif cmd == 'query_cache':
+            logging.critical('[main] query_cache starts.')
+            g_query_cache_enabled = True
+            logging.critical('[main] query_cache done. Load epoch is %s.' % get_load_epoch())
+
+        # REPORT QUERY RESULT CACHE METRICS
+        elif cmd == 'query_cache_report':
+            logging.critical('[main] query_cache_report starts.')
+            query_cache_report()
+            logging.critical('[main] query_cache_report done.')
+
+        # CLEAR QUERY RESULT CACHE
+        elif cmd == 'clear_query_cache':
+            logging.critical('[main] clear_query_cache starts.')
+            bump_load_epoch()
+            logging.critical('[main] clear_query_cache done.')
+
         # FETCH PIDs OVER TIME FROM EPIHIPER OUTPUT DB FOR A GIVEN EXIT STATE
         elif cmd == 'fetch_pids_by_exit_state':
             logging.critical('[main] fetch_pids_by_exit_state starts.')
             exit_state = 'Isymp_s'
             out_path = path.join(g_epihiper_output_folder, g_int_cn_folder, 'pid_over_time_by_%s.pickle' % exit_state)
-            fetch_pids_by_exit_state(exit_state, out_path)
+            fetch_pids_by_exit_state(exit_state, out_path, d_col_store, d_pidset_store)
             logging.critical('[main] fetch_pids_by_exit_state done.')
 
+        # FETCH NEWLY ENTERED PIDs OVER TIME FOR A GIVEN EXIT STATE
+        # Requires "pidset_store". Only PIDs not in the exit state at the previous tick are kept.
+        elif cmd == 'fetch_new_pids_by_exit_state':
+            logging.critical('[main] fetch_new_pids_by_exit_state starts.')
+            exit_state = 'Isymp_s'
+            out_path = path.join(g_epihiper_output_folder, g_int_cn_folder,
+                                 'new_pid_over_time_by_%s.pickle' % exit_state)
+            df_new_pid_over_time = pidset_store_pid_over_time(d_pidset_store, exit_state, newly_entered=True)
+            pd.to_pickle(df_new_pid_over_time, out_path)
+            logging.critical('[main] fetch_new_pids_by_exit_state done.')
+
         # COMPUTE DISTRIBUTION OF DURATION OVER TIME
         elif cmd == 'duration_distribution':
             logging.critical('[main] duration_distribution starts.')
@@ -1673,6 +7143,37 @@ if __name__ == '__main__':
                                             'duration_distribution_%s.PNG' % exit_state))
             logging.critical('[main] duration_distribution done.')
 
+        # COMPUTE APPROXIMATE DISTRIBUTION OF DURATION OVER TIME
+        # The CSR contact network is used if "cn_csr" is run beforehand. Otherwise, Neo4j is used.
+        elif cmd == 'approx_duration_distribution':
+            logging.critical('[main] approx_duration_distribution starts.')
+            exit_state = 'Isymp_s'
+            pid_file_path = path.join(g_epihiper_output_folder, g_int_cn_folder,
+                                      'pid_over_time_by_%s.pickle' % exit_state)
+            df_output_pid_over_time = pd.read_pickle(pid_file_path)
+            budget = 10000
+            unit_hist_fn_by_tick = duration_hist_fn_by_tick(neo4j_driver, d_csr)
+            df_dist = approx_duration_distribution(unit_hist_fn_by_tick, df_output_pid_over_time, budget,
+                                                   tol=0.001, num_boot=200, conf=0.95)
+            pd.to_pickle(df_dist, path.join(g_epihiper_output_folder, g_int_cn_folder,
+                                            'approx_duration_dist_%s.pickle' % exit_state))
+            logging.critical('[main] approx_duration_distribution done.')
+
+        # MEASURE SSAQF OF DURATION DISTRIBUTION OVER TIME
+        # The CSR contact network is used if "cn_csr" is run beforehand. Otherwise, Neo4j is used.
+        elif cmd == 'ssaqf_duration_distribution':
+            logging.critical('[main] ssaqf_duration_distribution starts.')
+            exit_state = 'Isymp_s'
+            pid_file_path = path.join(g_epihiper_output_folder, g_int_cn_folder,
+                                      'pid_over_time_by_%s.pickle' % exit_state)
+            df_output_pid_over_time = pd.read_pickle(pid_file_path)
+            l_sample_size = [10, 50, 100, 500, 1000, 5000, 10000, 50000]
+            unit_hist_fn_by_tick = duration_hist_fn_by_tick(neo4j_driver, d_csr)
+            ssaqf_duration_distribution(unit_hist_fn_by_tick, df_output_pid_over_time, l_sample_size,
+                                        path.join(g_epihiper_output_folder, g_int_cn_folder,
+                                                  'ssaqf_%s' % exit_state))
+            logging.critical('[main] ssaqf_duration_distribution done.')
+
         # OUTPUT BATCHED TNEANET GRAPHS TO FILES
         elif cmd == 'output_in_1nn_batch':
             logging.critical('[main] output_in_1nn_batch starts.')
@@ -1682,7 +7183,8 @@ if __name__ == '__main__':
             df_output_pid_over_time = pd.read_pickle(pid_file_path)
             batch_size = 1000
             out_folder = path.join(g_epihiper_output_folder, g_int_cn_folder)
-            output_in_1nn_batch(neo4j_driver, df_output_pid_over_time, batch_size, out_folder, exit_state)
+            output_in_1nn_batch(neo4j_driver, df_output_pid_over_time, batch_size, out_folder, exit_state,
+                                use_cohort_label=True)
             logging.critical('[main] output_in_1nn done.')
 
         # QUERY INCOMING DEGREES OF INFECTED PEOPLE
@@ -1691,58 +7193,70 @@ if __name__ == '__main__':
             timer_start = time.time()
             t = 5
             neo4j_session_config = {'database': g_neo4j_db_name}
-            df_output = load_epihiper_output(g_epihiper_output_path)
-            df_output = df_output.set_index('tick')
-            l_infect_pid = list(set(df_output.loc[t]['pid'].to_list()))
+            if d_col_store is not None:
+                l_infect_pid = col_store_pids_at_tick(d_col_store, t).tolist()
+            else:
+                df_output = load_epihiper_output(g_epihiper_output_path)
+                df_output = df_output.set_index('tick')
+                l_infect_pid = list(set(df_output.loc[t]['pid'].to_list()))
             logging.critical('Running time: %s' % str(time.time() - timer_start))
-            query_str = '''unwind $infect_pid as infect_pid
-                           match (n:PERSON {pid: infect_pid})
-                           return infect_pid, apoc.node.degree(n, "<CONTACT")'''
-            query_param = {'infect_pid': l_infect_pid}
-            ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [query_str], l_query_param=[query_param],
-                                        need_ret=True)
+            # Degrees are looked up from the degree tables of tick t if materialized.
+            df_deg = tick_degree_lookup(t, l_infect_pid, deg_dir='in')
+            if df_deg is not None:
+                ret = [df_deg.values.tolist()]
+            else:
+                # Only edges at tick t are counted. 'apoc.node.degree' would count edges of all ticks.
+                query_str = '''unwind $infect_pid as infect_pid
+                               match (n:PERSON {pid: infect_pid})
+                               optional match ()-[r:CONTACT]->(n) where r.occur = $tick
+                               return infect_pid, count(r)'''
+                query_param = {'infect_pid': l_infect_pid, 'tick': t}
+                ret = execute_neo4j_queries(neo4j_driver, neo4j_session_config, [query_str],
+                                            l_query_param=[query_param], need_ret=True)
             logging.critical('return:')
             logging.critical(ret[0])
             # logging.critical([item for item in ret[0] if item['apoc.node.degree(n, "<CONTACT")'] > 0])
             logging.critical('[main] infect_in_deg_dist_at_t done.')
 
+        # The two stages of an example query overlap, and PIDs are handed over in memory.
         elif cmd == 'example_query_1':
             logging.critical('[main] example_query_1 starts.')
             timer_start = time.time()
             query_id = 1
-            sqlite_out_name = 'sqlite_pid.pickle'
-            sqlite_out_path = path.join(g_example_query_each_folder_fmt.format(str(query_id)), sqlite_out_name)
-            neo4j_out_name = 'results.pickle'
-            neo4j_out_path = path.join(g_example_query_each_folder_fmt.format(str(query_id)), neo4j_out_name)
-            query_1_sqlite_1(sqlite_out_path)
-            df_pid = pd.read_pickle(sqlite_out_path)
-            query_1_neo4j_1(neo4j_driver, df_pid, neo4j_out_path)
+            checkpoint_folder = None
+            if g_example_query_checkpoint:
+                checkpoint_folder = g_example_query_each_folder_fmt.format(str(query_id))
+            example_query_1_pipeline(neo4j_driver, d_col_store, checkpoint_folder=checkpoint_folder,
+                                     d_person=d_person)
             logging.critical('[main] example_query_1 done in %s secs.' % str(time.time() - timer_start))
 
         elif cmd == 'example_query_2':
             logging.critical('[main] example_query_2 starts.')
             timer_start = time.time()
             query_id = 2
-            neo4j_out_name = 'neo4j_pid.pickle'
-            neo4j_out_path = path.join(g_example_query_each_folder_fmt.format(str(query_id)), neo4j_out_name)
-            sqlite_out_name = 'results.pickle'
-            sqlite_out_path = path.join(g_example_query_each_folder_fmt.format(str(query_id)), sqlite_out_name)
-            query_2_neo4j_1(neo4j_driver, neo4j_out_path)
-            df_pid = pd.read_pickle(neo4j_out_path)
-            query_2_sqlite_1(df_pid, sqlite_out_path)
+            checkpoint_folder = None
+            if g_example_query_checkpoint:
+                checkpoint_folder = g_example_query_each_folder_fmt.format(str(query_id))
+            example_query_neo4j_to_sqlite_pipeline(neo4j_driver, g_query_2_neo4j_1_str,
+                                                   checkpoint_folder=checkpoint_folder)
             logging.critical('[main] example_query_2 done in %s secs.' % str(time.time() - timer_start))
 
         elif cmd == 'example_query_3':
             logging.critical('[main] example_query_3 starts.')
             timer_start = time.time()
             query_id = 3
-            neo4j_out_name = 'neo4j_pid.pickle'
-            neo4j_out_path = path.join(g_example_query_each_folder_fmt.format(str(query_id)), neo4j_out_name)
-            sqlite_out_name = 'results.pickle'
-            sqlite_out_path = path.join(g_example_query_each_folder_fmt.format(str(query_id)), sqlite_out_name)
-            query_3_neo4j_1(neo4j_driver, neo4j_out_path)
-            df_pid = pd.read_pickle(neo4j_out_path)
-            query_3_sqlite_1(df_pid, sqlite_out_path)
+            checkpoint_folder = None
+            if g_example_query_checkpoint:
+                checkpoint_folder = g_example_query_each_folder_fmt.format(str(query_id))
+            if d_person is not None and d_csr is not None:
+                df_pid = query_3_person_col_1(d_person, d_csr, None)
+                df_exit_state = query_3_sqlite_1(df_pid, None)
+                if checkpoint_folder is not None:
+                    pd.to_pickle(df_pid, path.join(checkpoint_folder, 'neo4j_pid.pickle'))
+                    pd.to_pickle(df_exit_state, path.join(checkpoint_folder, 'results.pickle'))
+            else:
+                example_query_neo4j_to_sqlite_pipeline(neo4j_driver, g_query_3_neo4j_1_str,
+                                                       checkpoint_folder=checkpoint_folder)
             logging.critical('[main] example_query_3 done in %s secs.' % str(time.time() - timer_start))
 
         elif cmd == 'example_query_5':
@@ -1751,9 +7265,38 @@ if __name__ == '__main__':
             query_id = 5
             neo4j_out_name = 'results.pickle'
             neo4j_out_path = path.join(g_example_query_each_folder_fmt.format(str(query_id)), neo4j_out_name)
-            query_5_neo4j_1(neo4j_driver, neo4j_out_path)
+            if d_hh is not None:
+                query_5_household_1(d_hh, neo4j_out_path)
+            else:
+                query_5_neo4j_1(neo4j_driver, neo4j_out_path)
             logging.critical('[main] example_query_5 done in %s secs.' % str(time.time() - timer_start))
 
+        # SERVE QUERIES FROM A LONG-LIVED DAEMON
+        # Whatever is opened by earlier commands is kept warm. Runs until "query_daemon_shutdown" or Ctrl-C.
+        elif cmd == 'query_daemon':
+            logging.critical('[main] query_daemon starts.')
+            serve_query_daemon(neo4j_driver, d_col_store=d_col_store, d_person=d_person, d_pidset_store=d_pidset_store)
+            logging.critical('[main] query_daemon done.')
+
+        # SEND EXAMPLE QUERIES TO THE DAEMON
+        # No heavy modules are imported on this side.
+        elif cmd == 'query_daemon_example':
+            logging.critical('[main] query_daemon_example starts.')
+            num_rep = 5
+            for query_name in ['query_1', 'query_2', 'query_3']:
+                for rep in range(num_rep):
+                    timer_start = time.time()
+                    d_resp = query_daemon_request([{'op': 'planned_query', 'query': query_name}])[0]
+                    logging.critical('[main] %s #%s: ok=%s, server %s secs, round trip %s secs.'
+                                     % (query_name, rep, d_resp['ok'], d_resp['secs'], time.time() - timer_start))
+            logging.critical(query_daemon_request([{'op': 'stats'}])[0])
+            logging.critical('[main] query_daemon_example done.')
+
+        elif cmd == 'query_daemon_shutdown':
+            logging.critical('[main] query_daemon_shutdown starts.')
+            query_daemon_request([{'op': 'shutdown'}])
+            logging.critical('[main] query_daemon_shutdown done.')
+
         # TEST FOR PARALLEL LOADING USING APOC
         elif cmd == 'parallel_apoc':
             logging.critical('[main] parallel_apoc starts.')
@@ -1788,7 +7331,7 @@ if __name__ == '__main__':
         elif cmd == 'bogus_data':
             logging.critical('[main] bogus_data starts.')
             try:
-                db_con = sqlite3.connect(g_epihiper_output_db_path)
+                db_con = connect_to_sqlite(g_epihiper_output_db_path)
                 db_cur = db_con.cursor()
             except Exception as e:
                 logging.error(e)
@@ -1843,4 +7386,9 @@ if __name__ == '__main__':
             except Exception as e:
                 logging.error('[main] final commit, error: %s' % e)
             db_con.close()
-            logging.critical('[main] bogus_data done.')
\ No newline at end of file
+            logging.critical('[main] bogus_data done.')
+
+    run_pipeline(l_cmd, run_cmd)
+
+    if g_instrument_enabled:
+        write_instrument_report()